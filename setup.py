@@ -17,11 +17,12 @@ DEPENDENCIES = [
     'pyserial',
     'gpiozero',
     'pymemcache',
+    'numpy',
     'RPi.GPIO',
     'grpcio',
 ]
 
-TEST_DEPENDENCIES = []
+TEST_DEPENDENCIES = ['pytest']
 
 VERSION = '2.2.1'
 URL = 'https://github.com/ammolytics/open-trickler-peripheral/'
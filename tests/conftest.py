@@ -0,0 +1,56 @@
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+
+The trickler modules import each other by bare name, as they do when run from the trickler directory.
+"""
+
+import configparser
+import os
+import sys
+
+import pytest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'trickler'))
+
+
+@pytest.fixture
+def config():
+    """Returns the shipped config file."""
+    parser = configparser.ConfigParser()
+    parser.optionxform = str
+    parser.read(os.path.join(ROOT, 'opentrickler_config.ini'))
+    return parser
+
+
+class Clock:
+    """Stands in for the time module, as twin.VirtualClock does. Time only passes by sleeping or advance()."""
+
+    def __init__(self, start=1000.0):
+        self.now = int(start * 1e9)
+
+    def monotonic_ns(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now / 1e9
+
+    time = monotonic
+    time_ns = monotonic_ns
+    perf_counter = monotonic
+    perf_counter_ns = monotonic_ns
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def advance(self, seconds):
+        """Moves the time forward."""
+        self.now += max(int(round(seconds * 1e9)), 0)
+
+
+@pytest.fixture
+def clock():
+    """Returns a Clock, to monkeypatch over the time module of the modules under test."""
+    return Clock()
@@ -0,0 +1,119 @@
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+"""
+
+import math
+
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+import autotune # pylint: disable=wrong-import-position;
+import controller # pylint: disable=wrong-import-position;
+import PID # pylint: disable=wrong-import-position;
+
+
+PLANT = autotune.Plant((0.3, 0.9), 0.25, 0.3, 0.25, 0.0)
+SETTINGS = autotune.Settings(
+    dt=0.1, target=30.0, start=0.9, resolution=0.02, min_pwm=20.0, max_pwm=100.0, windup=20.0, fine_remainder=0.1,
+    max_time=30.0, settle_time=2.0, flow_noise=0.0)
+
+
+def _charge(pid, settings=SETTINGS, plant=PLANT):
+    """Runs one charge of the autotuner's plant with a scalar controller, as simulate() runs thousands."""
+    dt = settings.dt
+    target = settings.target
+    delay = int(round(plant.dead_time / dt))
+    alpha = min(dt / plant.lag, 1.0)
+    landed = reading = settings.start * target
+    pipe = [0.0] * (delay + 1)
+    pid.SetPoint = 100.0
+    pid.last_time = 0.0
+    active = True
+    done_at = math.inf
+    steps = int(settings.max_time / dt)
+    for step in range(steps + int(settings.settle_time / dt)):
+        measured = round(reading / settings.resolution) * settings.resolution
+        remainder = target - measured
+        if step >= steps:
+            active = False
+        elif active and remainder <= 0:
+            done_at = step * dt
+            active = False
+        pid.update(measured / target * 100, (step + 1) * dt)
+        pwm = min(max(math.trunc(pid.output), settings.min_pwm), settings.max_pwm) / 100
+        motor1 = pwm if active else 0.0
+        motor2 = pwm if active and remainder > settings.fine_remainder else 0.0
+        pipe[step % (delay + 1)] = dt * sum(
+            gain * max((motor - plant.stall) / (1 - plant.stall), 0)
+            for gain, motor in zip(plant.gains, (motor1, motor2)))
+        landed += pipe[(step + 1) % (delay + 1)]
+        reading += (landed - reading) * alpha
+    return done_at, round(reading / settings.resolution) * settings.resolution - target
+
+
+@pytest.mark.parametrize('kwargs', [
+    {},
+    dict(setpoint_weight=0.8, derivative_weight=0.5, derivative_filter=0.3, tracking_time=0.5),
+    dict(schedule=[(5, 8, 0, 2), (20, 12, 2, 3)]),
+])
+def test_simulate_v2_matches_controller(kwargs):
+    """The vectorized v2 law runs charges as controller.Controller does."""
+    pid = controller.Controller(10, 1.5, 3.75, output_limits=(SETTINGS.min_pwm, SETTINGS.max_pwm), **kwargs)
+    settings = SETTINGS._replace(law='v2', v2=(
+        pid.setpoint_weight, pid.derivative_weight, pid.derivative_filter, pid.tracking_time, pid.schedule))
+    done_at, overshoot = autotune.simulate(PLANT, settings, numpy.array([[10, 1.5, 3.75]]), 1, 0)
+    expected = _charge(pid, settings)
+    assert done_at[0, 0] == pytest.approx(expected[0])
+    assert overshoot[0, 0] == pytest.approx(expected[1])
+
+
+def test_simulate_ivpid_matches_pid():
+    """The vectorized IvPID law runs charges as PID.PID does."""
+    pid = PID.PID(10, 1.5, 3.75)
+    pid.sample_time = 0
+    done_at, overshoot = autotune.simulate(PLANT, SETTINGS, numpy.array([[10, 1.5, 3.75]]), 1, 0)
+    expected = _charge(pid)
+    assert done_at[0, 0] == pytest.approx(expected[0])
+    assert overshoot[0, 0] == pytest.approx(expected[1])
+
+
+def test_gain_grid(config):
+    grid = autotune.gain_grid(config, 3)
+    assert grid.shape == (27, 3)
+    assert grid[:, 0].min() == pytest.approx(10 / 4)
+    assert grid[:, 0].max() == pytest.approx(10 * 4)
+
+
+def test_pareto_front_and_choose():
+    results = [
+        autotune.Result(1, 0, 0, 10.0, 0.10, 1.0),
+        autotune.Result(2, 0, 0, 12.0, 0.02, 1.0),
+        autotune.Result(3, 0, 0, 13.0, 0.05, 1.0),
+        autotune.Result(4, 0, 0, 5.0, 0.00, 0.5),
+    ]
+    front = autotune.pareto_front(results)
+    assert [x.kp for x in front] == [1, 2]
+    assert autotune.choose(front, 0.02).kp == 2
+    assert autotune.choose(front, 0.001).kp == 2
+    assert autotune.choose(front, 0.2).kp == 1
+
+
+def test_identify_recovers_plant():
+    """A charge simulated from a known plant identifies it again."""
+    # The lag is one of autotune.LAG_CANDIDATES.
+    plant = PLANT._replace(lag=0.3)
+    dt = 0.1
+    rng = numpy.random.default_rng(1)
+    motor1 = numpy.repeat(rng.uniform(0.3, 1.0, 40), 5)
+    motor2 = numpy.repeat(rng.uniform(0.3, 1.0, 40), 5) * (rng.uniform(size=200) > 0.5)
+    poured = numpy.cumsum(
+        plant.gains[0] * autotune.effective_pwm(motor1, plant.stall)
+        + plant.gains[1] * autotune.effective_pwm(motor2, plant.stall)) * dt
+    delay = int(round(plant.dead_time / dt))
+    landed = numpy.concatenate((numpy.zeros(delay), poured[:-delay])) + 27.0
+    weight = autotune.lag_filter(landed, [dt / plant.lag])[0]
+    identified = autotune.identify([(weight, motor1, motor2)], dt)
+    assert identified.gains == pytest.approx(plant.gains, rel=0.05)
+    assert (identified.stall, identified.dead_time, identified.lag) == pytest.approx(plant[1:4])
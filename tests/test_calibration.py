@@ -0,0 +1,102 @@
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+"""
+
+import pytest
+
+import calibration
+import dump
+import scales
+
+
+UNITS = scales.SerialScale.Units
+
+
+def plane(angle, dwell):
+    """Dump mass in grams of a measure which lands 1g at 90 degrees without dwelling."""
+    return 1 + 0.02 * (angle - 90) + 0.4 * dwell
+
+
+def landed(angle, dwell, mass, settled=True):
+    """Returns the dump.DumpResult of a dump."""
+    return dump.DumpResult(0, 1, 2, 50, settled, angle, dwell, mass)
+
+
+@pytest.fixture(name='calibrated')
+def fixture_calibrated(tmp_path):
+    calibrated = calibration.DumpCalibration('varget', str(tmp_path / 'calibration.json'), 90)
+    for angle, dwell in ((88, 0), (92, 0), (88, 0.25), (92, 0.25), (90, 0)):
+        calibrated.learn(landed(angle, dwell, plane(angle, dwell)), UNITS.GRAMS)
+    return calibrated
+
+
+def test_to_grams():
+    assert calibration.to_grams(scales.GRAINS_PER_GRAM, UNITS.GRAINS) == pytest.approx(1)
+    assert calibration.to_grams(2, UNITS.GRAMS) == 2
+
+
+def test_fit_samples():
+    samples = [(a, d, plane(a, d)) for a, d in ((80, 0), (90, 0), (100, 0.5), (90, 0.25))]
+    fit = calibration.fit_samples(samples, 0.005)
+    assert fit.angle_slope == pytest.approx(0.02)
+    assert fit.dwell_slope == pytest.approx(0.4)
+    assert fit.sigma == 0.005
+    assert calibration.fit_samples(samples[:2]) is None
+
+
+def test_fit_samples_unvaried():
+    """A variable which hasn't been varied gets no slope, and the scatter shows in sigma."""
+    fit = calibration.fit_samples([(90, 0, 1.0), (90, 0, 1.1), (94, 0, 1.1), (94, 0, 1.2)])
+    assert fit.dwell_slope == pytest.approx(0)
+    assert fit.angle_slope == pytest.approx(0.025)
+    assert fit.sigma == pytest.approx(0.1)
+
+
+def test_uncalibrated():
+    """Until there are min_samples, the measure dumps at the default angle onto a pan less than half full."""
+    uncalibrated = calibration.DumpCalibration(default_angle=90)
+    assert uncalibrated.choose(1.0, 0.2, UNITS.GRAMS) == (90, 0, None)
+    assert uncalibrated.choose(1.0, 0.6, UNITS.GRAMS) is None
+    assert uncalibrated.predict(90, 0) is None
+
+
+def test_predict(calibrated):
+    assert calibrated.predict(100, 0.5) == pytest.approx(plane(100, 0.5))
+
+
+def test_choose(calibrated):
+    """The closest command under the target, less margin and safety, within a step of those tried."""
+    angle, dwell, predicted = calibrated.choose(1.19, 0, UNITS.GRAMS)
+    assert (angle, dwell) == (92, 0.25)
+    assert predicted == pytest.approx(1.14)
+    angle, dwell, predicted = calibrated.choose(3.0, 0, UNITS.GRAMS)
+    assert (angle, dwell) == (96, 0.5)
+    assert calibrated.choose(1.19, 1.0, UNITS.GRAMS) is None
+
+
+def test_choose_grains(calibrated):
+    target = 1.19 * scales.GRAINS_PER_GRAM
+    assert calibrated.choose(target, 0, UNITS.GRAINS)[:2] == (92, 0.25)
+
+
+def test_learn(calibrated, tmp_path):
+    """Dumps the scale didn't settle after, or which landed nothing, aren't samples. Samples are kept in the file."""
+    calibrated.learn(landed(96, 0, 1.12, settled=False), UNITS.GRAMS)
+    calibrated.learn(landed(96, 0, 0), UNITS.GRAMS)
+    assert len(calibrated.samples) == 5
+    calibrated.learn(landed(96, 0, plane(96, 0) * scales.GRAINS_PER_GRAM), UNITS.GRAINS)
+    assert calibrated.samples[-1] == (96, 0, pytest.approx(plane(96, 0)))
+
+    reloaded = calibration.DumpCalibration('varget', str(tmp_path / 'calibration.json'), 90, max_samples=4)
+    assert reloaded.samples == calibrated.samples[-4:]
+    assert calibration.DumpCalibration('h4350', str(tmp_path / 'calibration.json')).samples == []
+
+
+def test_from_config(config, tmp_path):
+    assert calibration.from_config(config) is None
+    config['cutoff']['profile'] = 'varget'
+    calibrated = calibration.from_config(config, enabled='true', samples_file=str(tmp_path / 'calibration.json'))
+    assert (calibrated.profile, calibrated.default_angle) == ('varget', float(config['servo']['servo_angle']))
+    assert calibrated.angles == list(range(60, 121, 4))
+    assert calibrated.dwells == [0, 0.25, 0.5]
@@ -0,0 +1,128 @@
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+"""
+
+import types
+
+import pytest
+
+import cascade
+import controller
+
+
+class Motor:
+    """Trickler motor which only remembers its speed, clamped as motors.TricklerMotor clamps it."""
+
+    def __init__(self, min_pwm=30, max_pwm=100):
+        self.min_pwm = min_pwm
+        self.max_pwm = max_pwm
+        self.speed = 0.0
+
+    def update(self, target_pwm):
+        self.speed = max(min(int(target_pwm), self.max_pwm), self.min_pwm) / 100
+
+    def off(self):
+        self.speed = 0.0
+
+
+def _cascade(pid=None, bulk_pid=None):
+    """Returns a bulk stage handing off at 10 ticks with a hysteresis of 2, then a fine stage."""
+    stages = [
+        cascade.Stage('2', Motor(40, 100), cascade.Threshold(10, False), cascade.Threshold(2, False), bulk_pid),
+        cascade.Stage('1', Motor(30, 60), cascade.Threshold(0, False), cascade.Threshold(2, False)),
+    ]
+    return cascade.Cascade(stages, pid or types.SimpleNamespace(output=50.0))
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('5', cascade.Threshold(5.0, False)),
+    ('5 ticks', cascade.Threshold(5.0, False)),
+    ('2 percent', cascade.Threshold(2.0, True)),
+    ('2%', cascade.Threshold(2.0, True)),
+])
+def test_threshold_parse(text, expected):
+    assert cascade.Threshold.parse(text) == expected
+
+
+def test_threshold_parse_unit():
+    with pytest.raises(ValueError):
+        cascade.Threshold.parse('5 grains')
+
+
+def test_threshold_percent():
+    threshold = cascade.Threshold(2.0, True)
+    assert threshold.ticks(500) == 10
+    assert threshold.weight(25, 0.02) == 0.5
+
+
+def test_handoff_and_takeover():
+    """The bulk stage runs down to its handoff, and takes over again only above handoff plus hysteresis."""
+    trickle = _cascade()
+    trickle.start(500, 0.0)
+    assert trickle.update(100, 50.0, 1.0) == 0
+    assert trickle.speed('2') == 0.5 and trickle.speed('1') == 0.5
+
+    assert trickle.update(10, 98.0, 2.0) == 1
+    assert trickle.speed('2') == 0.0 and trickle.speed('1') == 0.5
+    # Within the hysteresis, the fine stage keeps going alone.
+    assert trickle.update(12, 97.0, 3.0) == 1
+    assert trickle.speed('2') == 0.0
+    assert trickle.update(13, 97.0, 4.0) == 0
+    assert trickle.speed('2') == 0.5
+
+    trickle.off()
+    assert trickle.total_speed == 0.0
+
+
+def test_several_handoffs_in_one_reading():
+    """A reading past several handoffs at once runs only the stages still needed."""
+    stages = [
+        cascade.Stage(str(x), Motor(), cascade.Threshold(handoff, False), cascade.Threshold(1, False))
+        for x, handoff in ((3, 20), (2, 10), (1, 0))]
+    trickle = cascade.Cascade(stages, types.SimpleNamespace(output=50.0))
+    trickle.start(500, 0.0)
+    assert trickle.update(5, 99.0, 1.0) == 2
+    assert trickle.peak_speed == 0.5
+    assert trickle.speed('3') == trickle.speed('2') == 0.0
+
+
+def test_shared_pid_limits_follow_running_stage():
+    """The cascade's v2 controller is clamped to the envelope of the first stage it drives."""
+    pid = controller.Controller(10, 1, 0)
+    trickle = _cascade(pid)
+    trickle.start(500, 0.0)
+    assert pid.output_limits == (40, 100)
+    trickle.update(5, 99.0, 1.0)
+    assert pid.output_limits == (30, 60)
+    trickle.update(50, 90.0, 2.0)
+    assert pid.output_limits == (40, 100)
+
+
+def test_stage_with_own_pid():
+    """A stage with its own controller runs from it, and keeps its own envelope."""
+    bulk_pid = controller.Controller(20, 0, 0)
+    pid = controller.Controller(10, 0, 0)
+    trickle = _cascade(pid, bulk_pid)
+    assert bulk_pid.output_limits == (40, 100)
+    trickle.start(500, 0.0)
+    pid.SetPoint = 100.0
+    pid.update(97.0, 1.0)
+    trickle.update(100, 97.0, 1.0)
+    assert bulk_pid.output == 60.0
+    assert trickle.speed('2') == 0.6 and trickle.speed('1') == 0.3
+    assert pid.output_limits == (30, 60)
+
+
+def test_str_formats_speeds():
+    trickle = _cascade()
+    trickle.start(500, 0.0)
+    trickle.update(100, 50.0, 1.0)
+    assert str(trickle) == '2=0.5 1=0.5'
+
+
+def test_from_config(config):
+    """The default cascade is motor 2 handing off to motor 1."""
+    trickle = cascade.from_config(config, types.SimpleNamespace(output=0.0), lambda x: Motor())
+    assert [x.name for x in trickle.stages] == ['2', '1']
+    assert trickle.stages[0].handoff == cascade.Threshold(5.0, False)
@@ -0,0 +1,117 @@
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+"""
+
+import collections
+import enum
+import sqlite3
+
+import pytest
+
+import charges
+
+
+DumpResult = collections.namedtuple('DumpResult', 'start pour_end end')
+TrickleResult = collections.namedtuple('TrickleResult', 'start end peak_pwm iterations reason')
+
+
+class Reason(enum.Enum):
+    COMPLETE = 'complete'
+    PAN_REMOVED = 'pan_removed'
+
+
+def charge(start, overshoot=0.02, reason='complete', station='a'):
+    """Returns a charge which started trickling at a time, unsettled if it has no overshoot."""
+    settled = (None, None) if overshoot is None else (start + 5, 24.5 + overshoot)
+    return charges.Charge(
+        station, 24.5, 'g', start - 3, start - 1.5, start - 1, start, start + 4, *settled, overshoot, 80.0, 40, reason)
+
+
+@pytest.fixture(name='conn')
+def fixture_conn(tmp_path):
+    conn = charges.connect(str(tmp_path / 'charges.db'))
+    with conn:
+        conn.executemany(charges.INSERT, [
+            charge(0, 0.02), charge(600, 0.04), charge(3700, 0.02), charge(4000, None, 'pan_removed'),
+            charge(4100, 0.06, station='b')])
+    yield conn
+    conn.close()
+
+
+def test_find(conn):
+    assert [x.trickle_start for x in charges.find(conn, 0, 4000)] == [0, 600, 3700]
+    assert [x.trickle_start for x in charges.find(conn, 0, 5000, 'b')] == [4100]
+    assert charges.find(conn, 0, 1)[0] == charge(0)
+
+
+def test_throughput(conn):
+    assert charges.throughput(conn, 0, 5000) == [(0, 2, 0), (3600, 2, 1)]
+    assert charges.throughput(conn, 0, 5000, station='a') == [(0, 2, 0), (3600, 1, 1)]
+
+
+def test_cycle_breakdown(conn):
+    averages, reasons = charges.cycle_breakdown(conn, 0, 5000)
+    assert averages['charges'] == 4
+    assert averages['dump'] == pytest.approx(2)
+    assert averages['pour'] == pytest.approx(1.5)
+    assert averages['dump_to_trickle'] == pytest.approx(1)
+    assert averages['trickle'] == pytest.approx(4)
+    assert averages['cycle'] == pytest.approx(8)
+    assert reasons == {'complete': 4, 'pan_removed': 1}
+
+
+def test_overshoot_distribution(conn):
+    summary = charges.overshoot_distribution(conn, 0, 5000)
+    assert summary['charges'] == 4
+    assert summary['mean'] == pytest.approx(0.035)
+    assert summary['histogram'] == {0.02: 2, 0.04: 1, 0.06: 1}
+    assert (summary['p50'], summary['p99']) == (0.04, 0.06)
+    assert charges.overshoot_distribution(conn, 10000, 20000) == {'charges': 0}
+
+
+def test_connect_adds_columns(tmp_path):
+    """Databases from before a column was added get it."""
+    path = str(tmp_path / 'old.db')
+    old = sqlite3.connect(path)
+    old.execute(charges.SCHEMA[0].replace('pour_end REAL,', ''))
+    old.close()
+    conn = charges.connect(path)
+    assert 'pour_end' in {x[1] for x in conn.execute('PRAGMA table_info(charges)')}
+    conn.close()
+
+
+def test_charge_log(tmp_path):
+    """Charges are written once settled, or on close if they never settle."""
+    path = str(tmp_path / 'charges.db')
+    log = charges.ChargeLog(path, 'a', settle_time=0, flush_interval=0)
+    log.trickled(24.5, 'g', DumpResult(1, 2, 3), TrickleResult(4, 5, 80.0, 40, Reason.COMPLETE))
+    log.settled(24.52, False)
+    log.settled(24.52, True)
+    log.trickled(24.5, 'g', None, TrickleResult(10, 11, 60.0, 20, Reason.PAN_REMOVED))
+    log.close()
+    assert log.written == 2
+
+    conn = charges.connect(path)
+    settled, unsettled = charges.find(conn, 0, 100)
+    conn.close()
+    assert settled.final_weight == 24.52
+    assert settled.overshoot == pytest.approx(0.02)
+    assert (settled.dump_start, settled.pour_end, settled.dump_end) == (1, 2, 3)
+    assert unsettled.final_weight is None
+    assert unsettled.dump_start is None
+    assert unsettled.abort_reason == 'pan_removed'
+
+
+def test_parse_time():
+    assert charges.parse_time('30m', 10000) == 10000 - 1800
+    assert charges.parse_time('1.5h', 10000) == 10000 - 5400
+    assert charges.parse_time('2024-05-01T00:00:00+00:00') == 1714521600
+
+
+def test_from_config(config, tmp_path):
+    assert charges.from_config(config) is None
+    config['charges'] = {'enabled': 'true', 'database': str(tmp_path / 'charges.db'), 'settle_time': '2'}
+    log = charges.from_config(config, 'b')
+    log.close()
+    assert (log.station, log.settle_time) == ('b', 2.0)
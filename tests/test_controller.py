@@ -0,0 +1,124 @@
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+"""
+
+import pytest
+
+import controller
+import PID
+
+
+def _controller(*gains, **kwargs):
+    """Returns a controller heading for 100 percent, started at time 0."""
+    pid = controller.Controller(*gains, **kwargs)
+    pid.SetPoint = 100.0
+    pid.last_time = 0.0
+    return pid
+
+
+def test_proportional_and_integral():
+    pid = _controller(2, 0.5, 0)
+    pid.update(90.0, 1.0)
+    assert pid.PTerm == 20.0
+    assert pid.output == 20.0
+    # 10 percent of error for a second, applied from the next reading.
+    assert pid.ITerm == 10.0
+    pid.update(90.0, 2.0)
+    assert pid.output == 25.0
+
+
+def test_same_time_adds_nothing():
+    """A reading at a time which hasn't moved on is ignored."""
+    pid = _controller(2, 0.5, 0)
+    pid.update(90.0, 1.0)
+    pid.update(90.0, 2.0)
+    output, integral = pid.output, pid.ITerm
+    pid.update(50.0, 2.0)
+    assert (pid.output, pid.ITerm) == (output, integral)
+
+
+def test_derivative_is_filtered():
+    """A step in the reading moves the derivative only part of the way at once."""
+    pid = _controller(0, 0, 1, derivative_filter=0.2)
+    pid.update(50.0, 0.1)
+    pid.update(40.0, 0.2)
+    # The derivative acts on the falling reading at 100 percent/s, of which 0.1 / (0.2 + 0.1) gets through.
+    assert pid.DTerm == pytest.approx(100 / 3)
+
+
+def test_setpoint_weight():
+    pid = _controller(2, 0, 0, setpoint_weight=0.5)
+    pid.update(40.0, 1.0)
+    assert pid.PTerm == 20.0
+
+
+def test_back_calculation_limits_windup():
+    """With the output pinned at the limit, the integral settles where error and tracking balance, rather than winding
+    up."""
+    pid = _controller(1, 1, 0, output_limits=(0, 100), tracking_time=0.5)
+    for tick in range(1, 200):
+        pid.update(0.0, tick * 0.1)
+    unlimited = _controller(1, 1, 0)
+    for tick in range(1, 200):
+        unlimited.update(0.0, tick * 0.1)
+    # error == (output - limit) / (Ki * tracking_time), with output = 100 + ITerm.
+    assert pid.ITerm == pytest.approx(50, abs=0.5)
+    assert unlimited.ITerm > 1000
+
+
+def test_scheduled_ki_rescales_integral():
+    """Moving to a band with another Ki keeps Ki * ITerm as it was."""
+    pid = _controller(10, 1, 0, schedule=[(50, 10, 2, 0)])
+    pid.update(40.0, 1.0)
+    pid.update(40.0, 2.0)
+    share = pid.Ki * pid.ITerm
+    pid.update(60.0, 2.5)
+    assert pid.Ki == 2
+    assert pid.integral_gain * (pid.ITerm - 40 * 0.5) == pytest.approx(share)
+
+
+def test_ki_zero_band_holds_integral_output():
+    """Crossing into a band with a Ki of 0 keeps the integral's share of the output, and stops it accumulating."""
+    pid = _controller(10, 1, 0, schedule=[(5, 10, 0, 0)])
+    for tick in range(1, 11):
+        pid.update(90.0, float(tick))
+    share = pid.integral_gain * pid.ITerm
+    assert share == 100
+
+    pid.update(96.0, 11.0)
+    assert pid.Ki == 0
+    # Only the proportional term follows the smaller error, the integral's 100 percent stays in the output.
+    assert pid.output == pytest.approx(10 * 4 + share)
+    pid.update(97.0, 12.0)
+    assert pid.integral_gain * pid.ITerm == pytest.approx(share)
+
+    # Leaving the band picks the integral up where it was.
+    pid.update(80.0, 13.0)
+    assert pid.Ki == 1
+    assert pid.output - pid.PTerm == pytest.approx(share)
+
+
+def test_clear_restores_gains():
+    pid = _controller(10, 1, 0, schedule=[(5, 5, 0, 0)])
+    pid.update(99.0, 1.0)
+    pid.clear()
+    assert (pid.Kp, pid.Ki, pid.Kd, pid.integral_gain, pid.ITerm) == (10, 1, 0, 1, 0)
+
+
+def test_parse_schedule():
+    assert controller.parse_schedule('5: 8 1.2 3.75, 1: 6 1.0 3.75') == [(5, 8, 1.2, 3.75), (1, 6, 1.0, 3.75)]
+    assert controller.parse_schedule('') == []
+    with pytest.raises(ValueError):
+        controller.parse_schedule('5: 8 1.2')
+
+
+def test_from_config(config):
+    assert isinstance(controller.from_config(config), PID.PID)
+    config['PID']['controller'] = 'v2'
+    pid = controller.from_config(config, Kp=20)
+    assert isinstance(pid, controller.Controller)
+    assert pid.Kp == 20
+    config['PID']['controller'] = 'v3'
+    with pytest.raises(ValueError):
+        controller.from_config(config)
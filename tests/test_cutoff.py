@@ -0,0 +1,113 @@
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+"""
+
+import json
+
+import pytest
+
+import cutoff
+
+
+@pytest.fixture(name='estimator')
+def fixture_estimator(monkeypatch, clock, tmp_path):
+    monkeypatch.setattr(cutoff, 'time', clock)
+    return cutoff.CutoffEstimator('varget', str(tmp_path / 'cutoff.json'))
+
+
+def trickle(estimator, target, rate=0.1, pwm=50, start=9.0, interval=0.1):
+    """Feeds readings of a steady flow to the estimator until it stops, and returns the weight it stopped at."""
+    estimator.start()
+    for count in range(10000):
+        weight = round(start + rate * interval * count, 6)
+        if estimator.update(int(count * interval * 1e9), weight, pwm, target):
+            return weight
+    raise AssertionError('never stopped')
+
+
+def test_rate(estimator):
+    assert estimator.rate() == 0
+    trickle(estimator, 9.2)
+    assert estimator.rate() == pytest.approx(0.1)
+    # Only the last second of readings is kept.
+    assert len(estimator._readings) == 11 # pylint: disable=protected-access;
+
+
+def test_stops_ahead_of_the_target(estimator):
+    """With 0.1/s flowing and a 0.5s lead, 0.05 is in the air."""
+    # One reading either way, for rounding.
+    assert trickle(estimator, 10) == pytest.approx(9.95, abs=0.011)
+    estimator.lead = 0
+    assert trickle(estimator, 10) == pytest.approx(10)
+
+
+def test_never_stops_early(estimator):
+    """However fast the powder flows, the trickle runs to within max_fraction of the target."""
+    estimator.lead = 3
+    assert trickle(estimator, 10, rate=1, start=5) == pytest.approx(9.5)
+
+
+def test_in_flight_follows_pwm(estimator):
+    """The measured flow is scaled by how the PWM has changed over the window."""
+    for count in range(10):
+        estimator.update(int(count * 1e8), count * 0.01, 50, 100)
+    estimator.update(int(10 * 1e8), 0.1, 25, 100)
+    assert estimator.in_flight() == pytest.approx(estimator.rate() * 0.5 * 25 / (25 + 50 * 10) * 11)
+
+
+def test_learns_once_settled(estimator, clock, tmp_path):
+    """The lead moves towards what was observed, only once the scale has been stable for settle_time."""
+    stopped = trickle(estimator, 10)
+    estimator.trickled(True)
+    estimator.settled(stopped + 0.1, False)
+    clock.advance(0.5)
+    estimator.settled(stopped + 0.1, True)
+    assert estimator.charges == 0
+    clock.advance(0.5)
+    estimator.settled(stopped + 0.1, True)
+    # 0.1 in the air at 0.1/s is a lead of 1s, which moves 0.5s by 0.3 of the difference.
+    assert estimator.lead == pytest.approx(0.65)
+    assert estimator.charges == 1
+
+    estimator.settled(stopped + 0.5, True)
+    assert estimator.charges == 1
+    with open(tmp_path / 'cutoff.json', encoding='utf-8') as profiles_file:
+        assert json.load(profiles_file) == {'varget': {'lead': estimator.lead, 'charges': 1}}
+
+
+def test_profiles_are_kept_apart(estimator, clock, tmp_path):
+    path = str(tmp_path / 'cutoff.json')
+    other = cutoff.CutoffEstimator('h4350', path, initial_lead=1.0)
+    for learner in (estimator, other):
+        stopped = trickle(learner, 10)
+        learner.trickled(True)
+        clock.advance(1)
+        learner.settled(stopped + 0.2, True)
+    assert cutoff.CutoffEstimator('varget', path).lead == pytest.approx(0.95)
+    assert cutoff.CutoffEstimator('h4350', path).lead == pytest.approx(1.3)
+    assert cutoff.CutoffEstimator('n140', path).lead == 0.5
+
+
+@pytest.mark.parametrize('completed, weight', [(False, 10.05), (True, None)])
+def test_not_learned(estimator, clock, completed, weight):
+    """Aborted charges, and charges whose pan was taken before they settled, are not learned from."""
+    trickle(estimator, 10)
+    estimator.trickled(completed)
+    estimator.settled(weight, True)
+    clock.advance(1)
+    estimator.settled(10.05, True)
+    assert (estimator.lead, estimator.charges) == (0.5, 0)
+
+
+def test_unreadable_file(tmp_path):
+    path = tmp_path / 'cutoff.json'
+    path.write_text('{', encoding='utf-8')
+    assert cutoff.CutoffEstimator('varget', str(path), initial_lead=0.7).lead == 0.7
+
+
+def test_from_config(config, tmp_path):
+    assert cutoff.from_config(config) is None
+    estimator = cutoff.from_config(
+        config, enabled='true', profile='varget', profiles_file=str(tmp_path / 'cutoff.json'), learn_rate='0.5')
+    assert (estimator.profile, estimator.learn_rate, estimator.lead) == ('varget', 0.5, 0.5)
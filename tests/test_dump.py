@@ -0,0 +1,109 @@
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+"""
+
+import pytest
+
+import dump
+
+
+class Scale:
+    """Plays back (ticks, stable) readings at 10 a second, then repeats the last."""
+
+    resolution = 0.02
+
+    def __init__(self, clock, readings):
+        self.clock = clock
+        self.readings = list(readings)
+        self.ticks, self.is_stable = self.readings.pop(0)
+
+    @property
+    def weight(self):
+        return self.ticks * self.resolution
+
+    def update(self):
+        self.clock.advance(0.1)
+        if self.readings:
+            self.ticks, self.is_stable = self.readings.pop(0)
+        return self.weight
+
+
+class Servo:
+    """Records the servo angles."""
+
+    servo_angle = 120
+
+    def __init__(self):
+        self.angles = []
+
+    def run_servo(self, angle):
+        self.angles.append(angle)
+
+    def set_initial_angle(self):
+        self.angles.append(0)
+
+
+@pytest.fixture(autouse=True)
+def fixture_clock(monkeypatch, clock):
+    monkeypatch.setattr(dump, 'time', clock)
+
+
+def test_dump(clock):
+    """The servo returns once the powder lands, and the dump completes once the scale settles."""
+    scale = Scale(clock, [(0, True), (0, True), (3, False), (500, False), (490, False), (491, True), (491, True)])
+    servo = Servo()
+    result = dump.DumpSequence(start_delay=0).run(scale, servo)
+    assert servo.angles == [120, 0]
+    assert result.jump == 500
+    assert result.settled
+    assert result.pour_time == pytest.approx(0.3)
+    assert result.settle_time == pytest.approx(0.3)
+    assert result.duration == pytest.approx(0.6)
+    assert result.mass == pytest.approx(9.82)
+    assert (result.angle, result.dwell) == (120, 0)
+
+
+def test_start_delay_and_dwell(clock):
+    scale = Scale(clock, [(0, True), (500, True)])
+    servo = Servo()
+    result = dump.DumpSequence(start_delay=1.0).run(scale, servo, angle=90, dwell=0.5)
+    assert servo.angles == [90, 0]
+    assert result.pour_time == pytest.approx(1.6)
+    assert result.settle_time == pytest.approx(0.3)
+    assert (result.angle, result.dwell) == (90, 0.5)
+
+
+def test_empty_measure(clock):
+    """With no powder landing, the servo is returned after pour_timeout."""
+    scale = Scale(clock, [(0, True)])
+    result = dump.DumpSequence(start_delay=0, pour_timeout=1.5).run(scale, Servo())
+    assert result.jump == 0
+    assert result.pour_time == pytest.approx(1.5)
+    assert result.settled
+    assert result.mass == 0
+
+
+def test_never_settles(clock):
+    scale = Scale(clock, [(0, True), (500, False)])
+    result = dump.DumpSequence(start_delay=0, settle_timeout=3.0).run(scale, Servo())
+    assert not result.settled
+    assert result.settle_time == pytest.approx(3.0)
+
+
+def test_pan_removed(clock):
+    """The dump is cut short when the pan is taken, and nothing has landed on it."""
+    scale = Scale(clock, [(0, True), (-100, True)])
+    servo = Servo()
+    result = dump.DumpSequence(start_delay=0).run(scale, servo)
+    assert servo.angles == [120, 0]
+    assert result.duration == pytest.approx(0.2)
+    assert not result.settled
+    assert result.mass == 0
+
+
+def test_from_config(config):
+    sequence = dump.from_config(config)
+    assert (sequence.start_delay, sequence.jump_ticks) == (1.0, 5)
+    config.remove_section('dump')
+    assert dump.from_config(config).start_delay == 1.0
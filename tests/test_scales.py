@@ -0,0 +1,91 @@
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+"""
+
+import logging
+import threading
+import time
+
+import pytest
+
+import scales
+import simulator
+
+
+@pytest.fixture
+def pty_scale():
+    """Serves a virtual A&D scale on a pseudo-terminal."""
+    served = simulator.PtyScale(
+        simulator.VirtualScale('and', simulator.PowderModel(seed=1)), [], baudrate=19200, frame_rate=20)
+    thread = threading.Thread(target=served.run, daemon=True)
+    thread.start()
+    yield served
+    served.close()
+    thread.join()
+
+
+def _connect(config, port):
+    """Connects to the scale on a port, without the profile cache or probing."""
+    config['scale']['auto_detect'] = 'False'
+    return scales.connect(config, port=port)
+
+
+def test_exit_restores_streaming(config, pty_scale):
+    """A scale left idle in poll mode streams again after the trickler exits."""
+    scale = _connect(config, pty_scale.port)
+    scale.set_output_mode(scales.OutputMode.POLL)
+    deadline = time.monotonic() + 2
+    while scale.output_mode is not scales.OutputMode.POLL and time.monotonic() < deadline:
+        scale.update()
+    assert scale.output_mode is scales.OutputMode.POLL
+    assert pty_scale.virtual_scale.mode is simulator.VirtualScale.Mode.COMMAND
+    scale.close()
+
+    deadline = time.monotonic() + 1
+    while pty_scale.virtual_scale.mode is not simulator.VirtualScale.Mode.STREAM and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert pty_scale.virtual_scale.mode is simulator.VirtualScale.Mode.STREAM
+    scale = _connect(config, pty_scale.port)
+    assert scale.output_mode is None
+    scale.close()
+
+
+def test_connect_wakes_a_polled_scale(config, pty_scale):
+    """A scale left in poll mode, such as by a crash, is polled rather than declared silent, then streams again."""
+    pty_scale.virtual_scale.mode = simulator.VirtualScale.Mode.COMMAND
+    scale = _connect(config, pty_scale.port)
+    deadline = time.monotonic() + 2
+    while scale.output_mode is not scales.OutputMode.STREAM and time.monotonic() < deadline:
+        scale.update()
+    assert scale.output_mode is scales.OutputMode.STREAM
+    assert pty_scale.virtual_scale.mode is simulator.VirtualScale.Mode.STREAM
+    scale.close()
+
+
+def test_connect_silent_port(config, pty_scale):
+    """A port which doesn't answer polls either is reported as silent."""
+    pty_scale.virtual_scale.model = 'ussolid'
+    pty_scale.virtual_scale.mode = simulator.VirtualScale.Mode.COMMAND
+    config['scale']['verify_timeout'] = '0.5'
+    with pytest.raises(scales.ScaleNotReady):
+        _connect(config, pty_scale.port)
+
+
+def test_unsupported_unit_change_logs_once(config, caplog):
+    """A scale which can't change units says so once, not on every pass of the control loop."""
+    served = simulator.PtyScale(
+        simulator.VirtualScale('ussolid', simulator.PowderModel(seed=1)), [], baudrate=9600, frame_rate=20)
+    thread = threading.Thread(target=served.run, daemon=True)
+    thread.start()
+    config['scale']['model'] = 'ussolid'
+    config['scale']['baudrate'] = '9600'
+    scale = _connect(config, served.port)
+    with caplog.at_level(logging.INFO):
+        for _ in range(3):
+            assert isinstance(scale.change_unit().exception(), scales.ScaleCommandError)
+    scale.close()
+    served.close()
+    thread.join()
+    assert [x.getMessage() for x in caplog.records].count(
+        'This scale does not support changing units through RS232') == 1
@@ -0,0 +1,73 @@
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+"""
+
+import metrics
+import scheduler
+
+
+def _run(loop_scheduler, clock, busy):
+    """Runs a tick for each of the busy times, in seconds, and returns the start times in seconds."""
+    starts = []
+    ticks = loop_scheduler.ticks()
+    for seconds in busy:
+        starts.append(round(next(ticks) / 1e9 - 1000, 6))
+        clock.advance(seconds)
+    ticks.close()
+    return starts
+
+
+def test_ticks_on_fixed_grid(monkeypatch, clock):
+    """Ticks start on a grid of deadlines, so a late tick doesn't push the later ones back."""
+    monkeypatch.setattr(scheduler, 'time', clock)
+    monkeypatch.setattr(metrics, 'time', clock)
+    loop_scheduler = scheduler.LoopScheduler(10)
+    assert _run(loop_scheduler, clock, [0.01, 0.05, 0.09, 0.02]) == [0.0, 0.1, 0.2, 0.3]
+    assert loop_scheduler.metrics.counters.get('deadline_misses', 0) == 0
+
+
+def test_overrun_skips_ticks(monkeypatch, clock):
+    """A tick which overruns is a deadline miss, and the ticks it overran are skipped to the next deadline."""
+    monkeypatch.setattr(scheduler, 'time', clock)
+    monkeypatch.setattr(metrics, 'time', clock)
+    loop_scheduler = scheduler.LoopScheduler(10)
+    assert _run(loop_scheduler, clock, [0.25, 0.01, 0.01]) == [0.0, 0.3, 0.4]
+    counters = loop_scheduler.metrics.counters
+    assert counters['deadline_misses'] == 1
+    assert counters['skipped_ticks'] == 2
+    # A tick is counted once it's done, and the last one was stopped rather than done.
+    assert counters['ticks'] == 2
+    assert 'deadline misses' in loop_scheduler.summary()
+
+
+def test_rate_zero_runs_back_to_back(monkeypatch, clock):
+    monkeypatch.setattr(scheduler, 'time', clock)
+    monkeypatch.setattr(metrics, 'time', clock)
+    loop_scheduler = scheduler.LoopScheduler(0)
+    assert _run(loop_scheduler, clock, [0.03, 0.2, 0.01]) == [0.0, 0.03, 0.23]
+    assert loop_scheduler.metrics.counters.get('deadline_misses', 0) == 0
+
+
+def test_phase_budgets(monkeypatch, clock):
+    """Phases are timed from the end of the previous one, and counted when over budget."""
+    monkeypatch.setattr(scheduler, 'time', clock)
+    monkeypatch.setattr(metrics, 'time', clock)
+    loop_scheduler = scheduler.LoopScheduler(10, {'read': 0.02, 'compute': 0.005})
+    ticks = loop_scheduler.ticks()
+    next(ticks)
+    clock.advance(0.01)
+    loop_scheduler.phase('read')
+    clock.advance(0.01)
+    loop_scheduler.phase('compute')
+    ticks.close()
+    counters = loop_scheduler.metrics.counters
+    assert 'read_over_budget' not in counters
+    assert counters['compute_over_budget'] == 1
+    assert loop_scheduler.metrics.histograms['compute'].max == 10_000_000
+
+
+def test_from_config(config):
+    loop_scheduler = scheduler.from_config(config)
+    section = config['scheduler'] if config.has_section('scheduler') else {}
+    assert loop_scheduler.period == (int(1e9 / float(section['rate'])) if section.get('rate') else 0)
@@ -0,0 +1,67 @@
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+"""
+
+import decimal
+import os
+import uuid
+
+from multiprocessing import resource_tracker
+
+import pytest
+
+import statebus
+
+
+@pytest.fixture
+def client(config):
+    """Returns a client of a state bus of its own, removed afterwards."""
+    name = f'ot_test_{uuid.uuid4().hex[:8]}'
+    bus_client = statebus.StateBusClient(name, config['memcache_vars'])
+    yield bus_client
+    shm = bus_client.bus._shm # pylint: disable=protected-access;
+    # StateBus leaves the segment in place, so hand it back to the resource tracker to remove.
+    resource_tracker.register(shm._name, 'shared_memory') # pylint: disable=protected-access;
+    shm.unlink()
+    bus_client.close()
+    os.unlink(os.path.join('/dev/shm', f'{name}.lock'))
+
+
+@pytest.mark.parametrize('value, expected', [
+    (decimal.Decimal('12.34'), decimal.Decimal('12.34')),
+    (decimal.Decimal('-0.02'), decimal.Decimal('-0.02')),
+    (0.1, decimal.Decimal('0.1')),
+    (42, decimal.Decimal(42)),
+    (None, None),
+])
+def test_decimal_round_trip(value, expected):
+    """Decimals, and numbers which convert to them, are stored exactly."""
+    field = statebus.Field('decimal')
+    assert field.decode(field.encode(value)) == expected
+
+
+@pytest.mark.parametrize('value', [
+    decimal.Decimal('NaN'),
+    decimal.Decimal('Infinity'),
+    float('nan'),
+    decimal.Decimal('1' * 20),
+    decimal.Decimal('1E+200'),
+])
+def test_decimal_out_of_range(value):
+    """Values a decimal slot can't hold raise ValueError rather than struct.error."""
+    with pytest.raises(ValueError):
+        statebus.Field('decimal').encode(value)
+
+
+def test_read_recovers_from_dead_writer(client, config):
+    """A slot left odd by a writer which died mid-write is cleared rather than read forever."""
+    key = config['memcache_vars']['SCALE_WEIGHT']
+    client.set(key, decimal.Decimal('1.5'))
+    offset, _ = client.bus.slots[key]
+    sequence = statebus.SEQUENCE.unpack_from(client.bus._buf, offset)[0] # pylint: disable=protected-access;
+    statebus.SEQUENCE.pack_into(client.bus._buf, offset, sequence + 1) # pylint: disable=protected-access;
+
+    assert client.get(key) is None
+    client.set(key, decimal.Decimal('2.5'))
+    assert client.get(key) == decimal.Decimal('2.5')
@@ -0,0 +1,107 @@
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+"""
+
+import io
+import types
+
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+import telemetry # pylint: disable=wrong-import-position;
+
+
+PID = types.SimpleNamespace(PTerm=1.0, Ki=0.5, ITerm=4.0, Kd=2.0, DTerm=0.25, output=3.5)
+
+
+def _record(recorder, charges, ticks):
+    """Records ticks records for each of a number of charges, with the tick number as the weight."""
+    for _ in range(charges):
+        recorder.start_charge()
+        for tick in range(ticks):
+            recorder.record(tick * 100_000_000, tick, 1000, 0.02, PID, 0.5, 0.25, 1 + tick % 2)
+
+
+def test_readback(tmp_path):
+    path = str(tmp_path / 'telemetry.bin')
+    recorder = telemetry.Recorder(path, 16)
+    _record(recorder, 2, 3)
+    reader = telemetry.Reader(path)
+    assert reader.count == 6
+    assert reader.charges() == [1, 2]
+    records = reader.records(2)
+    assert records['weight_ticks'].tolist() == [0, 1, 2]
+    assert records['phase'].tolist() == [1, 2, 1]
+    assert records['i'][0] == PID.Ki * PID.ITerm
+    assert records['d'][0] == PID.Kd * PID.DTerm
+    assert reader.column('motor2', 1).tolist() == [0.25] * 3
+    reader.close()
+    recorder.close()
+
+
+def test_ring_wraps_in_order(tmp_path):
+    """Once the ring is full, the oldest records are overwritten and the rest read back oldest first."""
+    path = str(tmp_path / 'telemetry.bin')
+    recorder = telemetry.Recorder(path, 8)
+    _record(recorder, 4, 3)
+    reader = telemetry.Reader(path)
+    assert reader.count == 12
+    records = reader.records()
+    assert len(records) == 8
+    assert records['charge'].tolist() == [2, 2, 3, 3, 3, 4, 4, 4]
+    assert records['weight_ticks'].tolist() == [1, 2, 0, 1, 2, 0, 1, 2]
+    reader.close()
+    recorder.close()
+
+
+def test_reopen_continues_numbering(tmp_path):
+    path = str(tmp_path / 'telemetry.bin')
+    recorder = telemetry.Recorder(path, 8)
+    _record(recorder, 2, 1)
+    recorder.close()
+    recorder = telemetry.Recorder(path, 8)
+    assert (recorder.count, recorder.charge) == (2, 2)
+    recorder.close()
+    # A different capacity starts the file over.
+    recorder = telemetry.Recorder(path, 4)
+    assert (recorder.count, recorder.charge) == (0, 0)
+    recorder.close()
+
+
+def test_reader_rejects_other_versions(tmp_path):
+    path = tmp_path / 'telemetry.bin'
+    path.write_bytes(b'OTTM\x01\x00' + bytes(58))
+    with pytest.raises(telemetry.TelemetryError):
+        telemetry.Reader(str(path))
+
+
+def test_export_uses_each_charge_offset(tmp_path):
+    """Each charge's records are exported with the wall clock offset of that charge."""
+    path = str(tmp_path / 'telemetry.bin')
+    recorder = telemetry.Recorder(path, 8)
+    recorder.start_charge()
+    recorder.wall_offset = 1_000_000_000_000_000_000
+    recorder.record(500_000_000, 900, 1000, 0.02, PID, 0.5, 0.0, 1)
+    recorder.start_charge()
+    recorder.wall_offset = 1_000_000_010_000_000_000
+    recorder.record(600_000_000, 950, 1000, 0.02, PID, 0.25, 0.0, 2)
+    reader = telemetry.Reader(path)
+    output = io.StringIO()
+    assert telemetry.export_pidtuner(reader, output) == 2
+    assert output.getvalue().splitlines() == [
+        'timestamp, input (motor %), output (weight %)',
+        '1000000000.500000, 50.0000, 90.0000',
+        '1000000010.600000, 25.0000, 95.0000',
+    ]
+    reader.close()
+    recorder.close()
+
+
+def test_from_config(config, tmp_path):
+    assert telemetry.from_config(config) is None
+    config['telemetry']['file'] = str(tmp_path / 'telemetry.bin')
+    recorder = telemetry.from_config(config, enabled=True)
+    assert recorder.capacity == 65536
+    recorder.close()
@@ -0,0 +1,55 @@
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+"""
+
+import time
+
+import pytest
+
+import scheduler
+import twin
+
+
+def test_charges_reach_the_target(config):
+    """Charges on the twin are trickled to the target within a couple of resolutions, and don't time out."""
+    trickler = twin.Twin(config, twin.PROFILES['ball'], seed=1)
+    results = [trickler.run_charge(24.5) for _ in range(3)]
+    for result in results:
+        assert not result.timed_out
+        assert 0 <= result.overshoot <= 0.1
+        assert result.trickle_time < result.cycle_time
+    summary = twin.summarize(results)
+    assert summary['charges'] == 3
+    assert summary['timeouts'] == 0
+
+
+def test_seeded_runs_repeat(config):
+    """The same seed runs the same charges, since time is virtual."""
+    first = twin.Twin(config, twin.PROFILES['flake'], seed=7).run_charge(10)
+    second = twin.Twin(config, twin.PROFILES['flake'], seed=7).run_charge(10)
+    assert first == second
+
+
+def test_clock_is_restored(config):
+    """The virtual clock only stands in for the time module while a charge runs."""
+    trickler = twin.Twin(config, seed=1)
+    trickler.run_charge(10)
+    assert scheduler.time is time
+    assert trickler.clock.monotonic() > 1000
+
+
+def test_compare_finds_regressions():
+    base = {
+        'charges': 10, 'charges_per_hour': 300.0, 'overshoot_mean': 0.02, 'overshoot_p99': 0.04,
+        'time_to_target_mean': 6.0, 'time_to_target_p99': 8.0, 'timeouts': 0}
+    assert twin.compare({'ball 10': base}, {'ball 10': base}) == []
+    worse = dict(base, charges_per_hour=250.0, overshoot_p99=0.1, timeouts=1)
+    regressions = twin.compare({'ball 10': base}, {'ball 10': worse, 'flake 10': worse})
+    assert len(regressions) == 3
+    assert all(x.startswith('ball 10') for x in regressions)
+
+
+@pytest.mark.parametrize('percent, expected', [(0, 1), (50, 3), (99, 5), (100, 5)])
+def test_percentile(percent, expected):
+    assert twin._percentile([5, 1, 4, 2, 3], percent) == expected # pylint: disable=protected-access;
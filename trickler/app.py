@@ -54,7 +54,7 @@ if args.auto_mode is not None:
 logging.info('Auto Mode is set as %s', auto_mode)
 
 app = Flask(__name__)
-memcache_client = helpers.get_mc_client()
+memcache_client = helpers.get_state_client(config)
 
 def get_memcache_value(key, default):
     value = memcache_client.get(key)
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+
+Offline PID autotuner.
+
+Identifies a model of the powder flow (flow per PWM of each motor, stall PWM, dead time and scale lag) from charges
+recorded by telemetry.py, then simulates thousands of charges at once for a grid of Kp/Ki/Kd, with the control law of
+the [PID] controller (PID.PID, or controller.Controller with its weights, filter, anti-windup and gain schedule)
+vectorized over NumPy arrays and the grid spread across a process pool. Prints the Pareto
+front of time to target against overshoot and writes the chosen gains as a config snippet:
+
+    python3 autotune.py /etc/opentrickler_config.ini --telemetry /var/tmp/opentrickler_telemetry.bin -o pid.ini
+
+Weights are in the unit the charges were recorded in.
+"""
+
+import collections
+import concurrent.futures
+import logging
+import os
+
+import numpy # pylint: disable=import-error;
+
+import cascade
+import controller
+import scales
+import telemetry
+
+
+# Model of the powder flow. gains is the flow in weight units/second of each motor at full PWM, above stall.
+Plant = collections.namedtuple('Plant', 'gains stall dead_time lag noise')
+# How the simulated charges are run, mirroring trickler_loop() and its config. law is the [PID] controller, and
+# v2 holds the options of controller.Controller as (setpoint_weight, derivative_weight, derivative_filter,
+# tracking_time, schedule), None for ivpid.
+Settings = collections.namedtuple(
+    'Settings',
+    'dt target start resolution min_pwm max_pwm windup fine_remainder max_time settle_time flow_noise law v2',
+    defaults=('ivpid', None))
+# Outcome of a set of gains over all of its simulated charges.
+Result = collections.namedtuple('Result', 'kp ki kd time overshoot success')
+
+# Candidate plant parameters tried by identify().
+STALL_CANDIDATES = (0.0, 0.1, 0.2, 0.25, 0.3, 0.4)
+LAG_CANDIDATES = (0.05, 0.1, 0.15, 0.2, 0.3, 0.4, 0.6, 0.8, 1.2)
+MAX_DEAD_TIME = 1.5
+
+
+def effective_pwm(pwm, stall):
+    """Returns the share of full flow a motor gives at a PWM (0 - 1)."""
+    return numpy.clip((pwm - stall) / (1 - stall), 0, None)
+
+
+def resample(records, dt):
+    """Returns the weight, motor1 and motor2 of a charge's records on a uniform grid of dt seconds."""
+    seconds = (records['timestamp'] - records['timestamp'][0]) / 1e9
+    grid = numpy.arange(0, seconds[-1], dt)
+    weight = records['weight_ticks'] * records['resolution'].astype(float)
+    # Motors hold their speed until the next tick.
+    held = numpy.searchsorted(seconds, grid, 'right') - 1
+    return numpy.interp(grid, seconds, weight), records['motor1'][held], records['motor2'][held]
+
+
+def lag_filter(values, alphas):
+    """Returns values through first-order lag filters, one per alpha, as an array of shape (alphas, ...values)."""
+    filtered = numpy.empty((len(alphas),) + values.shape)
+    alphas = numpy.asarray(alphas).reshape((-1,) + (1,) * (values.ndim - 1))
+    state = numpy.broadcast_to(values[..., 0], filtered.shape[:-1]).copy()
+    for n in range(values.shape[-1]):
+        state += (values[..., n] - state) * alphas
+        filtered[..., n] = state
+    return filtered
+
+
+def identify(charges, dt):
+    """Returns the Plant which best explains the (weight, motor1, motor2) arrays of the charges.
+
+    The weight is linear in the flow gains for a given stall, dead time and lag, so those are searched on a grid and
+    the gains fit by least squares, with an offset for each charge's starting weight. While both motors always run
+    together their flows can't be told apart, and the total is split evenly between them.
+    """
+    lags = [x for x in LAG_CANDIDATES if x >= dt / 2]
+    alphas = [min(dt / x, 1.0) for x in lags]
+    weights = numpy.concatenate([x[0] for x in charges])
+    offsets = numpy.zeros((len(weights), len(charges)))
+    start = 0
+    for index, (weight, _, _) in enumerate(charges):
+        offsets[start:start + len(weight), index] = 1
+        start += len(weight)
+    best = None
+    for stall in STALL_CANDIDATES:
+        for delay in range(int(MAX_DEAD_TIME / dt) + 1):
+            # Powder poured so far by each motor, as it lands after the dead time: shape (lags, motors, samples).
+            columns = []
+            for _, motor1, motor2 in charges:
+                poured = numpy.cumsum(effective_pwm(numpy.stack((motor1, motor2)), stall), axis=1) * dt
+                landed = numpy.concatenate((numpy.zeros((2, delay)), poured[:, :poured.shape[1] - delay]), axis=1)
+                columns.append(lag_filter(landed, alphas))
+            regressors = numpy.concatenate(columns, axis=2)
+            for lag, regressor in zip(lags, regressors):
+                design = numpy.hstack((regressor.T, offsets))
+                solution = numpy.linalg.lstsq(design, weights, rcond=None)[0]
+                solution[:2] = solution[:2].clip(0)
+                residual = weights - design @ solution
+                error = float(residual @ residual)
+                if best is None or error < best[0]:
+                    best = (error, Plant(tuple(solution[:2].tolist()), stall, delay * dt, lag, float(residual.std())))
+    return best[1]
+
+
+def plant_from_config(config, unit):
+    """Returns the Plant of the [simulator] section of the config, for tuning without recorded charges."""
+    sim_config = config['simulator'] if config.has_section('simulator') else {}
+    factor = scales.GRAINS_PER_GRAM if unit == 'GN' else 1.0
+    gains = tuple(float(x) * factor for x in sim_config.get('flow_rates', '0.02, 0.06').split(','))
+    return Plant(
+        gains,
+        float(sim_config.get('stall_pwm', 0.25)),
+        float(sim_config.get('fall_time', 0.35)),
+        float(sim_config.get('scale_lag', 0.25)),
+        0.0)
+
+
+def _schedule(schedule, error, base, integral_gain, iterm):
+    """Returns the (Kp, Ki, Kd) arrays of each charge's band of the gain schedule, the integral gains and the integral,
+    rescaled as controller.Controller rescales them."""
+    kp, ki, kd = (x.copy() for x in base)
+    magnitude = numpy.abs(error)
+    # Widest band first, so the narrowest band holding the error is applied last.
+    for band, band_kp, band_ki, band_kd in reversed(schedule):
+        within = magnitude <= band
+        kp[within], ki[within], kd[within] = band_kp, band_ki, band_kd
+    rescale = (ki != 0) & (ki != integral_gain)
+    held = rescale & (integral_gain != 0)
+    iterm = numpy.where(held, iterm * integral_gain / numpy.where(held, ki, 1), iterm)
+    return kp, ki, kd, numpy.where(rescale, ki, integral_gain), iterm
+
+
+def simulate(plant, settings, gains, runs, seed):
+    """Simulates runs charges for each row of gains (Kp, Ki, Kd), all at once.
+
+    Returns arrays of the time to reach the target (inf if it wasn't reached) and the final settled weight over the
+    target, each of shape (len(gains), runs).
+    """
+    rng = numpy.random.default_rng(seed)
+    count = len(gains) * runs
+    kp, ki, kd = (numpy.repeat(gains[:, x], runs) for x in range(3))
+    dt = settings.dt
+    target = settings.target
+    delay = int(round(plant.dead_time / dt))
+    alpha = min(dt / plant.lag, 1.0) if plant.lag else 1.0
+    flow_gains = numpy.asarray(plant.gains) * dt
+
+    landed = numpy.full(count, settings.start * target)
+    reading = landed.copy()
+    # Powder in the air, by the step it was poured on.
+    pipe = numpy.zeros((delay + 1, count))
+    iterm = numpy.zeros(count)
+    # PID.clear() leaves last_error at 0, so the first tick has a derivative kick, as on the trickler.
+    last_error = numpy.zeros(count)
+    if settings.law == 'v2':
+        setpoint_weight, derivative_weight, derivative_filter, tracking_time, schedule = settings.v2
+        base = (kp, ki, kd)
+        integral_gain = ki.copy()
+        dterm = numpy.zeros(count)
+        # controller.Controller has no derivative until its second reading.
+        last_input = None
+    active = numpy.ones(count, bool)
+    done_at = numpy.full(count, numpy.inf)
+
+    steps = int(settings.max_time / dt)
+    for step in range(steps + int(settings.settle_time / dt)):
+        measured = numpy.round(reading / settings.resolution) * settings.resolution
+        remainder = target - measured
+        if step < steps:
+            finished = active & (remainder <= 0)
+            done_at[finished] = step * dt
+            active &= ~finished
+        else:
+            active[:] = False
+        feedback = measured / target * 100
+        error = 100.0 - feedback
+        if settings.law == 'v2':
+            if schedule:
+                kp, ki, kd, integral_gain, iterm = _schedule(schedule, error, base, integral_gain, iterm)
+            derivative_input = derivative_weight * 100.0 - feedback
+            if last_input is not None:
+                rate = (derivative_input - last_input) / dt
+                dterm += (rate - dterm) * dt / (derivative_filter + dt)
+            last_input = derivative_input
+            output = kp * (setpoint_weight * 100.0 - feedback) + integral_gain * iterm + kd * dterm
+            # Back-calculation against the motors' envelope, only where the integral accumulates.
+            limited = numpy.clip(output, settings.min_pwm, settings.max_pwm)
+            tracking = (limited - output) / numpy.where(ki != 0, ki * tracking_time, 1)
+            iterm = numpy.where(ki != 0, iterm + (error + tracking) * dt, iterm)
+        else:
+            iterm = numpy.clip(iterm + error * dt, -settings.windup, settings.windup)
+            output = kp * error + ki * iterm + kd * (error - last_error) / dt
+            last_error = error
+        pwm = numpy.clip(numpy.trunc(output), settings.min_pwm, settings.max_pwm) / 100
+        motor1 = numpy.where(active, pwm, 0.0)
+        motor2 = numpy.where(active & (remainder > settings.fine_remainder), pwm, 0.0)
+        poured = flow_gains[0] * effective_pwm(motor1, plant.stall) + flow_gains[1] * effective_pwm(motor2, plant.stall)
+        if settings.flow_noise:
+            poured *= numpy.clip(rng.normal(1.0, settings.flow_noise, count), 0, None)
+        pipe[step % (delay + 1)] = poured
+        landed += pipe[(step + 1) % (delay + 1)]
+        reading += (landed - reading) * alpha
+    final = numpy.round(reading / settings.resolution) * settings.resolution
+    return done_at.reshape(len(gains), runs), (final - target).reshape(len(gains), runs)
+
+
+def _evaluate(args):
+    """Process pool worker, returning a Result for each row of gains."""
+    plant, settings, gains, runs, seed = args
+    done_at, overshoot = simulate(plant, settings, gains, runs, seed)
+    success = numpy.isfinite(done_at).mean(axis=1)
+    time = numpy.where(numpy.isfinite(done_at), done_at, settings.max_time).mean(axis=1)
+    worst = numpy.percentile(overshoot, 90, axis=1)
+    return [Result(*row) for row in zip(*gains.T.tolist(), time.tolist(), worst.tolist(), success.tolist())]
+
+
+def evaluate(plant, settings, gains, runs, workers=None, seed=0):
+    """Returns a Result for each row of gains, simulating runs charges each, in a pool of worker processes."""
+    workers = workers or os.cpu_count() or 1
+    chunks = numpy.array_split(gains, workers * 4)
+    tasks = [(plant, settings, chunk, runs, seed + index) for index, chunk in enumerate(chunks) if len(chunk)]
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        return [result for results in executor.map(_evaluate, tasks) for result in results]
+
+
+def pareto_front(results):
+    """Returns the results which reached the target every time and have no other with both less time and overshoot."""
+    front = []
+    for result in sorted((x for x in results if x.success == 1), key=lambda x: (x.time, x.overshoot)):
+        if not front or result.overshoot < front[-1].overshoot:
+            front.append(result)
+    return front
+
+
+def choose(front, max_overshoot):
+    """Returns the fastest result of the front within max_overshoot, or the one with the least overshoot."""
+    within = [x for x in front if x.overshoot <= max_overshoot]
+    return within[0] if within else front[-1]
+
+
+def gain_grid(config, points, spread=4.0):
+    """Returns rows of (Kp, Ki, Kd) spaced logarithmically around the gains in the config."""
+    axes = []
+    for name in ('Kp', 'Ki', 'Kd'):
+        value = float(config['PID'][name])
+        if value > 0:
+            axes.append(numpy.geomspace(value / spread, value * spread, points))
+        else:
+            axes.append(numpy.concatenate(([0.0], numpy.geomspace(0.01, 10, points - 1))))
+    return numpy.stack(numpy.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+
+
+def config_snippet(result, unit, source):
+    """Returns the [PID] section for the chosen gains."""
+    return (
+        f'# Autotuned from {source}: {result.time:.1f}s to target, 90th percentile overshoot '
+        f'{result.overshoot:.3f} {unit}.\n'
+        '[PID]\n'
+        f'Kp = {result.kp:.4g}\n'
+        f'Ki = {result.ki:.4g}\n'
+        f'Kd = {result.kd:.4g}\n')
+
+
+if __name__ == '__main__':
+    import argparse
+    import configparser
+
+    import helpers
+
+    parser = argparse.ArgumentParser(description='Tune the OpenTrickler PID gains by simulation.')
+    parser.add_argument('config_file')
+    parser.add_argument('--telemetry', help='Telemetry file to identify the powder flow from.')
+    parser.add_argument('--charges', help='Comma separated charge numbers to use, default all of them.')
+    parser.add_argument('--target', type=float, help='Target weight, default the target of the recorded charges.')
+    parser.add_argument('--unit', default='GN', help='Weight unit, the unit the charges were recorded in.')
+    parser.add_argument('--resolution', type=float, default=0.02, help='Scale resolution, without telemetry.')
+    parser.add_argument('--start', type=float, help='Weight trickling starts from, as a fraction of the target.')
+    parser.add_argument('--grid', type=int, default=8, help='Values of each gain to try.')
+    parser.add_argument('--runs', type=int, default=32, help='Charges simulated for each set of gains.')
+    parser.add_argument('--flow_noise', type=float, default=0.3, help='Relative noise on the powder flow.')
+    parser.add_argument('--max_time', type=float, default=60, help='Seconds a charge may take.')
+    parser.add_argument('--max_overshoot', type=float, help='Overshoot allowed, default one scale resolution.')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help='File to write the [PID] config snippet to, default stdout.')
+    args = parser.parse_args()
+
+    helpers.setup_logging(logging.INFO)
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read(args.config_file)
+    rate = float(config['scheduler'].get('rate', 10)) if config.has_section('scheduler') else 0
+
+    if args.telemetry:
+        reader = telemetry.Reader(args.telemetry)
+        numbers = [int(x) for x in args.charges.split(',')] if args.charges else reader.charges()
+        recorded = [reader.records(x) for x in numbers]
+        recorded = [x for x in recorded if len(x) > 2]
+        if not recorded:
+            parser.error(f'No charges with enough records in {args.telemetry}.')
+        if rate:
+            dt = 1 / rate
+        else:
+            dt = float(numpy.median(numpy.concatenate([numpy.diff(x['timestamp']) for x in recorded]))) / 1e9
+        resampled = [resample(x, dt) for x in recorded]
+        plant = identify(resampled, dt)
+        source = f'{len(recorded)} charges in {args.telemetry}'
+        resolution = float(recorded[-1]['resolution'][-1])
+        target = args.target or float(numpy.median([x['target_ticks'][0] * x['resolution'][0] for x in recorded]))
+        start = args.start or float(numpy.median([x[0][0] for x in resampled]) / target)
+    else:
+        dt = 1 / (rate or 10)
+        plant = plant_from_config(config, args.unit)
+        source = f'the [simulator] model in {args.config_file}'
+        resolution = args.resolution
+        target = args.target or 30.0
+        start = args.start or 0.9
+    logging.info(
+        'Plant: flow at full PWM %s /s, stall PWM %.2f, dead time %.2fs, scale lag %.2fs, fit error %.3f',
+        ', '.join(f'{x:.3f}' for x in plant.gains), plant.stall, plant.dead_time, plant.lag, plant.noise)
+
+    settings = Settings(
+        dt=dt,
+        target=target,
+        start=start,
+        resolution=resolution,
+        min_pwm=float(config['motor1']['trickler_min_pwm']),
+        max_pwm=float(config['motor1']['trickler_max_pwm']),
+        # The default of PID.PID, and where motor 2 of the cascade hands off to motor 1.
+        windup=20.0,
+        fine_remainder=cascade.Threshold.parse(config['motor2'].get('handoff', '5')).weight(target, resolution),
+        max_time=args.max_time,
+        settle_time=max(5 * plant.lag + 2 * plant.dead_time, 2.0),
+        flow_noise=args.flow_noise,
+        law=config['PID'].get('controller', 'ivpid'))
+    if settings.law == 'v2':
+        v2 = controller.from_config(config)
+        settings = settings._replace(v2=(
+            v2.setpoint_weight, v2.derivative_weight, v2.derivative_filter, v2.tracking_time, v2.schedule))
+    logging.info('Tuning the gains of the %s controller.', settings.law)
+    gains = gain_grid(config, args.grid)
+    logging.info('Simulating %d charges of %s for %d sets of gains...', len(gains) * args.runs, target, len(gains))
+    current = numpy.array([[float(config['PID'][x]) for x in ('Kp', 'Ki', 'Kd')]])
+    baseline = evaluate(plant, settings, current, args.runs, 1, args.seed)[0]
+    results = evaluate(plant, settings, gains, args.runs, args.workers, args.seed)
+    front = pareto_front(results)
+    if not front:
+        parser.error(f'No gains reached the target every time within {args.max_time}s.')
+
+    print(f'{"Kp":>9} {"Ki":>9} {"Kd":>9} {"time (s)":>9} {"overshoot":>10}')
+    for row in front:
+        print(f'{row.kp:9.4g} {row.ki:9.4g} {row.kd:9.4g} {row.time:9.2f} {row.overshoot:10.3f}')
+    print(
+        f'Current gains: {baseline.time:.2f}s, overshoot {baseline.overshoot:.3f}, '
+        f'reached the target {baseline.success:.0%} of the time')
+    chosen = choose(front, resolution if args.max_overshoot is None else args.max_overshoot)
+    snippet = config_snippet(chosen, args.unit, source)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as snippet_file:
+            snippet_file.write(snippet)
+        print(f'Wrote {args.output}')
+    else:
+        print(snippet, end='')
@@ -403,8 +403,8 @@ if __name__ == '__main__':
         LOG_LEVEL = logging.DEBUG
     helpers.setup_logging(LOG_LEVEL)
 
-    # Setup memcache.
-    memcache_client = helpers.get_mc_client()
+    # Setup memcache, or the shared-memory state bus if configured.
+    memcache_client = helpers.get_state_client(config)
 
     # Run the main bluetooth control loop.
     run(config, memcache_client, args)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+
+Calibration of the powder measure dump, learned for each powder profile from the weights the dumps land.
+
+Every dump is a sample of the mass it put on the pan for the servo angle and the dwell, the seconds the servo is held
+open after the powder lands. The mass is fitted as a plane in angle and dwell by least squares, and each charge
+dumps with the command whose predicted mass, plus a few standard deviations of the fit's error, lands closest under the
+target. Commands are only chosen within one step of those already tried, so the calibration explores a step at a
+time. Until a profile has enough samples, the measure dumps at the configured angle when less than half of the charge
+is on the pan, as it always has. Samples are kept in a JSON file, alongside those of the other profiles.
+"""
+
+import collections
+import json
+import logging
+import os
+import threading
+
+import scales
+
+
+# The fewest samples a fit is made from.
+MIN_FIT_SAMPLES = 3
+# Stations in one process share the samples file, so they take turns to update it.
+_SAVE_LOCK = threading.Lock()
+
+# A dump to make. predicted is the mass expected in grams, None before the profile is calibrated.
+DumpCommand = collections.namedtuple('DumpCommand', 'angle dwell predicted')
+# Least squares plane of the dump mass in grams: mass + angle_slope * (angle - angle) + dwell_slope * (dwell - dwell).
+Fit = collections.namedtuple('Fit', 'angle dwell mass angle_slope dwell_slope sigma')
+
+
+def to_grams(weight, unit):
+    """Returns a weight in a scales.Units unit in grams."""
+    return float(weight) / scales.GRAINS_PER_GRAM if unit.name == 'GRAINS' else float(weight)
+
+
+def fit_samples(samples, min_sigma=0.0):
+    """Returns the Fit of (angle, dwell, grams) samples, or None if there are too few."""
+    count = len(samples)
+    if count < MIN_FIT_SAMPLES:
+        return None
+    mean_a = sum(x[0] for x in samples) / count
+    mean_d = sum(x[1] for x in samples) / count
+    mean_m = sum(x[2] for x in samples) / count
+    saa = sdd = sad = sam = sdm = 0.0
+    for angle, dwell, mass in samples:
+        a, d, m = angle - mean_a, dwell - mean_d, mass - mean_m
+        saa += a * a
+        sdd += d * d
+        sad += a * d
+        sam += a * m
+        sdm += d * m
+    # A touch of ridge keeps the slope of a variable which hasn't been varied at zero, rather than undefined.
+    ridge = 1e-9 * count
+    saa += ridge
+    sdd += ridge
+    determinant = saa * sdd - sad * sad
+    angle_slope = (sam * sdd - sdm * sad) / determinant
+    dwell_slope = (sdm * saa - sam * sad) / determinant
+    error = sum((x[2] - mean_m - angle_slope * (x[0] - mean_a) - dwell_slope * (x[1] - mean_d)) ** 2 for x in samples)
+    sigma = (error / max(count - 3, 1)) ** 0.5
+    return Fit(mean_a, mean_d, mean_m, angle_slope, dwell_slope, max(sigma, min_sigma))
+
+
+class DumpCalibration: # pylint: disable=too-many-instance-attributes;
+    """Learned dump mass of the powder measure for one powder profile."""
+
+    def __init__(self, profile='default', path=None, default_angle=92.0, **kwargs):
+        """Constructor. path is the JSON file the samples are kept in, None to not keep them."""
+        self.profile = profile
+        self.path = path
+        self.default_angle = float(default_angle)
+        min_angle = float(kwargs.get('min_angle', 60))
+        max_angle = float(kwargs.get('max_angle', 120))
+        self.angle_step = float(kwargs.get('angle_step', 4))
+        self.angles = [min_angle + self.angle_step * x for x in range(int((max_angle - min_angle) / self.angle_step) + 1)]
+        self.dwells = sorted(float(x) for x in str(kwargs.get('dwells', '0, 0.25, 0.5')).split(','))
+        # Samples needed before commands are chosen from the fit, and the most kept, dropping the oldest.
+        self.min_samples = int(kwargs.get('min_samples', 5))
+        self.max_samples = int(kwargs.get('max_samples', 100))
+        # Standard deviations of the fit's error the prediction must leave below the limit.
+        self.safety = float(kwargs.get('safety', 3.0))
+        # Fraction of the target to leave for trickling at the least.
+        self.margin = float(kwargs.get('margin', 0.02))
+        # Smallest standard deviation the fit is trusted to, in grams.
+        self.min_sigma = float(kwargs.get('min_sigma', 0.005))
+        self.samples = [tuple(x) for x in self._load().get(profile, [])][-self.max_samples:]
+        self._fit = fit_samples(self.samples, self.min_sigma)
+
+    def _load(self):
+        """Returns the samples of every profile in the file."""
+        if not self.path:
+            return {}
+        try:
+            with open(self.path, encoding='utf-8') as samples_file:
+                return json.load(samples_file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            logging.exception('Could not read dump calibration from %s, starting over.', self.path)
+            return {}
+
+    def _save(self):
+        """Write this profile's samples to the file, keeping the other profiles."""
+        if not self.path:
+            return
+        with _SAVE_LOCK:
+            profiles = self._load()
+            profiles[self.profile] = self.samples
+            temporary = self.path + '.tmp'
+            try:
+                with open(temporary, 'w', encoding='utf-8') as samples_file:
+                    json.dump(profiles, samples_file)
+                os.replace(temporary, self.path)
+            except OSError:
+                logging.exception('Could not save dump calibration to %s.', self.path)
+
+    def predict(self, angle, dwell):
+        """Returns the predicted dump mass in grams, or None before there are enough samples."""
+        fit = self._fit
+        if fit is None:
+            return None
+        return fit.mass + fit.angle_slope * (angle - fit.angle) + fit.dwell_slope * (dwell - fit.dwell)
+
+    def choose(self, target, weight, unit):
+        """Returns the DumpCommand which lands closest under the target, given the weight on the pan, or None if no
+        dump is safe."""
+        if len(self.samples) < self.min_samples or self._fit is None:
+            if (target - weight) / target < 0.5:
+                return None
+            return DumpCommand(self.default_angle, self.dwells[0], None)
+        limit = to_grams(target - weight, unit) - to_grams(target, unit) * self.margin
+        tried_angles = [x[0] for x in self.samples]
+        low = min(tried_angles) - self.angle_step
+        high = max(tried_angles) + self.angle_step
+        max_dwell = max(x[1] for x in self.samples)
+        dwells = self.dwells[:len([x for x in self.dwells if x <= max_dwell]) + 1]
+        best = None
+        for angle in self.angles:
+            if not low <= angle <= high:
+                continue
+            for dwell in dwells:
+                predicted = self.predict(angle, dwell)
+                if predicted + self.safety * self._fit.sigma <= limit and (best is None or predicted > best.predicted):
+                    best = DumpCommand(angle, dwell, predicted)
+        logging.debug('Dump command for %s of %s %s: %r', target - weight, target, unit, best)
+        return best
+
+    def learn(self, dump_result, unit):
+        """Add the mass of a dump.DumpResult as a sample, if the scale settled after it."""
+        if not dump_result.settled or dump_result.mass <= 0:
+            return
+        grams = to_grams(dump_result.mass, unit)
+        predicted = self.predict(dump_result.angle, dump_result.dwell)
+        self.samples.append((dump_result.angle, dump_result.dwell, grams))
+        del self.samples[:-self.max_samples]
+        self._fit = fit_samples(self.samples, self.min_sigma)
+        logging.info(
+            'Powder %s: dump at %s degrees for %ss landed %.4fg, predicted %s, fit error %s',
+            self.profile, dump_result.angle, dump_result.dwell, grams,
+            'none' if predicted is None else f'{predicted:.4f}g', self._fit and f'{self._fit.sigma:.4f}g')
+        self._save()
+
+
+def from_config(config, **overrides):
+    """Returns a DumpCalibration for the [calibration] section of the config, or None if it's disabled. Keyword
+    arguments override options of the section."""
+    calibration_config = dict(config['calibration']) if config.has_section('calibration') else {}
+    calibration_config.update(overrides)
+    if str(calibration_config.pop('enabled', False)).lower() not in ('1', 'true', 'yes', 'on'):
+        return None
+    # The powder is the one the cutoff learns for, unless the calibration names its own.
+    cutoff_config = config['cutoff'] if config.has_section('cutoff') else {}
+    return DumpCalibration(
+        calibration_config.pop('profile', cutoff_config.get('profile', 'default')),
+        calibration_config.pop('samples_file', '/var/tmp/opentrickler_calibration.json'),
+        config['servo']['servo_angle'],
+        **calibration_config)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+
+Cascade of trickler motors, from a high-flow bulk trickler down to the fine trickler which finishes the charge.
+
+Each stage is a trickler motor with its own PWM envelope, a handoff threshold and optionally its own PID gains. Every
+stage runs until the remainder falls to its handoff, so the charge is handed from stage to stage, and the last stage
+runs to the target. A stage which has handed off takes over again if the remainder rises above its handoff plus its
+hysteresis, such as when the reading dips. Thresholds are in ticks of the scale resolution, or percent of the target,
+spelled out since configparser takes % for interpolation:
+
+    [cascade]
+    stages = 3, 2, 1
+
+    [motor3]
+    trickler_pin = 13
+    trickler_min_pwm = 40
+    trickler_max_pwm = 100
+    handoff = 15 percent
+    Kp = 20
+"""
+
+import collections
+import logging
+import controller
+
+
+class Threshold(collections.namedtuple('Threshold', 'value percent')):
+    """A remainder, in ticks of the scale resolution or in percent of the target."""
+    __slots__ = ()
+
+    @classmethod
+    def parse(cls, text):
+        """Returns the Threshold for a config value such as 5, 5 ticks, 2 percent or 2%."""
+        text = str(text).strip()
+        if text.endswith('%'):
+            return cls(float(text[:-1]), True)
+        value, _, unit = text.partition(' ')
+        if unit.strip() not in ('', 'tick', 'ticks', 'percent'):
+            raise ValueError(f'Threshold {text!r} must be in ticks or percent.')
+        return cls(float(value), unit.strip() == 'percent')
+
+    def ticks(self, target_ticks):
+        """Returns the threshold in ticks, for a target in ticks."""
+        return self.value * target_ticks / 100 if self.percent else self.value
+
+    def weight(self, target, resolution):
+        """Returns the threshold in the scale unit, for a target and resolution in it."""
+        return self.value * target / 100 if self.percent else self.value * resolution
+
+
+class Stage:
+    """One trickler motor of the cascade."""
+
+    def __init__(self, name, motor, handoff, hysteresis, pid=None):
+        """Constructor. pid is the stage's own PID controller, or None to follow the cascade's."""
+        self.name = name
+        self.motor = motor
+        self.handoff = handoff
+        self.hysteresis = hysteresis
+        self.pid = pid
+
+    def __repr__(self):
+        return f'Stage({self.name!r}, handoff={self.handoff!r}, hysteresis={self.hysteresis!r}, own_pid={bool(self.pid)})'
+
+
+class Cascade:
+    """State machine handing the charge from stage to stage. The state is the index of the first running stage."""
+
+    def __init__(self, stages, pid):
+        """Constructor. stages run in order, bulk first, and pid is the controller of stages without their own."""
+        if not stages:
+            raise ValueError('A cascade needs at least one stage.')
+        self.stages = stages
+        self.pid = pid
+        self.motors = {x.name: x.motor for x in stages}
+        self.state = 0
+        self._limits = None
+        # Controllers which know the motors' clamp are given the PWM envelope of their stage, the cascade's as each
+        # stage following it takes over, see _limit_output().
+        for stage in stages:
+            if stage.pid and hasattr(stage.pid, 'output_limits'):
+                stage.pid.output_limits = (stage.motor.min_pwm, stage.motor.max_pwm)
+
+    def __str__(self):
+        return ' '.join(f'{x.name}={x.motor.speed}' for x in self.stages)
+
+    def start(self, target_ticks, seconds):
+        """Start a trickle with every stage running, for a target in ticks, from the time of the last reading."""
+        self.state = 0
+        # The last stage runs until the trickle stops.
+        self._limits = [
+            (x.handoff.ticks(target_ticks), x.hysteresis.ticks(target_ticks)) for x in self.stages[:-1]] + [(None, 0)]
+        self._limit_output()
+        for stage in self.stages:
+            if stage.pid:
+                self._reset_pid(stage.pid, seconds)
+
+    def _limit_output(self):
+        """Gives the cascade's PID controller the PWM envelope of the first running stage it drives."""
+        if not hasattr(self.pid, 'output_limits'):
+            return
+        for stage in self.stages[self.state:]:
+            if not stage.pid:
+                self.pid.output_limits = (stage.motor.min_pwm, stage.motor.max_pwm)
+                return
+
+    @staticmethod
+    def _reset_pid(pid, seconds):
+        """Clears a stage's own PID controller, as control_loop() does the cascade's."""
+        pid.clear()
+        pid.SetPoint = 100.0
+        pid.last_time = seconds
+
+    def _transition(self, remainder_ticks, seconds):
+        """Moves the state to the stages which should run for the remainder."""
+        state = self.state
+        while self.state < len(self.stages) - 1 and remainder_ticks <= self._limits[self.state][0]:
+            stage = self.stages[self.state]
+            stage.motor.off()
+            self.state += 1
+            logging.debug('Motor %s handed off at %s ticks remaining.', stage.name, remainder_ticks)
+        while self.state > 0:
+            handoff, hysteresis = self._limits[self.state - 1]
+            if remainder_ticks <= handoff + hysteresis:
+                break
+            self.state -= 1
+            stage = self.stages[self.state]
+            if stage.pid:
+                self._reset_pid(stage.pid, seconds)
+            logging.debug('Motor %s took over again at %s ticks remaining.', stage.name, remainder_ticks)
+        if self.state != state:
+            self._limit_output()
+
+    def update(self, remainder_ticks, feedback, seconds):
+        """Runs the stages for the remainder, from a reading at seconds. The cascade's PID must already be updated
+        with it."""
+        self._transition(remainder_ticks, seconds)
+        for stage in self.stages[self.state:]:
+            if stage.pid:
+                if seconds > stage.pid.last_time:
+                    stage.pid.update(feedback, seconds)
+                stage.motor.update(stage.pid.output)
+            else:
+                stage.motor.update(self.pid.output)
+        return self.state
+
+    def speed(self, name):
+        """Returns the speed of a stage's motor, 0 if there's no such stage."""
+        motor = self.motors.get(name)
+        return motor.speed if motor else 0.0
+
+    @property
+    def total_speed(self):
+        """Returns the sum of the speeds of every motor."""
+        return sum(x.motor.speed for x in self.stages)
+
+    @property
+    def peak_speed(self):
+        """Returns the speed of the fastest motor."""
+        return max(x.motor.speed for x in self.stages)
+
+    def off(self):
+        """Turns every motor off."""
+        for stage in self.stages:
+            stage.motor.off()
+
+
+def from_config(config, pid, motor_factory):
+    """Returns the Cascade of the [cascade] section of the config, with each stage's options from its [motorN]
+    section. motor_factory(number) returns the trickler motor for a section's number."""
+    cascade_config = config['cascade'] if config.has_section('cascade') else {}
+    numbers = [x.strip() for x in cascade_config.get('stages', '2, 1').split(',') if x.strip()]
+    stages = []
+    for index, number in enumerate(numbers):
+        motor_config = config['motor' + number]
+        last = index == len(numbers) - 1
+        own_pid = None
+        if any(x in motor_config for x in ('Kp', 'Ki', 'Kd')):
+            own_pid = controller.from_config(config, **{x: motor_config[x] for x in ('Kp', 'Ki', 'Kd') if x in motor_config})
+        stages.append(Stage(
+            number,
+            motor_factory(number),
+            # 5 ticks is the 0.1 grains at which the fine trickler used to take over alone.
+            Threshold.parse(motor_config.get('handoff', '0' if last else '5')),
+            Threshold.parse(motor_config.get('hysteresis', '2')),
+            own_pid))
+    cascade = Cascade(stages, pid)
+    logging.debug('cascade: %r', stages)
+    return cascade
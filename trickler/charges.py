@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+
+Record of every charge cycle in a local SQLite database, with queries and a command line report.
+
+The control loop hands each finished charge to a ChargeLog, which writes them from a background thread in batches, so
+the loop never waits on the SD card. The database is in WAL mode, so reports can be run while the trickler writes:
+
+    python3 charges.py /var/tmp/opentrickler_charges.db throughput --since 7d
+    python3 charges.py /var/tmp/opentrickler_charges.db breakdown --since 24h
+    python3 charges.py /var/tmp/opentrickler_charges.db overshoot --since 2024-05-01 --until 2024-06-01
+"""
+
+import atexit
+import collections
+import datetime
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS charges (
+        id INTEGER PRIMARY KEY,
+        station TEXT NOT NULL DEFAULT '',
+        target REAL NOT NULL,
+        unit TEXT NOT NULL,
+        dump_start REAL,
+        pour_end REAL,
+        dump_end REAL,
+        trickle_start REAL NOT NULL,
+        trickle_end REAL NOT NULL,
+        settled_at REAL,
+        final_weight REAL,
+        overshoot REAL,
+        peak_pwm REAL,
+        iterations INTEGER,
+        abort_reason TEXT NOT NULL)''',
+    'CREATE INDEX IF NOT EXISTS charges_by_time ON charges (trickle_start)',
+    'CREATE INDEX IF NOT EXISTS charges_by_station ON charges (station, trickle_start)',
+    'CREATE INDEX IF NOT EXISTS charges_by_reason ON charges (abort_reason, trickle_start)',
+)
+# Columns added since the table was first created, with their types, for databases which predate them.
+ADDED_COLUMNS = (
+    ('pour_end', 'REAL'),
+)
+# Columns of a charge, in order. Times are Unix timestamps in seconds, weights in the unit and the PWM in percent.
+COLUMNS = (
+    'station', 'target', 'unit', 'dump_start', 'pour_end', 'dump_end', 'trickle_start', 'trickle_end', 'settled_at',
+    'final_weight', 'overshoot', 'peak_pwm', 'iterations', 'abort_reason')
+Charge = collections.namedtuple('Charge', COLUMNS)
+INSERT = f'INSERT INTO charges ({", ".join(COLUMNS)}) VALUES ({", ".join("?" * len(COLUMNS))})'
+
+
+def connect(path):
+    """Returns a connection to the database, creating it if needed."""
+    conn = sqlite3.connect(path, timeout=5)
+    conn.execute('PRAGMA journal_mode=WAL')
+    # With WAL, NORMAL only risks the last transactions on power loss, never corruption.
+    conn.execute('PRAGMA synchronous=NORMAL')
+    for statement in SCHEMA:
+        conn.execute(statement)
+    existing = {x[1] for x in conn.execute('PRAGMA table_info(charges)')}
+    for name, column_type in ADDED_COLUMNS:
+        if name not in existing:
+            conn.execute(f'ALTER TABLE charges ADD COLUMN {name} {column_type}')
+    conn.commit()
+    return conn
+
+
+class ChargeLog:
+    """Collects charge cycles from the control loop and writes them to the database from a background thread.
+
+    The control loop calls trickled() when trickling stops, then settled() with every scale reading until the charge
+    is complete: once the scale has been stable for settle_time after trickling, or the pan is removed.
+    """
+
+    def __init__(self, path, station='', settle_time=1.0, flush_interval=5.0):
+        """Constructor."""
+        self.path = path
+        self.station = station
+        self.settle_time = settle_time
+        self.written = 0
+        self._flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._pending = None
+        # The connection is made in the writer thread, since SQLite connections belong to their thread.
+        connect(path).close()
+        self._thread = threading.Thread(target=self._run, name='charge-log', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def trickled(self, target, unit, dump_result, result):
+        """Start recording a charge from the dump.DumpResult of its dump, None if it had none, and the
+        main.TrickleResult of its trickle. Completed by settled()."""
+        self.settled(None, False)
+        dump_times = (dump_result.start, dump_result.pour_end, dump_result.end) if dump_result else (None, None, None)
+        self._pending = Charge(
+            self.station, float(target), unit, *dump_times, result.start, result.end, None, None, None,
+            result.peak_pwm, result.iterations, result.reason.value)
+
+    def settled(self, weight, stable):
+        """Complete the pending charge with the scale's weight if it has settled. None for the weight if the pan is
+        gone, which completes the charge without it."""
+        charge = self._pending
+        if charge is None:
+            return
+        now = time.time()
+        if weight is not None and weight >= 0:
+            if not stable or now - charge.trickle_end < self.settle_time:
+                return
+            charge = charge._replace(settled_at=now, final_weight=float(weight), overshoot=float(weight) - charge.target)
+        self._pending = None
+        self._queue.put(charge)
+
+    def close(self):
+        """Write everything queued, including a charge which hasn't settled yet, and stop the writer thread."""
+        if self._thread.is_alive():
+            self.settled(None, False)
+            self._queue.put(None)
+            self._thread.join(timeout=10)
+
+    def _run(self):
+        """Writer thread, inserting whatever has queued up at most once every flush_interval, in one transaction."""
+        conn = connect(self.path)
+        stop = False
+        while not stop:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self._flush_interval
+            while batch[-1] is not None and time.monotonic() < deadline:
+                try:
+                    batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                stop = True
+                batch.pop()
+            if not batch:
+                continue
+            try:
+                with conn:
+                    conn.executemany(INSERT, batch)
+                self.written += len(batch)
+            except sqlite3.Error:
+                logging.exception('Failed to record %d charges in %s.', len(batch), self.path)
+        conn.close()
+
+
+def from_config(config, station=''):
+    """Returns a ChargeLog for the [charges] section of the config, or None if it's disabled."""
+    charges_config = config['charges'] if config.has_section('charges') else {}
+    if str(charges_config.get('enabled', False)).lower() not in ('1', 'true', 'yes', 'on'):
+        return None
+    return ChargeLog(
+        charges_config.get('database', '/var/tmp/opentrickler_charges.db'),
+        station,
+        float(charges_config.get('settle_time', 1.0)),
+        float(charges_config.get('flush_interval', 5.0)))
+
+
+def _where(since, until, station):
+    """Returns the WHERE clause and parameters selecting charges which started trickling in a time range."""
+    clause = 'trickle_start >= ? AND trickle_start < ?'
+    params = [since, until]
+    if station is not None:
+        clause += ' AND station = ?'
+        params.append(station)
+    return clause, params
+
+
+def find(conn, since, until, station=None):
+    """Returns the Charges which started trickling between two Unix timestamps, oldest first."""
+    clause, params = _where(since, until, station)
+    rows = conn.execute(f'SELECT {", ".join(COLUMNS)} FROM charges WHERE {clause} ORDER BY trickle_start', params)
+    return [Charge(*x) for x in rows]
+
+
+def throughput(conn, since, until, bucket=3600, station=None):
+    """Returns (bucket start, completed charges, aborted charges) for each bucket of seconds with any charges."""
+    clause, params = _where(since, until, station)
+    return conn.execute(
+        f'''SELECT CAST(trickle_start / ? AS INTEGER) * ? AS bucket,
+            SUM(abort_reason = 'complete'), SUM(abort_reason != 'complete')
+        FROM charges WHERE {clause} GROUP BY bucket ORDER BY bucket''',
+        [bucket, bucket] + params).fetchall()
+
+
+def cycle_breakdown(conn, since, until, station=None):
+    """Returns the average seconds of each part of a completed charge cycle, and the count of each abort reason."""
+    clause, params = _where(since, until, station)
+    averages = conn.execute(
+        f'''SELECT COUNT(*), AVG(dump_end - dump_start), AVG(pour_end - dump_start), AVG(dump_end - pour_end),
+            AVG(trickle_start - dump_end),
+            AVG(trickle_end - trickle_start), AVG(settled_at - trickle_end), AVG(settled_at - COALESCE(dump_start,
+            trickle_start)), AVG(iterations), AVG(peak_pwm)
+        FROM charges WHERE {clause} AND abort_reason = 'complete' ''',
+        params).fetchone()
+    reasons = conn.execute(
+        f'SELECT abort_reason, COUNT(*) FROM charges WHERE {clause} GROUP BY abort_reason ORDER BY 2 DESC',
+        params).fetchall()
+    keys = ('charges', 'dump', 'pour', 'dump_settle', 'dump_to_trickle', 'trickle', 'settle', 'cycle', 'iterations', 'peak_pwm')
+    return dict(zip(keys, averages)), dict(reasons)
+
+
+def overshoot_distribution(conn, since, until, station=None, percentiles=(50, 90, 99), bin_width=None):
+    """Returns the count, mean, percentiles and a histogram of {bin start: count} of the overshoot of completed
+    charges. bin_width defaults to the smallest difference between overshoots, usually the scale resolution."""
+    clause, params = _where(since, until, station)
+    values = [x[0] for x in conn.execute(
+        f'''SELECT overshoot FROM charges WHERE {clause} AND abort_reason = 'complete' AND overshoot IS NOT NULL
+        ORDER BY overshoot''',
+        params)]
+    if not values:
+        return {'charges': 0}
+    if bin_width is None:
+        steps = [round(b - a, 6) for a, b in zip(values, values[1:]) if b - a > 1e-9]
+        bin_width = min(steps) if steps else 1.0
+    histogram = collections.Counter(round(int(round(x / bin_width, 6) // 1) * bin_width, 6) for x in values)
+    summary = {
+        'charges': len(values),
+        'mean': sum(values) / len(values),
+        'histogram': dict(sorted(histogram.items())),
+    }
+    for percent in percentiles:
+        summary[f'p{percent:g}'] = values[min(len(values) - 1, int(len(values) * percent / 100))]
+    return summary
+
+
+def parse_time(value, now=None):
+    """Returns a Unix timestamp for an ISO date/time, or a time ago such as 30m, 24h or 7d."""
+    now = time.time() if now is None else now
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    if value[-1:] in units and value[:-1].replace('.', '', 1).isdigit():
+        return now - float(value[:-1]) * units[value[-1]]
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    import dump
+
+    parser = argparse.ArgumentParser(description='Report on the charges recorded by OpenTrickler.')
+    parser.add_argument('database')
+    parser.add_argument('report', choices=('list', 'throughput', 'breakdown', 'overshoot'))
+    parser.add_argument('--since', default='24h', help='ISO date/time, or a time ago such as 30m, 24h or 7d.')
+    parser.add_argument('--until', help='ISO date/time, or a time ago, default now.')
+    parser.add_argument('--station', help='Only charges of this station.')
+    parser.add_argument('--bucket', default='1h', help='Throughput interval, such as 15m, 1h or 1d.')
+    args = parser.parse_args()
+
+    now = time.time()
+    since = parse_time(args.since, now)
+    until = parse_time(args.until, now) if args.until else now
+    db = connect(args.database)
+
+    def timestamp(value):
+        """Formats a Unix timestamp in local time."""
+        return datetime.datetime.fromtimestamp(value).strftime('%Y-%m-%d %H:%M:%S')
+
+    if args.report == 'list':
+        for charge in find(db, since, until, args.station):
+            final = '-' if charge.final_weight is None else f'{charge.final_weight:g}'
+            print(
+                f'{timestamp(charge.trickle_start)} {charge.station or "-"} {charge.target:g} {charge.unit} '
+                f'final {final} trickle {charge.trickle_end - charge.trickle_start:.1f}s peak {charge.peak_pwm:.0f}% '
+                f'{charge.iterations} iterations {charge.abort_reason}')
+    elif args.report == 'throughput':
+        bucket = now - parse_time(args.bucket, now)
+        for start, completed, aborted in throughput(db, since, until, bucket, args.station):
+            print(f'{timestamp(start)} {completed:5d} completed {aborted:4d} aborted {completed * 3600 / bucket:7.1f}/h')
+    elif args.report == 'breakdown':
+        averages, reasons = cycle_breakdown(db, since, until, args.station)
+        print(f'{averages["charges"]} completed charges, average seconds:')
+        for key in ('dump', 'pour', 'dump_settle', 'dump_to_trickle', 'trickle', 'settle', 'cycle'):
+            print(f'  {key:<16} {"-" if averages[key] is None else f"{averages[key]:.2f}"}')
+        if averages['dump'] is not None:
+            print(f'  {"saved":<16} {dump.FIXED_DUMP_TIME - averages["dump"]:.2f} a dump, against the fixed sequence')
+        if averages['charges']:
+            print(f'  {averages["iterations"]:.0f} PID iterations, peak PWM {averages["peak_pwm"]:.0f}%')
+        print('Stopped by: ' + ', '.join(f'{reason} {count}' for reason, count in reasons.items()))
+    else:
+        summary = overshoot_distribution(db, since, until, args.station)
+        if not summary['charges']:
+            print('No completed charges.')
+        else:
+            print(
+                f'{summary["charges"]} completed charges, overshoot mean {summary["mean"]:.3f} '
+                f'p50 {summary["p50"]:g} p90 {summary["p90"]:g} p99 {summary["p99"]:g}')
+            widest = max(summary['histogram'].values())
+            for start, count in summary['histogram'].items():
+                print(f'{start:>8g} {count:5d} {"#" * max(1, count * 50 // widest)}')
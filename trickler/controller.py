@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+
+PID controller for the trickler, selected with controller = v2 in [PID] in place of the IvPID controller in PID.py,
+which stays the default since the shipped gains are tuned for it.
+
+It runs on the monotonic arrival times of the scale's frames rather than sampling the clock, and does nothing for a time
+which hasn't moved on, so a reading used twice adds nothing. The derivative acts on the reading, weighted by
+derivative_weight of the setpoint, through a first-order filter, since the scale's readings are steps of its
+resolution. The proportional term acts on setpoint_weight of the setpoint. Rather than a fixed windup guard, the
+integral is pulled back by how far the output is beyond the motor's PWM envelope (back-calculation), and gains can be
+scheduled by the band of the remaining error. The terms are kept as PID.PID keeps them, so telemetry and the tools
+read either controller alike.
+"""
+
+import math
+import time
+
+import PID
+
+
+class Controller: # pylint: disable=too-many-instance-attributes;
+    """PID controller with a filtered derivative, setpoint weighting, back-calculation anti-windup and gain scheduling.
+
+    Feedback and setpoint are in percent of the target, and the output in percent PWM, as with PID.PID.
+    """
+    __slots__ = (
+        'Kp', 'Ki', 'Kd', 'SetPoint', 'PTerm', 'ITerm', 'DTerm', 'output', 'current_time', 'last_time',
+        'setpoint_weight', 'derivative_weight', 'derivative_filter', 'tracking_time', 'output_limits', 'schedule',
+        '_gains', '_last_input', '_integral_gain')
+
+    def __init__(self, Kp, Ki, Kd, **kwargs): # pylint: disable=invalid-name;
+        """Constructor. schedule is a sequence of (error band, Kp, Ki, Kd), used for errors within the band."""
+        self.Kp = self.Ki = self.Kd = 0.0
+        self._gains = (float(Kp), float(Ki), float(Kd))
+        # Share of the setpoint the proportional and derivative terms act on, 0 - 1.
+        self.setpoint_weight = float(kwargs.get('setpoint_weight', 1.0))
+        self.derivative_weight = float(kwargs.get('derivative_weight', 0.0))
+        # Time constant of the derivative's filter, in seconds.
+        self.derivative_filter = float(kwargs.get('derivative_filter', 0.2))
+        # Seconds for the integral to track the output back inside the limits.
+        self.tracking_time = float(kwargs.get('tracking_time', 1.0))
+        # Output the motors can follow, (min_pwm, max_pwm). cascade.Cascade sets it from the running motor's envelope.
+        self.output_limits = kwargs.get('output_limits', (-math.inf, math.inf))
+        self.schedule = tuple(sorted(tuple(float(y) for y in x) for x in kwargs.get('schedule', ())))
+        self.current_time = self.last_time = time.monotonic()
+        self.clear()
+
+    def __repr__(self):
+        return f'Controller(Kp={self._gains[0]}, Ki={self._gains[1]}, Kd={self._gains[2]}, schedule={self.schedule})'
+
+    @property
+    def integral_gain(self):
+        """Returns the gain the integral is applied with, Ki unless a band with a Ki of 0 holds it."""
+        return self._integral_gain
+
+    def clear(self):
+        """Clears the terms and the setpoint, as PID.PID.clear() does."""
+        self.SetPoint = 0.0
+        self.PTerm = 0.0
+        self.ITerm = 0.0
+        self.DTerm = 0.0
+        self.output = 0.0
+        self._last_input = None
+        self.Kp, self.Ki, self.Kd = self._gains
+        # The Ki the integral is scaled for, which a band with a Ki of 0 leaves as it was.
+        self._integral_gain = self.Ki
+
+    def _schedule_gains(self, error):
+        """Switch to the gains of the narrowest band holding the error, keeping the integral's share of the output.
+
+        A band with a Ki of 0 stops the integral accumulating, but keeps its share of the output at the last Ki, until
+        the next band with a Ki picks it up again.
+        """
+        kp, ki, kd = self._gains
+        magnitude = abs(error)
+        for band, band_kp, band_ki, band_kd in self.schedule:
+            if magnitude <= band:
+                kp, ki, kd = band_kp, band_ki, band_kd
+                break
+        if ki and ki != self._integral_gain:
+            # Bumpless: rescale the integral so Ki * ITerm doesn't jump with the gain.
+            if self._integral_gain:
+                self.ITerm = self.ITerm * self._integral_gain / ki
+            self._integral_gain = ki
+        self.Kp, self.Ki, self.Kd = kp, ki, kd
+
+    def update(self, feedback_value, current_time=None):
+        """Update the output for a reading taken at current_time, in monotonic seconds."""
+        current_time = time.monotonic() if current_time is None else current_time
+        delta_time = current_time - self.last_time
+        self.current_time = current_time
+        if delta_time <= 0:
+            return
+        error = self.SetPoint - feedback_value
+        if self.schedule:
+            self._schedule_gains(error)
+
+        self.PTerm = self.Kp * (self.setpoint_weight * self.SetPoint - feedback_value)
+        derivative_input = self.derivative_weight * self.SetPoint - feedback_value
+        if self._last_input is not None:
+            rate = (derivative_input - self._last_input) / delta_time
+            self.DTerm += (rate - self.DTerm) * delta_time / (self.derivative_filter + delta_time)
+        self._last_input = derivative_input
+
+        output = self.PTerm + self._integral_gain * self.ITerm + self.Kd * self.DTerm
+        if self.Ki:
+            low, high = self.output_limits
+            limited = high if output > high else low if output < low else output
+            self.ITerm += (error + (limited - output) / (self.Ki * self.tracking_time)) * delta_time
+        self.output = output
+        self.last_time = current_time
+
+
+def parse_schedule(text):
+    """Returns the gain schedule of a config value such as 5: 8 1.2 3.75, 1: 6 1.0 3.75."""
+    schedule = []
+    for entry in text.split(','):
+        if not entry.strip():
+            continue
+        band, _, gains = entry.partition(':')
+        values = gains.split()
+        if len(values) != 3:
+            raise ValueError(f'Gain schedule entry {entry.strip()!r} must be "band: Kp Ki Kd".')
+        schedule.append((float(band),) + tuple(float(x) for x in values))
+    return schedule
+
+
+def from_config(config, **gains):
+    """Returns the controller chosen in the [PID] section of the config. Keyword arguments override Kp, Ki and Kd."""
+    pid_config = config['PID']
+    kp, ki, kd = (float(gains.get(x, pid_config[x])) for x in ('Kp', 'Ki', 'Kd'))
+    kind = pid_config.get('controller', 'ivpid')
+    if kind == 'ivpid':
+        return PID.PID(kp, ki, kd)
+    if kind != 'v2':
+        raise ValueError(f'[PID] controller must be ivpid or v2, not {kind!r}.')
+    return Controller(
+        kp,
+        ki,
+        kd,
+        setpoint_weight=pid_config.get('setpoint_weight', 1.0),
+        derivative_weight=pid_config.get('derivative_weight', 0.0),
+        derivative_filter=pid_config.get('derivative_filter', 0.2),
+        tracking_time=pid_config.get('tracking_time', 1.0),
+        schedule=parse_schedule(pid_config.get('gain_schedule', '')))
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+
+Predictive cutoff of the trickler motors, for the powder which is still in the air when the scale reaches the target.
+
+Powder falling from the tube and the lag of the scale's filter mean the settled weight ends up above the reading the
+motors were stopped at, by roughly the flow rate times a lead time. The estimator measures the flow rate from recent
+readings, scales it by how the motor PWM has changed since, and stops the trickle once the predicted settled weight
+reaches the target. After every charge it compares the settled weight with the prediction and adjusts the lead time,
+which is learned separately for each powder profile and kept in a JSON file.
+"""
+
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+
+# Stations in one process share the profiles file, so they take turns to update it.
+_SAVE_LOCK = threading.Lock()
+
+
+class CutoffEstimator: # pylint: disable=too-many-instance-attributes;
+    """Online estimate of the powder in flight, learned charge over charge for one powder profile."""
+
+    def __init__(self, profile='default', path=None, **kwargs):
+        """Constructor. path is the JSON file the learned lead times are kept in, None to not keep them."""
+        self.profile = profile
+        self.path = path
+        # Seconds of readings the flow rate is measured over.
+        self.window = float(kwargs.get('window', 1.0))
+        # How far each charge moves the lead time towards what it observed, 0 - 1.
+        self.learn_rate = float(kwargs.get('learn_rate', 0.3))
+        self.max_lead = float(kwargs.get('max_lead', 3.0))
+        # Never stop earlier than this fraction of the target, however fast the powder flows.
+        self.max_fraction = float(kwargs.get('max_fraction', 0.05))
+        # Seconds the scale must be stable after the trickle before the charge is learned from.
+        self.settle_time = float(kwargs.get('settle_time', 1.0))
+        profiles = self._load()
+        learned = profiles.get(profile, {})
+        self.lead = float(learned.get('lead', kwargs.get('initial_lead', 0.5)))
+        self.charges = int(learned.get('charges', 0))
+        # Recent (seconds, weight, total PWM) readings of the current trickle.
+        self._readings = collections.deque()
+        # (weight, rate) when the trickle stopped, and the monotonic time, until the charge settles.
+        self._stopped = None
+        self._pending = None
+
+    def _load(self):
+        """Returns the learned lead times of every profile in the file."""
+        if not self.path:
+            return {}
+        try:
+            with open(self.path, encoding='utf-8') as profiles_file:
+                return json.load(profiles_file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            logging.exception('Could not read powder cutoff profiles from %s, starting over.', self.path)
+            return {}
+
+    def _save(self):
+        """Write this profile's lead time to the file, keeping the other profiles."""
+        if not self.path:
+            return
+        with _SAVE_LOCK:
+            profiles = self._load()
+            profiles[self.profile] = {'lead': self.lead, 'charges': self.charges}
+            temporary = self.path + '.tmp'
+            try:
+                with open(temporary, 'w', encoding='utf-8') as profiles_file:
+                    json.dump(profiles, profiles_file, indent=2)
+                os.replace(temporary, self.path)
+            except OSError:
+                logging.exception('Could not save powder cutoff profiles to %s.', self.path)
+
+    def start(self):
+        """Forget the readings of the last trickle."""
+        self._readings.clear()
+        self._stopped = None
+
+    def rate(self):
+        """Returns the flow rate in weight/second, from a least squares fit of the readings in the window."""
+        readings = self._readings
+        if len(readings) < 3:
+            return 0.0
+        count = len(readings)
+        mean_t = sum(x[0] for x in readings) / count
+        mean_w = sum(x[1] for x in readings) / count
+        variance = sum((x[0] - mean_t) ** 2 for x in readings)
+        if not variance:
+            return 0.0
+        return max(0.0, sum((x[0] - mean_t) * (x[1] - mean_w) for x in readings) / variance)
+
+    def in_flight(self):
+        """Returns the predicted weight which hasn't shown on the scale yet."""
+        readings = self._readings
+        if not readings:
+            return 0.0
+        rate = self.rate()
+        # The measured rate is that of the PWM over the window. If the PWM has dropped since, so has the flow.
+        mean_pwm = sum(x[2] for x in readings) / len(readings)
+        if mean_pwm > 0:
+            rate *= min(readings[-1][2] / mean_pwm, 2.0)
+        return rate * self.lead
+
+    def update(self, timestamp, weight, pwm, target):
+        """Add a reading of the trickle and return True if the predicted settled weight has reached the target.
+
+        timestamp is monotonic ns, weight and target are in the scale unit and pwm is the total of the motor speeds.
+        """
+        seconds = timestamp / 1e9
+        readings = self._readings
+        readings.append((seconds, float(weight), pwm))
+        while readings[0][0] < seconds - self.window:
+            readings.popleft()
+        target = float(target)
+        remainder = target - float(weight)
+        predicted = self.in_flight()
+        if remainder <= 0 or (remainder <= target * self.max_fraction and predicted >= remainder):
+            self._stopped = (float(weight), self.rate())
+            return True
+        return False
+
+    def trickled(self, completed):
+        """The trickle stopped. Only charges which completed are learned from, once they settle."""
+        self._pending = (self._stopped, time.monotonic()) if completed and self._stopped else None
+        self._stopped = None
+
+    def settled(self, weight, stable):
+        """Learn from the pending charge once the scale has been stable for settle_time after the trickle. None for
+        the weight if the pan is gone, which abandons it."""
+        if self._pending is None:
+            return
+        (stop_weight, rate), stopped_at = self._pending
+        if weight is None:
+            self._pending = None
+            return
+        if not stable or time.monotonic() - stopped_at < self.settle_time:
+            return
+        self._pending = None
+        if rate <= 0:
+            return
+        observed = min(max((float(weight) - stop_weight) / rate, 0.0), self.max_lead)
+        previous = self.lead
+        self.lead += (observed - self.lead) * self.learn_rate
+        self.charges += 1
+        logging.info(
+            'Powder %s: %s in flight at cutoff, lead time %.2fs -> %.2fs after %d charges',
+            self.profile, float(weight) - stop_weight, previous, self.lead, self.charges)
+        self._save()
+
+
+def from_config(config, **overrides):
+    """Returns a CutoffEstimator for the [cutoff] section of the config, or None if it's disabled. Keyword arguments
+    override options of the section."""
+    cutoff_config = dict(config['cutoff']) if config.has_section('cutoff') else {}
+    cutoff_config.update(overrides)
+    if str(cutoff_config.get('enabled', False)).lower() not in ('1', 'true', 'yes', 'on'):
+        return None
+    return CutoffEstimator(
+        cutoff_config.get('profile', 'default'),
+        cutoff_config.get('profiles_file', '/var/tmp/opentrickler_cutoff.json'),
+        **{k: v for k, v in cutoff_config.items() if k not in ('enabled', 'profile', 'profiles_file')})
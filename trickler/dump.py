@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+
+Powder measure dump, driven by the scale readings instead of fixed sleeps.
+
+The servo dumps the measure, and is returned as soon as the scale shows the weight jump of the powder landing, since by
+then the measure is empty. Trickling starts once the readings have settled after the impact. Each phase is timed, so
+the charge log can show what the dump costs against the fixed 3.5 second sequence it replaced.
+"""
+
+import collections
+import logging
+import time
+
+
+# Seconds the dump took when it was a fixed sequence of sleeps.
+FIXED_DUMP_TIME = 3.5
+
+
+class DumpResult(collections.namedtuple('DumpResult', 'start pour_end end jump settled angle dwell mass')):
+    """Timing and outcome of a dump. Times are Unix timestamps in seconds, the jump is in ticks of the scale resolution,
+    the dwell in seconds and the mass landed in the scale unit."""
+    __slots__ = ()
+
+    @property
+    def pour_time(self):
+        """Returns the seconds from the start of the dump until the servo was returned."""
+        return self.pour_end - self.start
+
+    @property
+    def settle_time(self):
+        """Returns the seconds from the servo being returned until the scale settled."""
+        return self.end - self.pour_end
+
+    @property
+    def duration(self):
+        """Returns the seconds the whole dump took."""
+        return self.end - self.start
+
+
+class DumpSequence:
+    """Dumps the powder measure and waits for the scale, rather than for a fixed time."""
+
+    def __init__(self, **kwargs):
+        """Constructor."""
+        # Seconds to wait before dumping, for a hand to get clear of the pan, as the fixed sequence did.
+        self.start_delay = float(kwargs.get('start_delay', 1.0))
+        # Rise in ticks which shows the powder has landed.
+        self.jump_ticks = int(kwargs.get('jump_ticks', 5))
+        # Seconds to wait for the powder to land before returning the servo regardless.
+        self.pour_timeout = float(kwargs.get('pour_timeout', 1.5))
+        # Consecutive readings within settle_ticks of each other, and stable, for the scale to have settled.
+        self.settle_frames = int(kwargs.get('settle_frames', 3))
+        self.settle_ticks = int(kwargs.get('settle_ticks', 1))
+        # Seconds to wait for the scale to settle before trickling regardless.
+        self.settle_timeout = float(kwargs.get('settle_timeout', 3.0))
+
+    def run(self, scale, servo_motor, angle=None, dwell=0.0):
+        """Dumps the measure onto the pan and returns a DumpResult once the scale has settled.
+
+        angle defaults to the servo's dump angle, and dwell is the seconds to hold the servo there after the powder
+        lands. The scale must be streaming. The dump is cut short if the pan is removed, which trickling then notices.
+        """
+        start = time.time()
+        if self.start_delay:
+            time.sleep(self.start_delay)
+        baseline = scale.ticks
+        logging.info('Starting powder dump...')
+        angle = servo_motor.servo_angle if angle is None else angle
+        servo_motor.run_servo(angle)
+
+        # Pour: until the powder lands on the pan.
+        jump = 0
+        deadline = time.monotonic() + self.pour_timeout
+        while time.monotonic() < deadline:
+            if scale.update() is None:
+                continue
+            if scale.weight < 0:
+                break
+            jump = scale.ticks - baseline
+            if jump >= self.jump_ticks:
+                break
+        else:
+            logging.warning('No powder landed within %ss of dumping, is the measure empty?', self.pour_timeout)
+        if dwell:
+            time.sleep(dwell)
+        servo_motor.set_initial_angle()
+        pour_end = time.time()
+
+        # Settle: until the readings stop moving after the impact.
+        recent = collections.deque(maxlen=self.settle_frames)
+        settled = False
+        deadline = time.monotonic() + self.settle_timeout
+        while time.monotonic() < deadline:
+            if scale.update() is None:
+                continue
+            if scale.weight < 0:
+                break
+            recent.append(scale.ticks)
+            if scale.is_stable and len(recent) == recent.maxlen and max(recent) - min(recent) <= self.settle_ticks:
+                settled = True
+                break
+        else:
+            logging.warning('Scale did not settle within %ss of the dump.', self.settle_timeout)
+        mass = float((scale.ticks - baseline) * scale.resolution) if scale.weight >= 0 else 0.0
+        result = DumpResult(start, pour_end, time.time(), jump, settled, angle, dwell, mass)
+        logging.info(
+            'Completed powder dump in %.2fs (pour %.2fs, settle %.2fs), %.2fs less than the fixed sequence.',
+            result.duration, result.pour_time, result.settle_time, FIXED_DUMP_TIME - result.duration)
+        return result
+
+
+def from_config(config):
+    """Returns a DumpSequence for the [dump] section of the config."""
+    return DumpSequence(**(dict(config['dump']) if config.has_section('dump') else {}))
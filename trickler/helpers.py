@@ -7,8 +7,12 @@ OpenTrickler
 https://github.com/ammolytics/projects/tree/develop/trickler
 """
 import array
+import atexit
 import decimal
+import json
 import logging
+import logging.handlers
+import queue
 import struct
 
 import pymemcache.client.base # pylint: disable=import-error;
@@ -24,12 +28,134 @@ def get_mc_client(server='127.0.0.1:11211'):
         timeout=2)
 
 
-def setup_logging(level=logging.DEBUG):
-    """Returns a configured logger instance."""
-    logging.basicConfig(
-        level=level,
-        format='%(asctime)s.%(msecs)06dZ %(levelname)-4s %(message)s',
-        datefmt='%Y-%m-%dT%H:%M:%S')
+def get_state_client(config):
+    """Returns the client the daemons share state through: memcache, or the shared-memory state bus."""
+    state_config = config['state'] if config.has_section('state') else {}
+    if state_config.get('backend', 'memcache') == 'shm':
+        import statebus # pylint: disable=import-outside-toplevel;
+        return statebus.StateBusClient(state_config.get('bus_name', 'opentrickler'), config['memcache_vars'])
+    return get_mc_client(state_config.get('memcache_server', '127.0.0.1:11211'))
+
+
+LOG_FORMAT = '%(asctime)s.%(msecs)06dZ %(levelname)-4s %(message)s'
+LOG_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+class RateLimitFilter(logging.Filter):
+    """Passes at most rate records per second from each line of code, counting the rest. Warnings always pass."""
+
+    def __init__(self, rate):
+        """Constructor."""
+        super().__init__()
+        self._interval = 1.0 / rate
+        # Time of the last record passed and the number suppressed since, by (pathname, lineno).
+        self._sites = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        site = (record.pathname, record.lineno)
+        last, suppressed = self._sites.get(site, (None, 0))
+        if last is not None and record.created - last < self._interval:
+            self._sites[site] = (last, suppressed + 1)
+            return False
+        self._sites[site] = (record.created, 0)
+        record.suppressed = suppressed
+        return True
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """Queues records without formatting them, leaving all of the work to the listener's thread.
+
+    The queue is bounded, and records which don't fit are dropped and counted rather than waiting for room.
+    """
+
+    def __init__(self, log_queue):
+        """Constructor."""
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._reported = 0
+
+    def prepare(self, record):
+        # Arguments are formatted later by the listener, so only pass immutable values (Decimal, enums, numbers).
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self.dropped != self._reported:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    'name': 'logging',
+                    'levelno': logging.WARNING,
+                    'levelname': 'WARNING',
+                    'msg': 'Log queue full, dropped %d records.',
+                    'args': (self.dropped - self._reported,),
+                }))
+                self._reported = self.dropped
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class TextFormatter(logging.Formatter):
+    """The usual text format, noting how many records from the same line were rate limited."""
+
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            text += f' ({suppressed} similar suppressed)'
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as one line of JSON."""
+
+    def format(self, record):
+        entry = {
+            'time': f'{self.formatTime(record, LOG_DATE_FORMAT)}.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'site': f'{record.module}:{record.lineno}',
+            'message': record.getMessage(),
+        }
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            entry['suppressed'] = suppressed
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def setup_logging(level=logging.DEBUG, config=None):
+    """Returns a configured logger instance.
+
+    With log_queue set in the [general] section of the config, records are handed to a background thread through a
+    bounded queue so the caller never waits on log output, with optional JSON output and per-line rate limiting.
+    """
+    general = config['general'] if config is not None and config.has_section('general') else {}
+    json_format = general.get('log_format', 'text') == 'json'
+    if not str(general.get('log_queue', False)).lower() in ('1', 'true', 'yes', 'on'):
+        logging.basicConfig(level=level, format=LOG_FORMAT, datefmt=LOG_DATE_FORMAT)
+        if json_format:
+            for handler in logging.getLogger().handlers:
+                handler.setFormatter(JsonFormatter())
+        return logging.getLogger()
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonFormatter() if json_format else TextFormatter(LOG_FORMAT, LOG_DATE_FORMAT))
+    queue_handler = LazyQueueHandler(queue.Queue(int(general.get('log_queue_length', 1000))))
+    rate = float(general.get('log_rate_limit', 0))
+    if rate:
+        queue_handler.addFilter(RateLimitFilter(rate))
+    logger = logging.getLogger()
+    logger.setLevel(level)
+    logger.addHandler(queue_handler)
+    listener = logging.handlers.QueueListener(queue_handler.queue, stream_handler)
+    listener.start()
+    # Write out whatever is still queued at exit.
+    atexit.register(listener.stop)
+    return logger
 
 
 def is_even(dec):
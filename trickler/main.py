@@ -9,16 +9,25 @@ https://github.com/ammolytics/projects/tree/develop/trickler
 OpenTrickler forked and updated here:
 https://github.com/codebydch/open-trickler-peripheral
 """
-import datetime
+import collections
 import decimal
 import enum
 import logging
+import signal
 import time
 
+import calibration
+import cascade
+import charges
+import controller
+import cutoff
+import dump
 import helpers
-import PID
 import motors
 import scales
+import scheduler
+import state
+import telemetry
 
 
 # Components:
@@ -31,133 +40,196 @@ import scales
 # 7: Powder pan/cup?
 
 
-def trickler_loop(memcache, constants, pid, trickler_motor1, trickler_motor2, scale, target_weight, target_unit, pidtune_logger): # pylint: disable=too-many-arguments;
-    """Main trickler control loop run when all devices are ready, target weight is set, and auto-mode is on."""
-    pidtune_logger.info('timestamp, input (motor %), output (weight %)')
+class StopReason(enum.Enum):
+    """Why trickler_loop() stopped."""
+    COMPLETE = 'complete'
+    AUTO_MODE_OFF = 'auto mode off'
+    UNIT_MISMATCH = 'unit mismatch'
+    PAN_REMOVED = 'pan removed'
+
+
+# What happened in a run of trickler_loop(). start and end are Unix timestamps, peak_pwm is in percent.
+TrickleResult = collections.namedtuple('TrickleResult', 'reason start end iterations peak_pwm')
+
+
+def trickler_loop(settings, constants, pid, trickle_cascade, scale, target_weight, target_unit, recorder, loop_scheduler, cutoff_estimator=None): # pylint: disable=too-many-arguments;
+    """Main trickler control loop run when all devices are ready, target weight is set, and auto-mode is on.
+
+    The motors of the cascade.Cascade hand the charge from stage to stage as the remainder falls. With a
+    cutoff.CutoffEstimator, the motors stop once the predicted settled weight reaches the target, rather than
+    the reading. Returns a TrickleResult.
+    """
+    # The controllers run on the arrival times of the frames, from that of the reading trickling starts from.
+    frame_time = scale.timestamp / 1e9 if scale.timestamp is not None else time.monotonic()
+    # Handoffs are in ticks, so they mean the same in any unit.
+    target_ticks = int(target_weight / scale.resolution)
+    trickle_cascade.start(target_ticks, frame_time)
+    if recorder:
+        recorder.start_charge()
+        resolution = float(scale.resolution)
     logging.info('Starting trickling process...')
+    loop_scheduler.reset()
+    # Ticks without a period read the scale as before, waiting for each frame. Otherwise use the freshest reading.
+    block = not loop_scheduler.period
+    pid.last_time = frame_time
+    start = time.time()
+    reason = None
+    iterations = 0
+    peak_pwm = 0.0
+    if cutoff_estimator:
+        cutoff_estimator.start()
 
     # Note(eric): All `break` calls will exit the loop and this function.
-    while 1:
+    for now in loop_scheduler.ticks():
         # Stop running if auto mode is disabled.
-        if not memcache.get(constants.AUTO_MODE.value):
+        if not settings.get(constants.AUTO_MODE.value):
             logging.debug('auto mode disabled.')
+            reason = StopReason.AUTO_MODE_OFF
             break
 
         # Read scale values (weight/unit/stable)
-        scale.update()
+        scale.update(block)
+        loop_scheduler.phase('read')
 
         # Stop running if scale's unit no longer matches target unit.
         if scale.unit != target_unit:
             logging.debug('Target unit does not match scale unit.')
+            reason = StopReason.UNIT_MISMATCH
             break
 
         # Stop running if pan removed.
         if scale.weight < 0:
             logging.debug('Pan removed.')
+            reason = StopReason.PAN_REMOVED
             break
 
         remainder_weight = target_weight - scale.weight
         logging.debug('remainder_weight: %r', remainder_weight)
 
-        pidtune_logger.info(
-            '%s, %s, %s',
-            datetime.datetime.now().timestamp(),
-            trickler_motor1.speed,
-            scale.weight / target_weight)
+        # Stop early for the powder still in the air.
+        if cutoff_estimator and cutoff_estimator.update(now, scale.weight, trickle_cascade.total_speed, target_weight) and remainder_weight > 0:
+            logging.debug('Predicted settled weight reached the target, motor turned off and PID reset.')
+            reason = StopReason.COMPLETE
+            break
 
         # Trickling complete.
         if remainder_weight <= 0:
             logging.debug('Trickling complete, motor turned off and PID reset.')
+            reason = StopReason.COMPLETE
             break
 
         # PID controller requires float value instead of decimal.Decimal
-        pid.update(float(scale.weight / target_weight) * 100)
-        trickler_motor1.update(pid.output)
-        trickler_motor2.update(pid.output)
-        logging.debug('trickler_motor1.speed: %r, trickler_motor2.speed: %r, pid.output: %r', trickler_motor1.speed, trickler_motor2.speed, pid.output)
-        logging.info(
-            'remainder: %s %s scale: %s %s motor1: %s motor2: %s',
-            remainder_weight,
-            target_unit,
-            scale.weight,
-            scale.unit,
-            trickler_motor1.speed,
-            trickler_motor2.speed)
-
-        while remainder_weight <= 0.1:
-            trickler_motor2.off()
-            scale.update()
-            remainder_weight = target_weight - scale.weight
-            pid.update(float(scale.weight / target_weight) * 100)
-            trickler_motor1.update(pid.output)
-            logging.debug('trickler_motor1.speed: %r, trickler_motor2.speed: %r, pid.output: %r', trickler_motor1.speed, trickler_motor2.speed, pid.output)
+        feedback = float(scale.weight / target_weight) * 100
+        previous_time, frame_time = frame_time, scale.timestamp / 1e9
+        # A reading used again by a tick without a new frame adds nothing.
+        if frame_time > previous_time:
+            pid.update(feedback, frame_time)
+            iterations += 1
+        loop_scheduler.phase('compute')
+
+        # The stage of the cascade which is running, counting from 1.
+        phase = trickle_cascade.update(target_ticks - scale.ticks, feedback, frame_time) + 1
+        peak_pwm = max(peak_pwm, trickle_cascade.peak_speed)
+        loop_scheduler.phase('actuate')
+
+        if recorder:
+            recorder.record(
+                now,
+                scale.ticks,
+                target_ticks,
+                resolution,
+                pid,
+                trickle_cascade.speed('1'),
+                trickle_cascade.speed('2'),
+                phase)
+        logging.debug('stage: %r, pid.output: %r', phase, pid.output)
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            # The speeds are formatted now, since a queued record is only formatted once the tick has moved on.
             logging.info(
-                'remainder: %s %s scale: %s %s motor1: %s motor2: %s',
+                'remainder: %s %s scale: %s %s motors: %s',
                 remainder_weight,
                 target_unit,
                 scale.weight,
                 scale.unit,
-                trickler_motor1.speed,
-                trickler_motor2.speed)
-            if remainder_weight <= 0:
-                break
+                str(trickle_cascade))
+        loop_scheduler.phase('publish')
 
     # Clean up tasks.
-    trickler_motor1.off()
-    trickler_motor2.off()
+    trickle_cascade.off()
     # Clear PID values.
     pid.clear()
-    logging.info('Trickling process stopped.')
+    logging.info('Trickling process stopped, scale sample rate: %.1f frames/s', scale.sample_rate or 0)
+    logging.info('Control loop: %s', loop_scheduler.summary())
+    return TrickleResult(reason, start, time.time(), iterations, peak_pwm * 100)
 
 
-def main(config, memcache, args, pidtune_logger):
+def main(config, memcache, args, recorder):
     """Main trickler function. This runs everything."""
     constants = enum.Enum('memcache_vars', config['memcache_vars'])
 
     # Set up the PID controller.
-    pid = PID.PID(
-        float(config['PID']['Kp']),
-        float(config['PID']['Ki']),
-        float(config['PID']['Kd']))
+    pid = controller.from_config(config)
     logging.debug('pid: %r', pid)
 
-    # Set up the trickler motor controller.
-    trickler_motor1 = motors.TricklerMotor(1, config, memcache=memcache)
-    logging.debug('trickler_motor1: %r', trickler_motor1)
-    trickler_motor2 = motors.TricklerMotor(2, config, memcache=memcache)
-    logging.debug('trickler_motor2: %r', trickler_motor2)
+    # Set up the cascade of trickler motor controllers.
+    trickle_cascade = cascade.from_config(config, pid, lambda x: motors.TricklerMotor(x, config, memcache=memcache))
     servo_motor = motors.ServoMotor(config, memcache=memcache)
     logging.debug('servo_motor: %r', servo_motor)
 
-    # Set up the scale controller.
-    scale_cls = scales.SCALES[config['scale']['model']]
-    # Wait until the scale is ready.
+    # Set up the scale controller, using the cached profile when there is one.
+    # Wait until the scale is ready. A misconfigured scale raises ScaleMisconfigured instead of retrying forever.
     while 1:
         try:
-            scale = scale_cls(config, memcache=memcache)
+            scale = scales.connect(config, memcache=memcache)
         except scales.ScaleNotReady:
             logging.info('Scale not ready, trying again...')
             time.sleep(10)
         else:
             logging.debug('scale: %r', scale)
             break
+    loop_scheduler = scheduler.from_config(config)
+
+    def dump_metrics(*_):
+        scale.dump_metrics()
+        loop_scheduler.metrics.dump()
 
+    # Dump the scale I/O and control loop metrics on demand with: kill -USR1 <pid>
+    signal.signal(signal.SIGUSR1, dump_metrics)
+
+    # Settings changed by the app, screen and BLE are mirrored locally, so the control loop doesn't wait on memcache.
+    settings = state.mirror_settings(config, memcache, constants)
+    control_loop(settings, constants, pid, trickle_cascade, servo_motor, scale, args, recorder, loop_scheduler, charges.from_config(config), cutoff.from_config(config), dump.from_config(config),
+        calibration.from_config(config))
+
+
+def control_loop(settings, constants, pid, trickle_cascade, servo_motor, scale, args, recorder, loop_scheduler, charge_log=None, cutoff_estimator=None, dump_sequence=None, dump_calibration=None): # pylint: disable=too-many-arguments;
+    """Outer-most control loop for one trickler, which waits for a pan and target weight and runs trickler_loop()."""
+    dump_sequence = dump_sequence or dump.DumpSequence()
     # Set initial values in memcache.
-    memcache.set_multi({
+    settings.set_multi({
         constants.AUTO_MODE.value: args.auto_mode or False,
         constants.TARGET_WEIGHT.value: args.target_weight or decimal.Decimal('0.0'),
         constants.TARGET_UNIT.value: scale.unit_map.get(args.target_unit, 'GN'),
     })
+    # Save the scale and serial port the work of streaming until it's needed.
+    scale.set_output_mode(scale.idle_output_mode)
 
     # Outer-most control loop for the whole trickler system.
     while 1:
-        # Update settings from memcache.
-        auto_mode = memcache.get(constants.AUTO_MODE.value)
-        target_weight = memcache.get(constants.TARGET_WEIGHT.value)
-        target_unit = memcache.get(constants.TARGET_UNIT.value)
+        # Update settings from the local mirror of memcache.
+        auto_mode = settings.get(constants.AUTO_MODE.value)
+        target_weight = settings.get(constants.TARGET_WEIGHT.value)
+        target_unit = settings.get(constants.TARGET_UNIT.value)
         # Use percentages for PID control to avoid complexity w/ different units of weight.
         pid.SetPoint = 100.0
         scale.update()
+        settled_weight = scale.weight if scale.weight >= 0 else None
+        if charge_log:
+            # Complete the record of the last charge once the scale settles, or without a weight if the pan is gone.
+            charge_log.settled(settled_weight, scale.is_stable)
+        if cutoff_estimator:
+            # Learn how much powder was in the air from the settled weight of the last charge.
+            cutoff_estimator.settled(settled_weight, scale.is_stable)
 
         # Set scale to match target unit.
         if target_unit != scale.unit:
@@ -178,19 +250,28 @@ def main(config, memcache, args, pidtune_logger):
                 scale.unit == target_unit and
                 scale.is_stable and
                 auto_mode):
+            # Get frames from the scale as fast as it can send them while trickling.
+            scale.set_output_mode(scale.trickle_output_mode)
+            scale.reset_sample_rate()
+            dump_result = None
+            if dump_calibration:
+                # Dump as much as is safe for the powder, which is nothing if the pan is too close to the target.
+                command = dump_calibration.choose(target_weight, scale.weight, target_unit)
+                if command:
+                    dump_result = dump_sequence.run(scale, servo_motor, command.angle, command.dwell)
+                    dump_calibration.learn(dump_result, target_unit)
             # Stops the servo from dumping powder twice if the scale weight dips below the target weight
-            if ((target_weight - scale.weight) / target_weight) >= 0.5:
-                # Wait a second to dump powder and start trickling.
-                time.sleep(1)
-                logging.info('Starting powder dump...')
-                servo_motor.run_servo()
-                time.sleep(1.5)
-                servo_motor.set_initial_angle()
-                # Required since the larger powder drop hitting the cup may overshoot the weight until settling
-                time.sleep(1)
-                logging.info('Completed powder dump.')
+            elif ((target_weight - scale.weight) / target_weight) >= 0.5:
+                # Dump powder and start trickling once the scale has settled after the drop hits the cup.
+                dump_result = dump_sequence.run(scale, servo_motor)
             # Run trickler loop.
-            trickler_loop(memcache, constants, pid, trickler_motor1, trickler_motor2, scale, target_weight, target_unit, pidtune_logger)
+            result = trickler_loop(settings, constants, pid, trickle_cascade, scale, target_weight, target_unit, recorder, loop_scheduler, cutoff_estimator)
+            logging.info('Trickling stopped: %s after %d iterations', result.reason.value, result.iterations)
+            scale.set_output_mode(scale.idle_output_mode)
+            if charge_log:
+                charge_log.trickled(target_weight, target_unit.name, dump_result, result)
+            if cutoff_estimator:
+                cutoff_estimator.trickled(result.reason is StopReason.COMPLETE)
 
 
 if __name__ == '__main__':
@@ -225,20 +306,17 @@ if __name__ == '__main__':
     LOG_LEVEL = logging.INFO
     if VERBOSE:
         LOG_LEVEL = logging.DEBUG
-    helpers.setup_logging(LOG_LEVEL)
-
-    # Setup memcache.
-    memcache_client = helpers.get_mc_client()
+    helpers.setup_logging(LOG_LEVEL, config)
 
-    # Set up a separate logger for PID tuning with it's own format.
-    pidtune_logger = logging.getLogger('pid_tune')
-    pid_handler = logging.StreamHandler()
-    pid_handler.setFormatter(logging.Formatter('%(message)s'))
+    # Setup memcache, or the shared-memory state bus if configured.
+    memcache_client = helpers.get_state_client(config)
 
-    # Configure the log level based on if the tuner feature should be active.
-    pidtune_logger.setLevel(logging.ERROR)
-    if args.pid_tune or config['PID'].getboolean('pid_tuner_mode'):
-        pidtune_logger.setLevel(logging.INFO)
+    # Record control loop telemetry for PID tuning, exported for pidtuner.com with telemetry.py.
+    pid_tune = args.pid_tune or config['PID'].getboolean('pid_tuner_mode')
 
-    # Run the main trickler program.
-    main(config, memcache_client, args, pidtune_logger)
+    # Run one trickler per [station.X] section if there are any, otherwise the single trickler configured above.
+    import stations
+    if stations.station_names(config):
+        stations.run(config, args, pid_tune)
+    else:
+        main(config, memcache_client, args, telemetry.from_config(config, pid_tune))
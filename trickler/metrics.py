@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+
+Low-overhead histograms and counters for instrumenting the hot paths, dumped to the log on demand or periodically.
+"""
+
+import logging
+import math
+import time
+
+
+# Percentiles included in summaries and dumps.
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class Histogram:
+    """Log-linear histogram of non-negative integers, in the style of HdrHistogram. record() is O(1).
+
+    Values below 2**significant_bits are counted exactly, larger ones within 1/2**(significant_bits - 1) of their value.
+    """
+
+    def __init__(self, name, unit='', scale=1, significant_bits=7):
+        """Constructor. Values are divided by scale when displayed, such as 1e6 to show ns as ms."""
+        self.name = name
+        self.unit = unit
+        self.scale = scale
+        self._bits = significant_bits
+        self._half = 1 << (significant_bits - 1)
+        self._counts = [0] * (1 << significant_bits)
+        self.reset()
+
+    def reset(self):
+        """Forget all recorded values."""
+        self._counts[:] = [0] * (1 << self._bits)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def _index(self, value):
+        """Returns the bucket for a value."""
+        shift = value.bit_length() - self._bits
+        if shift <= 0:
+            return value
+        return shift * self._half + (value >> shift)
+
+    def _value(self, index):
+        """Returns the lowest value counted in a bucket."""
+        if index < 1 << self._bits:
+            return index
+        shift = index // self._half - 1
+        return (index - shift * self._half) << shift
+
+    def record(self, value):
+        """Count an integer value. Negative values are counted as zero."""
+        if value < 0:
+            value = 0
+        index = self._index(value)
+        counts = self._counts
+        if index >= len(counts):
+            counts.extend([0] * (index + 1 - len(counts)))
+        counts[index] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percentile):
+        """Returns the value at a percentile (0-100), or None if nothing was recorded."""
+        if not self.count:
+            return None
+        target = max(1, math.ceil(percentile / 100 * self.count))
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if seen >= target:
+                return min(max(self._value(index), self.min), self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        """Returns the mean of the recorded values, or None if nothing was recorded."""
+        return self.total / self.count if self.count else None
+
+    def summary(self):
+        """Returns a dict of the count, min, mean, percentiles and max, scaled for display."""
+        summary = {'count': self.count}
+        if not self.count:
+            return summary
+        summary['min'] = self.min / self.scale
+        summary['mean'] = self.mean / self.scale
+        for percentile in PERCENTILES:
+            summary[f'p{percentile:g}'] = self.percentile(percentile) / self.scale
+        summary['max'] = self.max / self.scale
+        return summary
+
+    def __str__(self):
+        summary = self.summary()
+        if not self.count:
+            return f'{self.name}: no values'
+        values = ' '.join(f'{k}={v:.3g}' for k, v in summary.items() if k != 'count')
+        return f'{self.name} ({self.unit}): n={self.count} {values}'
+
+
+class Metrics:
+    """A named set of histograms and counters, dumped to the log on demand and every interval seconds (0 for never)."""
+
+    def __init__(self, name, interval=0):
+        """Constructor."""
+        self.name = name
+        self.histograms = {}
+        self.counters = {}
+        self._interval = int(interval * 1e9)
+        self._next_dump = time.monotonic_ns() + self._interval
+
+    def histogram(self, key, unit='', scale=1):
+        """Returns a new Histogram included in this set."""
+        histogram = Histogram(key, unit, scale)
+        self.histograms[key] = histogram
+        return histogram
+
+    def count(self, key, count=1):
+        """Add to a counter."""
+        self.counters[key] = self.counters.get(key, 0) + count
+
+    def snapshot(self):
+        """Returns a dict of histogram summaries and counters."""
+        snapshot = {key: histogram.summary() for key, histogram in self.histograms.items()}
+        snapshot.update(self.counters)
+        return snapshot
+
+    def dump(self, level=logging.INFO):
+        """Log every histogram and counter."""
+        for histogram in self.histograms.values():
+            logging.log(level, '%s metrics: %s', self.name, histogram)
+        if self.counters:
+            logging.log(level, '%s metrics: %s', self.name, ' '.join(f'{k}={v}' for k, v in self.counters.items()))
+
+    def maybe_dump(self, now):
+        """Dump if the interval has passed since the last periodic dump. Cheap enough to call on every frame."""
+        if self._interval and now >= self._next_dump:
+            self._next_dump = now + self._interval
+            self.dump()
+
+    def reset(self):
+        """Forget all recorded values."""
+        for histogram in self.histograms.values():
+            histogram.reset()
+        self.counters.clear()
@@ -26,6 +26,8 @@ class TricklerMotor:
         self._memcache = kwargs.get('memcache')
         # Pull default values from config, giving preference to provided arguments.
         self._constants = enum.Enum('memcache_vars', dict(config['memcache_vars']))
+        # This motor's own speed is also published when [memcache_vars] has a key for it, such as for the simulator.
+        self._speed_key = config['memcache_vars'].get(f'TRICKLER_MOTOR_SPEED_{motor}')
 
         self.motor_pin = kwargs.get('motor_pin', config['motor' + str(motor)]['trickler_pin'])
         self.min_pwm = float(kwargs.get('min_pwm', config['motor' + str(motor)]['trickler_min_pwm']))
@@ -60,7 +62,10 @@ class TricklerMotor:
             logging.debug('Setting speed from %r to %r', self.speed, speed)
             self.pwm.value = speed
             if self._memcache:
-                self._memcache.set(self._constants.TRICKLER_MOTOR_SPEED.value, self.speed)
+                values = {self._constants.TRICKLER_MOTOR_SPEED.value: self.speed}
+                if self._speed_key:
+                    values[self._speed_key] = self.speed
+                self._memcache.set_multi(values)
         else:
             logging.debug('invalid motor speed: %r must be between 0 and 1.', speed)
 
@@ -111,9 +116,10 @@ class ServoMotor:
         pulse_width = self.min_pulse_width + (self.initial_angle / self.max_angle) * (self.max_pulse_width - self.min_pulse_width)
         self.servo.set_servo_pulsewidth(self.servo_pin, pulse_width)
 
-    def run_servo(self):
-        """Moves servo to wanted angle."""
-        pulse_width = self.min_pulse_width + (self.servo_angle / self.max_angle) * (self.max_pulse_width - self.min_pulse_width)
+    def run_servo(self, angle=None):
+        """Moves servo to wanted angle, by default servo_angle."""
+        angle = self.servo_angle if angle is None else min(max(float(angle), 0.0), self.max_angle)
+        pulse_width = self.min_pulse_width + (angle / self.max_angle) * (self.max_pulse_width - self.min_pulse_width)
         self.servo.set_servo_pulsewidth(self.servo_pin, pulse_width)
             
     def off(self):
@@ -192,8 +198,8 @@ if __name__ == '__main__':
         LOG_LEVEL = logging.DEBUG
     helpers.setup_logging(LOG_LEVEL)
 
-    # Setup memcache.
-    memcache_client = helpers.get_mc_client()
+    # Setup memcache, or the shared-memory state bus if configured.
+    memcache_client = helpers.get_state_client(config)
 
     # Create a TricklerMotor instance and then run it at different speeds.
     motor = TricklerMotor(
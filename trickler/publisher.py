@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+
+Change-driven, rate-limited publication of values to memcache, off the control thread.
+"""
+
+import atexit
+import logging
+import threading
+import time
+
+
+# Marker for keys that have never been published.
+_MISSING = object()
+
+
+class MemcachePublisher: # pylint: disable=too-many-instance-attributes;
+    """Publishes snapshots of values to memcache from a background thread, sending only what changed.
+
+    Changes are batched into one set_multi() and sent at most max_rate times per second, with newer values replacing
+    older unsent ones. A change to any of the urgent keys is sent right away, along with anything else pending.
+    """
+
+    def __init__(self, memcache, max_rate=20.0, urgent_keys=()):
+        """Constructor."""
+        self._memcache = memcache
+        self._interval = 1.0 / max_rate if max_rate else 0.0
+        self._urgent_keys = frozenset(urgent_keys)
+        # Last value handed over for each key, used by the caller's thread to skip unchanged values.
+        self._submitted = {}
+        # Values waiting to be written, guarded by the condition.
+        self._pending = {}
+        self._urgent = False
+        self._stopping = False
+        self._next_send = 0.0
+        self._condition = threading.Condition()
+        # Counters of keys written, skipped as unchanged, and replaced before they were written.
+        self.sent = 0
+        self.suppressed = 0
+        self.coalesced = 0
+        self.batches = 0
+        self.errors = 0
+        self._failing = False
+        self._thread = threading.Thread(target=self._run, name='memcache-publisher', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def publish(self, values):
+        """Queue the changed values from a dict of key/values. Never blocks on memcache."""
+        changed = {}
+        for key, value in values.items():
+            if self._submitted.get(key, _MISSING) == value:
+                continue
+            changed[key] = value
+        self.suppressed += len(values) - len(changed)
+        if not changed:
+            return
+        self._submitted.update(changed)
+        with self._condition:
+            self.coalesced += sum(1 for key in changed if key in self._pending)
+            self._pending.update(changed)
+            if not self._urgent_keys.isdisjoint(changed):
+                self._urgent = True
+            self._condition.notify()
+
+    def skip(self, count):
+        """Count values that the caller already knows are unchanged."""
+        self.suppressed += count
+
+    def flush(self):
+        """Ask for pending values to be written right away."""
+        with self._condition:
+            self._urgent = True
+            self._condition.notify()
+
+    def close(self):
+        """Write anything pending and stop the background thread."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        self._thread.join(timeout=2)
+
+    @property
+    def stats(self):
+        """Returns a dict of publication counters."""
+        return {
+            'sent': self.sent,
+            'suppressed': self.suppressed,
+            'coalesced': self.coalesced,
+            'batches': self.batches,
+            'errors': self.errors,
+        }
+
+    def _next_batch(self):
+        """Waits until a batch is due and returns it, or None when stopping with nothing left to send."""
+        with self._condition:
+            while 1:
+                if not self._pending:
+                    if self._stopping:
+                        return None
+                    self._condition.wait()
+                    continue
+                delay = self._next_send - time.monotonic()
+                if delay <= 0 or self._urgent or self._stopping:
+                    break
+                self._condition.wait(delay)
+            batch = self._pending
+            self._pending = {}
+            self._urgent = False
+            return batch
+
+    def _run(self):
+        """Background thread which writes batches to memcache."""
+        while 1:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self._next_send = time.monotonic() + self._interval
+            try:
+                self._memcache.set_multi(batch)
+            except Exception: # pylint: disable=broad-except;
+                self.errors += 1
+                if not self._failing:
+                    # Only log the first failure in a row, the batch is retried until memcache is back.
+                    logging.exception('Failed to publish %r to memcache, will keep retrying.', sorted(batch))
+                    self._failing = True
+                with self._condition:
+                    # Put the batch back without overwriting anything newer.
+                    batch.update(self._pending)
+                    self._pending = batch
+                continue
+            if self._failing:
+                logging.info('Publishing to memcache again after %d failures.', self.errors)
+                self._failing = False
+            self.sent += len(batch)
+            self.batches += 1
@@ -7,16 +7,27 @@ OpenTrickler
 https://github.com/ammolytics/projects/tree/develop/trickler
 """
 
+import asyncio
 import atexit
 import collections
+import concurrent.futures
 import decimal
 import enum
+import glob
+import io
+import json
 import logging
+import os
+import struct
+import threading
 import time
 
 import serial # pylint: disable=import-error;
 
 import helpers
+import metrics
+import publisher
+import stability
 
 
 class ScaleException(Exception):
@@ -27,11 +38,412 @@ class ScaleNotReady(ScaleException):
     """Scale not ready."""
 
 
+class ScaleMisconfigured(ScaleException):
+    """Scale is sending data which doesn't parse with the configured model and baud rate."""
+
+
+class ScaleCommandError(ScaleException):
+    """Scale rejected a command, didn't answer it in time, or doesn't support it."""
+
+
 def noop(*args, **kwargs):
     """No-op function for scales to use on throwaway status updates."""
     return
 
 
+# Capture files start with a header of CAPTURE_MAGIC, a format version and the length of the scale model name, then
+# the model name. After that, each record is a monotonic timestamp (ns), a direction (CAPTURE_FROM_SCALE or
+# CAPTURE_TO_SCALE) and the length of the raw bytes which follow.
+CAPTURE_MAGIC = b'OTCAP'
+CAPTURE_VERSION = 1
+CAPTURE_HEADER = struct.Struct('<5sBB')
+CAPTURE_RECORD = struct.Struct('<QBH')
+CAPTURE_FROM_SCALE = 0
+CAPTURE_TO_SCALE = 1
+# Ports starting with this are capture files to replay, such as replay:/var/tmp/session.otcap
+REPLAY_PREFIX = 'replay:'
+# Grains in a gram, for converting between the units of the scales.
+GRAINS_PER_GRAM = 15.4323584
+
+
+class OutputMode(enum.Enum):
+    """How the scale sends frames."""
+    # Continuously, at the scale's fastest rate.
+    STREAM = 'stream'
+    # Only when asked, see SerialScale.poll_command.
+    POLL = 'poll'
+
+
+class Frame(collections.namedtuple('Frame', 'status unit counts exponent ticks text')):
+    """Parsed contents of a single frame from the scale.
+
+    The weight is kept as fixed-point integers: counts * 10**exponent as printed by the scale, and ticks, the
+    nearest integer count of the scale resolution for that unit. Frames without a weight have None for both.
+    """
+    __slots__ = ()
+
+    @property
+    def weight(self):
+        """Returns the weight as a decimal.Decimal, which is only built when asked for."""
+        if self.counts is None:
+            return None
+        return decimal.Decimal(self.counts).scaleb(self.exponent)
+
+
+class Reading(collections.namedtuple('Reading', 'status unit counts exponent ticks timestamp')):
+    """Immutable record of the scale state after a frame, stamped with its arrival time (monotonic ns)."""
+    __slots__ = ()
+
+    @property
+    def weight(self):
+        """Returns the weight as a decimal.Decimal, which is only built when asked for."""
+        if self.counts is None:
+            return None
+        return decimal.Decimal(self.counts).scaleb(self.exponent)
+
+    @property
+    def is_stable(self):
+        """Returns True if the scale was stable, otherwise False."""
+        return self.status is not None and self.status.name == 'STABLE'
+
+
+# Lookup tables used by the frame parser, built once per scale class.
+FrameTables = collections.namedtuple('FrameTables', 'units statuses weighing resolutions')
+_FRAME_TABLES = {}
+
+
+def unit_field_keys(name, width):
+    """Returns every space-padded form of a unit name that fits into a fixed-width unit field."""
+    raw = name.encode('ascii')
+    keys = [raw]
+    for left in range(max(width - len(raw), 0) + 1):
+        keys.append(b' ' * left + raw + b' ' * (width - len(raw) - left))
+    return keys
+
+
+def to_ticks(counts, exponent, coefficient, resolution_exponent):
+    """Converts a fixed-point weight to the nearest integer count of a resolution (coefficient * 10**exponent)."""
+    shift = exponent - resolution_exponent
+    numerator = counts * 10 ** max(shift, 0)
+    denominator = coefficient * 10 ** max(-shift, 0)
+    return (2 * numerator + denominator) // (2 * denominator)
+
+
+class ScaleCommand: # pylint: disable=too-few-public-methods;
+    """A command for the scale, completed by the first frame which satisfies done(frame)."""
+
+    def __init__(self, name, payload, done, timeout, retries):
+        """Constructor."""
+        self.name = name
+        self.payload = payload
+        self.done = done
+        self.timeout = timeout
+        self.retries = retries
+        self.attempts = 0
+        self.deadline = None
+        self.future = concurrent.futures.Future()
+
+
+class CommandQueue:
+    """Sends commands to the scale one at a time and completes them from the frames that follow.
+
+    Each command's future gets the completing Frame as its result, or a ScaleCommandError if the scale reports an
+    error or the command runs out of retries.
+    """
+
+    def __init__(self, write, error_status):
+        """Constructor. write sends bytes to the scale, error_status is the status of an error frame."""
+        self._write = write
+        self._error_status = error_status
+        self._queue = collections.deque()
+        self._lock = threading.Lock()
+
+    @property
+    def active(self):
+        """Returns True while any command is queued or waiting on the scale."""
+        return bool(self._queue)
+
+    def pending(self, name):
+        """Returns the future of a queued command with this name, or None."""
+        with self._lock:
+            for command in self._queue:
+                if command.name == name:
+                    return command.future
+        return None
+
+    def submit(self, command):
+        """Queue a command, sending it right away if the scale isn't busy with another. Returns its future."""
+        with self._lock:
+            self._queue.append(command)
+            if len(self._queue) == 1:
+                self._send(command)
+        return command.future
+
+    def _send(self, command):
+        """Write a command to the scale and start its timeout. Called with the lock held."""
+        command.attempts += 1
+        command.deadline = time.monotonic() + command.timeout
+        logging.debug('Sending scale command %s (attempt %d): %r', command.name, command.attempts, command.payload)
+        self._write(command.payload + b'\r\n')
+
+    def _finish(self, result=None, exception=None):
+        """Remove the command in flight, send the next one, and return the finished command. Lock must be held."""
+        command = self._queue.popleft()
+        if self._queue:
+            self._send(self._queue[0])
+        return command, result, exception
+
+    def on_frame(self, frame):
+        """Complete the command in flight if this frame answers it, then check its timeout."""
+        finished = None
+        with self._lock:
+            if not self._queue:
+                return
+            command = self._queue[0]
+            if frame.status is self._error_status:
+                finished = self._finish(exception=ScaleCommandError(
+                    f'Scale rejected {command.name} command: {frame.text or "error"}'))
+            elif command.done(frame):
+                finished = self._finish(result=frame)
+        if finished:
+            self._resolve(*finished)
+        else:
+            self.poll()
+
+    def poll(self):
+        """Resend or fail the command in flight if the scale hasn't answered it in time."""
+        finished = None
+        with self._lock:
+            if not self._queue or time.monotonic() < self._queue[0].deadline:
+                return
+            command = self._queue[0]
+            if command.attempts <= command.retries:
+                logging.info('Scale did not answer %s command in %rs, retrying.', command.name, command.timeout)
+                self._send(command)
+                return
+            finished = self._finish(exception=ScaleCommandError(
+                f'Scale did not answer {command.name} command after {command.attempts} attempts.'))
+        self._resolve(*finished)
+
+    @staticmethod
+    def _resolve(command, result, exception):
+        """Complete a command's future, outside of the lock so callbacks can submit more commands."""
+        if exception is not None:
+            logging.info('%s', exception)
+            command.future.set_exception(exception)
+        else:
+            logging.debug('Scale command %s completed after %d attempt(s).', command.name, command.attempts)
+            command.future.set_result(result)
+
+
+class CaptureWriter:
+    """Appends every raw frame to a capture file, along with its arrival time."""
+
+    def __init__(self, path, model):
+        """Constructor."""
+        if os.path.exists(path) and os.path.getsize(path):
+            existing = CaptureReader(path).model
+            if existing != model:
+                raise ScaleException(f'Capture file {path} holds a {existing} scale, not {model}.')
+            self._file = open(path, 'ab') # pylint: disable=consider-using-with;
+        else:
+            self._file = open(path, 'ab') # pylint: disable=consider-using-with;
+            name = model.encode('ascii')
+            self._file.write(CAPTURE_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, len(name)) + name)
+        self.path = path
+        self.records = 0
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def write(self, timestamp, raw, direction=CAPTURE_FROM_SCALE):
+        """Append a record. Safe to call from the reader thread and the control thread."""
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(CAPTURE_RECORD.pack(timestamp, direction, len(raw)) + raw)
+            self.records += 1
+
+    def close(self):
+        """Flush and close the capture file."""
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+                logging.info('Captured %d records to %s', self.records, self.path)
+
+
+class CaptureReader:
+    """Reads a capture file, yielding (timestamp, direction, raw) records."""
+
+    def __init__(self, path):
+        """Constructor, reads the header."""
+        self.path = path
+        with open(path, 'rb') as capture_file:
+            magic, version, length = CAPTURE_HEADER.unpack(capture_file.read(CAPTURE_HEADER.size))
+            if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+                raise ScaleException(f'{path} is not a version {CAPTURE_VERSION} capture file.')
+            self.model = capture_file.read(length).decode('ascii')
+            self._offset = capture_file.tell()
+
+    def __iter__(self):
+        with open(self.path, 'rb') as capture_file:
+            capture_file.seek(self._offset)
+            while 1:
+                header = capture_file.read(CAPTURE_RECORD.size)
+                if len(header) < CAPTURE_RECORD.size:
+                    # End of file, or a record cut short by a crash while capturing.
+                    return
+                timestamp, direction, length = CAPTURE_RECORD.unpack(header)
+                raw = capture_file.read(length)
+                if len(raw) < length:
+                    return
+                yield timestamp, direction, raw
+
+
+class ReplaySerial:
+    """Stands in for serial.Serial, reading frames back from a capture file with their original timing.
+
+    speed is a multiple of real time, or 0 to replay as fast as frames are read. Writes are ignored.
+    """
+
+    def __init__(self, path, speed=1.0, timeout=0.1):
+        """Constructor."""
+        self.port = REPLAY_PREFIX + path
+        self.baudrate = 0
+        self.timeout = timeout
+        self.speed = speed
+        self.finished = False
+        # Frames thrown away by reset_input_buffer(), like a real port would.
+        self.discarded = 0
+        self._records = (x for x in CaptureReader(path) if x[1] == CAPTURE_FROM_SCALE)
+        self._next = next(self._records, None)
+        self._first = self._next[0] if self._next else 0
+        self._start = None
+        self._buffer = b''
+
+    def _due(self, record):
+        """Returns the monotonic time (seconds) a record is due to arrive."""
+        return self._start + (record[0] - self._first) / 1e9 / self.speed
+
+    def _advance(self):
+        """Returns the raw bytes of the next record and moves on."""
+        raw = self._next[2]
+        self._next = next(self._records, None)
+        if self._next is None:
+            self.finished = True
+            logging.info('Replay of %s finished.', self.port)
+        return raw
+
+    def readline(self):
+        """Returns the next frame once it is due, or b'' if it isn't due within the timeout."""
+        if self._buffer:
+            raw, self._buffer = self._buffer, b''
+            return raw
+        if self._next is None:
+            time.sleep(self.timeout or 0)
+            return b''
+        if not self.speed:
+            return self._advance()
+        if self._start is None:
+            self._start = time.monotonic()
+        wait = self._due(self._next) - time.monotonic()
+        if wait > (self.timeout or 0):
+            time.sleep(self.timeout or 0)
+            return b''
+        if wait > 0:
+            time.sleep(wait)
+        return self._advance()
+
+    def read(self, size=1):
+        """Returns up to size bytes of the next frame."""
+        data = self._buffer or self.readline()
+        self._buffer = data[size:]
+        return data[:size]
+
+    @property
+    def in_waiting(self):
+        """Returns the number of bytes which have arrived and not been read."""
+        if self._buffer:
+            return len(self._buffer)
+        if self._next is None or self._start is None:
+            return 0
+        if not self.speed or self._due(self._next) <= time.monotonic():
+            return len(self._next[2])
+        return 0
+
+    def reset_input_buffer(self):
+        """Throws away frames which are already due, unless replaying as fast as possible."""
+        self._buffer = b''
+        if not self.speed or self._start is None:
+            return
+        now = time.monotonic()
+        while self._next is not None and self._due(self._next) <= now:
+            self._advance()
+            self.discarded += 1
+
+    def write(self, data):
+        """Ignores commands, since the capture can't respond to them."""
+        logging.debug('Replay ignoring write: %r', data)
+        return len(data)
+
+    def fileno(self):
+        """Capture files can't be registered with an event loop."""
+        raise io.UnsupportedOperation('Replayed scales have no file descriptor.')
+
+    def close(self):
+        """Stop replaying."""
+        self._next = None
+
+
+class FrameBuffer:
+    """Bounded ring buffer of timestamped raw frames, filled by a reader thread and drained by update()."""
+
+    def __init__(self, length):
+        """Constructor."""
+        self._frames = collections.deque(maxlen=length)
+        self._condition = threading.Condition()
+        # Frames pushed into the buffer by the reader.
+        self.received = 0
+        # Frames pushed out of the full buffer before anyone read them.
+        self.overwritten = 0
+        # Frames skipped over because a newer one was available when read.
+        self.dropped = 0
+
+    def push(self, timestamp, raw):
+        """Store a raw frame along with its arrival timestamp (ns), overwriting the oldest one when full."""
+        with self._condition:
+            if len(self._frames) == self._frames.maxlen:
+                self.overwritten += 1
+            self._frames.append((timestamp, raw))
+            self.received += 1
+            self._condition.notify_all()
+
+    def latest(self, timeout=None):
+        """Returns the newest unread (timestamp, raw) frame, waiting up to timeout seconds for one to arrive.
+
+        Older unread frames are discarded and counted as dropped. Returns None if nothing arrived in time.
+        """
+        with self._condition:
+            if not self._frames:
+                self._condition.wait(timeout)
+            if not self._frames:
+                return None
+            frame = self._frames.pop()
+            self.dropped += len(self._frames)
+            self._frames.clear()
+            return frame
+
+    @property
+    def stats(self):
+        """Returns a dict of frame counters."""
+        with self._condition:
+            return {
+                'received': self.received,
+                'overwritten': self.overwritten,
+                'dropped': self.dropped,
+                'buffered': len(self._frames),
+            }
+
+
 class SerialScale: # pylint: disable=too-many-instance-attributes;
     """Base class for a digital scale connected over a serial port."""
 
@@ -50,50 +462,461 @@ class SerialScale: # pylint: disable=too-many-instance-attributes;
         SERIAL_NUMBER = 5
         ACKNOWLEDGE = 6
 
+    # Frame prefixes which carry a status, mapped to StatusMap names. Override this in subclasses when needed.
+    status_codes = {}
+    # Frame prefixes from status_codes which are followed by a weight.
+    weighing_codes = ()
+    # Width of the fixed unit field in a frame.
+    unit_field_width = 2
+    # Commands supported over the serial port, as bytes without the line ending. Override this in subclasses.
+    command_codes = {}
+    # Commands which switch the scale into each OutputMode, and the command asking for one frame in POLL mode.
+    output_modes = {}
+    poll_command = None
+    # Baud rates used by the supported models, as listed in the class docstring, most common first.
+    baudrates = (9600,)
+
     def __init__(self, config, **kwargs):
         """Base scale class constructor. Should not usually need to be overridden."""
         # Store memcache client if provided.
         self._memcache = kwargs.get('memcache')
         # Pull default values from config, giving preference to provided arguments.
         self._constants = enum.Enum('memcache_vars', dict(config['memcache_vars']))
-
-        # Set up crash protection that closes the serial port so the program can restart.
-        atexit.register(self._graceful_exit)
+        # Scale values are published from a background thread, and only when they change.
+        self._publisher = None
+        self._published_state = None
+        if self._memcache:
+            self._publisher = publisher.MemcachePublisher(
+                self._memcache,
+                max_rate=float(kwargs.get('publish_max_rate', config['scale'].get('publish_max_rate', 20))),
+                # Status changes are flushed immediately, so the other daemons never see a stale status.
+                urgent_keys=(self._constants.SCALE_STATUS.value, self._constants.SCALE_IS_STABLE.value))
+        # Background reader state, only used when reader_thread is enabled.
+        self._frames = None
+        self._reader_thread = None
+        self._reader_stop = threading.Event()
+        self._capture = None
+
+        # Instrumentation of the scale I/O, see dump_metrics().
+        self.metrics = metrics.Metrics(
+            'scale', float(kwargs.get('metrics_interval', config['scale'].get('metrics_interval', 0))))
+        self._inter_frame = self.metrics.histogram('inter_frame', 'ms', 1e6)
+        self._read_wait = self.metrics.histogram('read_wait', 'ms', 1e6)
+        self._parse_time = self.metrics.histogram('parse', 'us', 1e3)
+        self._discarded = self.metrics.histogram('discarded', 'frames')
+        self._reading_age = self.metrics.histogram('reading_age', 'ms', 1e6)
+        self._last_arrival = None
+        # Frames and the arrival of the first one since the sample rate was last reset, see sample_rate.
+        self._rate_frames = 0
+        self._rate_first = None
+        self._frame_length = None
 
         # Set up the internal serial port connection.
         port = kwargs.get('port', config['scale']['port'])
         baudrate = kwargs.get('baudrate', int(config['scale']['baudrate']))
         timeout = kwargs.get('timeout', float(config['scale']['timeout']))
+        self._timeout = timeout
         try:
-            self._serial = serial.Serial(port=port, baudrate=baudrate, timeout=timeout)
+            if kwargs.get('serial_port') is not None:
+                # An already open serial-like object, such as the digital twin's physics model (see twin.py).
+                self._serial = kwargs['serial_port']
+            elif port.startswith(REPLAY_PREFIX):
+                speed = float(kwargs.get('replay_speed', config['scale'].get('replay_speed', 1.0)))
+                self._serial = ReplaySerial(port[len(REPLAY_PREFIX):], speed=speed, timeout=timeout)
+            else:
+                self._serial = serial.Serial(port=port, baudrate=baudrate, timeout=timeout)
         except (serial.SerialException, FileNotFoundError) as exc:
             logging.exception('Scale is not ready! The error traceback follows for context.')
             raise ScaleNotReady() from exc
+        # Set up crash protection that closes the serial port so the program can restart.
+        atexit.register(self._graceful_exit)
+
+        # Optionally record every raw frame, to replay later with a replay: port.
+        capture_file = kwargs.get('capture_file', config['scale'].get('capture_file', ''))
+        if capture_file:
+            self._capture = CaptureWriter(capture_file, model_name(type(self)))
+
+        # Commands are written right away and completed by the frames that follow, so nothing waits on the scale.
+        self._commands = CommandQueue(self._write, self.StatusMap.ERROR)
+        self._command_timeout = float(kwargs.get('command_timeout', config['scale'].get('command_timeout', 2.0)))
+        self._command_retries = int(kwargs.get('command_retries', config['scale'].get('command_retries', 1)))
 
         # Set default values, which should be overwritten quickly.
         self.unit = self.Units.GRAINS
         self.resolution = self.resolution_map[self.unit]
-        self.weight = decimal.Decimal('0.00')
+        # The weight is stored as fixed-point integers and only turned into a decimal.Decimal when read.
+        self._counts = 0
+        self._exponent = -2
+        self._weight = None
+        self.ticks = 0
         self.status = self.StatusMap.STABLE
+        # Arrival time (monotonic ns) of the most recent frame.
+        self.timestamp = None
+        # Event loop reader shared by every stream() subscriber, created on first use.
+        self._stream = None
+        self._stream_policy = kwargs.get('stream_policy', config['scale'].get('stream_policy', 'latest'))
+        self._stream_length = int(kwargs.get('stream_queue_length', config['scale'].get('stream_queue_length', 64)))
+        # Output modes used while trickling and when idle, for scales which support switching them.
+        self.output_mode = None
+        self.trickle_output_mode = self._output_mode_setting(
+            kwargs.get('trickle_output_mode', config['scale'].get('trickle_output_mode', '')))
+        self.idle_output_mode = self._output_mode_setting(
+            kwargs.get('idle_output_mode', config['scale'].get('idle_output_mode', '')))
+        self._poll_interval = float(kwargs.get('idle_poll_interval', config['scale'].get('idle_poll_interval', 0.25)))
+        self._next_poll = 0.0
         self._store_scale_config()
-        # Internal storage for scale readings to infer stability, used for scales that don't provide it.
-        self._readings = collections.deque(maxlen=int(config['scale']['stable_reading_length']))
+        # Stability detector, used for scales that don't provide it or when configured to override the scale.
+        self._stability = stability.from_config(config, **kwargs)
+        self._override_stability = kwargs.get(
+            'override_scale_stability', config['scale'].getboolean('override_scale_stability', False))
+
+        # Optionally drain the serial port from a background thread so that no frames are thrown away.
+        self._frame_buffer_length = int(
+            kwargs.get('frame_buffer_length', config['scale'].get('frame_buffer_length', 16)))
+        self._partial = b''
+        if kwargs.get('reader_thread', config['scale'].getboolean('reader_thread', False)):
+            self.buffer_frames()
+            self._reader_thread = threading.Thread(target=self._read_forever, name='scale-reader', daemon=True)
+            self._reader_thread.start()
 
     def _update_memcache(self):
         """ Update memcache values if the memcache client has been provided."""
-        if self._memcache:
-            self._memcache.set_multi({
-                self._constants.SCALE_STATUS.value: self.status,
-                self._constants.SCALE_WEIGHT.value: self.weight,
-                self._constants.SCALE_UNIT.value: self.unit,
-                self._constants.SCALE_RESOLUTION.value: self.resolution,
-                self._constants.SCALE_IS_STABLE.value: self.is_stable,
-            })
+        if not self._publisher:
+            return
+        state = (self.status, self._counts, self._exponent, self.unit)
+        if state == self._published_state:
+            # Nothing changed since the last frame, skip building the snapshot.
+            self._publisher.skip(5)
+            return
+        self._published_state = state
+        self._publisher.publish({
+            self._constants.SCALE_STATUS.value: self.status,
+            self._constants.SCALE_WEIGHT.value: self.weight,
+            self._constants.SCALE_UNIT.value: self.unit,
+            self._constants.SCALE_RESOLUTION.value: self.resolution,
+            self._constants.SCALE_IS_STABLE.value: self.is_stable,
+        })
+
+    @property
+    def publish_stats(self):
+        """Returns memcache publication counters, or None without a memcache client."""
+        if self._publisher:
+            return self._publisher.stats
+        return None
 
     def _graceful_exit(self):
-        """Graceful exit, closes serial port."""
+        """Graceful exit, stops the reader thread and closes serial port."""
+        self._reader_stop.set()
+        if self._reader_thread:
+            self._reader_thread.join(timeout=self._timeout * 2)
+        if self._frames:
+            logging.debug('Scale reader frame stats: %r', self.frame_stats)
+        logging.debug('Scale metrics: %r', self.metrics.snapshot())
+        if self._publisher:
+            self._publisher.close()
+            logging.debug('Scale memcache publish stats: %r', self.publish_stats)
+        if self.output_mode not in (None, OutputMode.STREAM) and OutputMode.STREAM in self.output_modes:
+            # Leave the scale streaming, as it powers on, so the next start doesn't find it silent.
+            logging.debug('Switching the scale back to stream output mode...')
+            try:
+                self._write(self.command_codes[self.output_modes[OutputMode.STREAM]] + b'\r\n')
+                self._serial.flush()
+            except (serial.SerialException, OSError):
+                logging.debug('Could not switch the scale back to stream output mode.', exc_info=True)
         logging.debug('Closing serial port...')
         self._serial.close()
+        if self._capture:
+            self._capture.close()
+
+    def close(self):
+        """Stops the reader thread and closes the serial port, for scales which are no longer needed."""
+        atexit.unregister(self._graceful_exit)
+        self._graceful_exit()
+
+    def verify(self, frames=2, timeout=2.0):
+        """Waits for frames which parse, raising ScaleNotReady if the scale is silent or ScaleMisconfigured if what
+        arrives doesn't parse, such as at the wrong baud rate or for the wrong model.
+
+        A scale which is silent for half the timeout is polled for readings, in case it was left in POLL mode, and is
+        switched back to streaming if it answers.
+        """
+        start = time.monotonic()
+        deadline = start + timeout
+        received = 0
+        parsed = 0
+        polling = False
+        # Give up early once it's clear that what arrives won't parse.
+        while parsed < frames and received - parsed < 10 and time.monotonic() < deadline:
+            if (not received and not polling and self.output_mode is None and OutputMode.POLL in self.output_modes
+                    and time.monotonic() >= start + timeout / 2):
+                logging.info('No data from %s yet, polling in case the scale was left in poll mode.', self._serial.port)
+                polling = True
+                self.output_mode = OutputMode.POLL
+            frame = self._read_frame()
+            if frame is None or not frame[1].strip():
+                continue
+            received += 1
+            if self._handle_frame(frame[1], frame[0]) is not None:
+                parsed += 1
+        if parsed >= frames:
+            if polling:
+                self.set_output_mode(OutputMode.STREAM)
+            return
+        if polling:
+            self.output_mode = None
+        if received:
+            raise ScaleMisconfigured(
+                f'Received {received} frames from {self._serial.port} at {self._serial.baudrate} baud but only '
+                f'{parsed} parsed as a {type(self).__name__}. Check the [scale] model and baudrate settings.')
+        raise ScaleNotReady(f'No data from {self._serial.port} in {timeout}s, is the scale on?')
+
+    def _read_forever(self):
+        """Background reader loop which pushes every complete line from the serial port into the frame buffer."""
+        partial = b''
+        while not self._reader_stop.is_set():
+            try:
+                raw = self._serial.readline()
+            except (serial.SerialException, OSError, TypeError):
+                if self._reader_stop.is_set():
+                    break
+                logging.exception('Scale reader failed to read from the serial port.')
+                self._reader_stop.wait(self._timeout)
+                continue
+            if self._commands.active:
+                self._commands.poll()
+            if not raw:
+                continue
+            # A read timeout can split a line in two, so hold on to the start until the rest arrives.
+            if not raw.endswith(b'\n'):
+                partial += raw
+                continue
+            raw = partial + raw
+            partial = b''
+            self._push_frame(time.monotonic_ns(), raw)
+
+    def buffer_frames(self):
+        """Have update() read frames from a buffer filled by a background reader, rather than from the serial port."""
+        if self._frames is None:
+            self._frames = FrameBuffer(self._frame_buffer_length)
+
+    def fileno(self):
+        """Returns the file descriptor of the serial port, for use with selectors."""
+        return self._serial.fileno()
+
+    def read_available(self):
+        """Buffer the complete frames among whatever has arrived on the serial port, for readers which wait on many
+        scales at once with a selector (see stations.ScaleMultiplexer). Only blocks if nothing has arrived."""
+        data = self._serial.read(self._serial.in_waiting or 1)
+        if not data:
+            return
+        timestamp = time.monotonic_ns()
+        self._partial += data
+        while 1:
+            end = self._partial.find(b'\n')
+            if end < 0:
+                break
+            raw = self._partial[:end + 1]
+            self._partial = self._partial[end + 1:]
+            self._push_frame(timestamp, raw)
+
+    def poll_commands(self):
+        """Resend or time out the command in flight, for readers which don't call update()."""
+        if self._commands.active:
+            self._commands.poll()
+
+    def _push_frame(self, timestamp, raw):
+        """Hand a complete raw frame from a background reader over to update()."""
+        self._arrived(timestamp, raw)
+        if self._commands.active:
+            # Replies to commands must not be lost when update() skips to the newest frame.
+            self._match_command(raw)
+        self._frames.push(timestamp, raw)
+
+    def _arrived(self, timestamp, raw):
+        """Record the arrival of a raw frame, called once for every frame read from the scale."""
+        if self._last_arrival is not None:
+            self._inter_frame.record(timestamp - self._last_arrival)
+        self._last_arrival = timestamp
+        if self._rate_first is None:
+            self._rate_first = timestamp
+        self._rate_frames += 1
+        self._frame_length = len(raw)
+        if self._capture:
+            self._capture.write(timestamp, raw)
+
+    def _write(self, data):
+        """Write bytes to the scale, recording them in the capture file if there is one."""
+        if self._capture:
+            self._capture.write(time.monotonic_ns(), data, CAPTURE_TO_SCALE)
+        self._serial.write(data)
+
+    def _match_command(self, raw):
+        """Check a raw frame against the command in flight, without updating this instance."""
+        try:
+            frame = self._parse_frame(raw)
+        except (KeyError, ValueError):
+            return
+        if frame is not None:
+            self._commands.on_frame(frame)
+
+    def _read_frame(self, block=True):
+        """Returns the next (timestamp, raw) frame from the scale, or None if one was not available in time.
+
+        Without block, only a frame which has already arrived is returned.
+        """
+        if self._frames:
+            dropped = self._frames.dropped
+            start = time.monotonic_ns()
+            if self.output_mode is OutputMode.POLL:
+                self._request_frame()
+            frame = self._frames.latest(timeout=self._timeout if block else 0)
+            self._read_wait.record(time.monotonic_ns() - start)
+            if frame is None:
+                return None
+            self._discarded.record(self._frames.dropped - dropped)
+        elif not block:
+            frame = self._newest_frame()
+            if frame is None:
+                return None
+        else:
+            # Note: The input buffer can fill up, causing latency. Clear it before reading, unless that would throw
+            # away the reply to a command.
+            if not self._commands.active:
+                waiting = self._serial.in_waiting
+                self._serial.reset_input_buffer()
+                self._partial = b''
+                if self._frame_length:
+                    # Whole frames are estimated from the bytes thrown away.
+                    self._discarded.record(-(-waiting // self._frame_length))
+            if self.output_mode is OutputMode.POLL:
+                self._request_frame()
+            start = time.monotonic_ns()
+            raw = self._serial.readline()
+            frame = (time.monotonic_ns(), raw)
+            self._read_wait.record(frame[0] - start)
+            if raw:
+                self._arrived(frame[0], raw)
+        logging.debug(frame[1])
+        return frame
+
+    def _newest_frame(self):
+        """Returns the newest complete (timestamp, raw) frame which has arrived on the serial port, without waiting."""
+        if self.output_mode is OutputMode.POLL:
+            self._request_frame()
+        waiting = self._serial.in_waiting
+        if waiting:
+            self._partial += self._serial.read(waiting)
+        end = self._partial.rfind(b'\n')
+        if end < 0:
+            return None
+        timestamp = time.monotonic_ns()
+        lines = self._partial[:end + 1].splitlines(keepends=True)
+        self._partial = self._partial[end + 1:]
+        for raw in lines:
+            self._arrived(timestamp, raw)
+        if self._commands.active:
+            # Replies to commands must not be lost by skipping to the newest frame.
+            for raw in lines[:-1]:
+                self._match_command(raw)
+        self._discarded.record(len(lines) - 1)
+        return (timestamp, lines[-1])
+
+    def _request_frame(self):
+        """Ask a scale in POLL mode for a frame, at most once every idle_poll_interval seconds."""
+        now = time.monotonic()
+        if now >= self._next_poll:
+            self._next_poll = now + self._poll_interval
+            self._write(self.command_codes[self.poll_command] + b'\r\n')
+
+    def _handle_frame(self, raw, timestamp=None):
+        """Parse a raw frame and update this instance with its values. Returns the Frame, or None."""
+        if timestamp is not None:
+            self.timestamp = timestamp
+        start = time.perf_counter_ns()
+        try:
+            frame = self._parse_frame(raw)
+        except (KeyError, ValueError):
+            # Bytes outside ASCII usually mean the wrong baud rate or line noise, rather than an unknown frame.
+            self.metrics.count('unparseable' if raw.isascii() else 'undecodable')
+            logging.debug('Could not parse frame: %r', raw)
+            return None
+        self._parse_time.record(time.perf_counter_ns() - start)
+        if frame is not None:
+            self._apply_frame(frame)
+            if self._commands.active and not self._frames:
+                self._commands.on_frame(frame)
+        return frame
+
+    def _apply_frame(self, frame):
+        """Update this instance with the values of a parsed frame."""
+        if frame.counts is None:
+            self.status = frame.status
+            if frame.text is not None:
+                logging.info('scale %s: %s', frame.status.name.lower().replace('_', ' '), frame.text)
+            if frame.status not in (self.StatusMap.MODEL_NUMBER, self.StatusMap.SERIAL_NUMBER):
+                self._update_memcache()
+            return
+
+        if frame.unit is not self.unit:
+            # Readings in another unit aren't comparable.
+            self._stability.reset()
+        if frame.status is None or self._override_stability:
+            # Infer stability from the readings when the scale doesn't report it, or isn't trusted to.
+            self._check_stability(frame.ticks)
+        else:
+            self.status = frame.status
+        self._counts = frame.counts
+        self._exponent = frame.exponent
+        self._weight = None
+        self.ticks = frame.ticks
+        if frame.unit is not self.unit:
+            self.unit = frame.unit
+            # Update the resolution according to the current unit of measure and supported resolutions.
+            self.resolution = self._frame_tables().resolutions[frame.unit]
+        # Update memcache values.
+        self._update_memcache()
+
+    @classmethod
+    def _frame_tables(cls):
+        """Returns the parser lookup tables for this class, building them on first use."""
+        tables = _FRAME_TABLES.get(cls)
+        if tables is not None:
+            return tables
+        resolutions = dict(cls.resolution_map) # pylint: disable=no-member;
+        units = {}
+        for name, unit in cls.unit_map.items(): # pylint: disable=no-member;
+            resolution = resolutions[unit].as_tuple()
+            entry = (unit, int(''.join(str(d) for d in resolution.digits)), resolution.exponent)
+            for key in unit_field_keys(name, cls.unit_field_width):
+                units[key] = entry
+        statuses = {code: cls.StatusMap[name] for code, name in cls.status_codes.items()}
+        tables = FrameTables(units, statuses, frozenset(cls.weighing_codes), resolutions)
+        _FRAME_TABLES[cls] = tables
+        return tables
+
+    @staticmethod
+    def _weight_frame(tables, status, weight_field, unit_field):
+        """Builds a Frame from the raw bytes of the weight and unit fields."""
+        units = tables.units
+        entry = units.get(unit_field)
+        if entry is None:
+            entry = units[unit_field.strip()]
+        unit, coefficient, resolution_exponent = entry
+        # Drop the decimal point and any padding, leaving a signed integer count.
+        counts = int(weight_field.translate(None, b'. '))
+        point = weight_field.find(b'.')
+        exponent = point + 1 - len(weight_field) if point >= 0 else 0
+        if exponent == resolution_exponent:
+            # Round half up to the nearest count of the resolution, which is exact when the scale steps by it.
+            ticks = counts if coefficient == 1 else (counts + coefficient // 2) // coefficient
+        else:
+            ticks = to_ticks(counts, exponent, coefficient, resolution_exponent)
+        return Frame(status, unit, counts, exponent, ticks, None)
+
+    @classmethod
+    def _parse_frame(cls, raw):
+        """Parse the raw bytes of a frame into a Frame, or None if it should be ignored."""
+        raise NotImplementedError('The _parse_frame() method needs to be defined in a brand-specific scale class.')
 
     def _store_scale_config(self):
         """Store the unit and status maps into memcache for reference elsewhere."""
@@ -108,9 +931,10 @@ class SerialScale: # pylint: disable=too-many-instance-attributes;
                 self._constants.SCALE_STATUS_MAP.value: {x.name: x.value for x in self.StatusMap},
             })
 
-    def _check_stability(self):
-        """Checks the internal list of readings and infer if the scale reading is stable."""
-        if len(self._readings) == self._readings.maxlen and len(set(self._readings)) == 1:
+    def _check_stability(self, ticks):
+        """Feeds a reading to the stability detector and infers if the scale reading is stable."""
+        timestamp = self.timestamp if self.timestamp is not None else time.monotonic_ns()
+        if self._stability.push(ticks, timestamp):
             self.status = self.StatusMap.STABLE
         else:
             self.status = self.StatusMap.UNSTABLE
@@ -138,18 +962,292 @@ class SerialScale: # pylint: disable=too-many-instance-attributes;
         """Map self.Units to matching resolutions with decimal.Decimal values."""
         raise NotImplementedError('')
 
+    @property
+    def weight(self):
+        """Returns the most recent weight as a decimal.Decimal."""
+        if self._weight is None:
+            self._weight = decimal.Decimal(self._counts).scaleb(self._exponent)
+        return self._weight
+
     @property
     def is_stable(self):
         """Returns True if the scale is stable, otherwise False."""
         return self.status == self.StatusMap.STABLE
 
+    @property
+    def reading(self):
+        """Returns an immutable Reading of the current scale state."""
+        return Reading(self.status, self.unit, self._counts, self._exponent, self.ticks, self.timestamp)
+
+    @property
+    def frame_stats(self):
+        """Returns frame counters from the background reader, or None when it isn't running."""
+        if self._frames:
+            return self._frames.stats
+        return None
+
+    def send_command(self, name, done, timeout=None, retries=None):
+        """Queue one of the command_codes, returning a concurrent.futures.Future completed by the frame done() accepts.
+
+        Never blocks. Timeout (seconds) and retries default to the [scale] command_timeout and command_retries.
+        """
+        payload = self.command_codes.get(name)
+        if payload is None:
+            future = concurrent.futures.Future()
+            future.set_exception(ScaleCommandError(f'{type(self).__name__} does not support the {name} command.'))
+            return future
+        return self._commands.submit(ScaleCommand(
+            name,
+            payload,
+            done,
+            self._command_timeout if timeout is None else timeout,
+            self._command_retries if retries is None else retries))
+
+    def _acknowledged(self, frame):
+        """Command completion test for commands answered with an acknowledgement."""
+        return frame.status is self.StatusMap.ACKNOWLEDGE
+
     def change_unit(self):
-        """Changes the unit of weight on the scale."""
-        raise NotImplementedError('The change_unit() method needs to be defined in a brand-specific scale class.')
+        """Changes the unit of weight on the scale. Returns a future completed once frames arrive in another unit."""
+        pending = self._commands.pending('unit')
+        if pending is not None:
+            return pending
+        logging.debug('changing weight unit on scale from: %r', self.unit)
+        start_unit = self.unit
+        # Completed by the unit change itself rather than the acknowledgement, which arrives before frames switch.
+        return self.send_command('unit', lambda frame: frame.unit is not None and frame.unit is not start_unit)
+
+    def tare(self):
+        """Tares the scale. Returns a future completed by the acknowledgement."""
+        return self.send_command('tare', self._acknowledged)
+
+    def zero(self):
+        """Re-zeroes the scale. Returns a future completed by the acknowledgement."""
+        return self.send_command('zero', self._acknowledged)
+
+    def query_model_number(self):
+        """Asks the scale for its model number. Returns a future completed by the reply frame (see Frame.text)."""
+        return self.send_command('model_number', lambda frame: frame.status is self.StatusMap.MODEL_NUMBER)
+
+    def query_serial_number(self):
+        """Asks the scale for its serial number. Returns a future completed by the reply frame (see Frame.text)."""
+        return self.send_command('serial_number', lambda frame: frame.status is self.StatusMap.SERIAL_NUMBER)
+
+    def update(self, block=True):
+        """Read from the serial port and update an instance of this class with the most recent values.
+
+        Returns the parsed Frame, or None if no frame arrived or it couldn't be parsed. Without block, returns right
+        away, leaving the previous values in place if no new frame has arrived.
+        """
+        frame = self._read_frame(block)
+        parsed = None
+        if frame is not None:
+            parsed = self._handle_frame(frame[1], frame[0])
+            now = time.monotonic_ns()
+            # How stale the reading is by the time the caller gets to act on it.
+            self._reading_age.record(now - frame[0])
+            self.metrics.maybe_dump(now)
+        if self._commands.active:
+            self._commands.poll()
+        return parsed
 
-    def update(self):
-        """Read from the serial port and update an instance of this class with the most recent values."""
-        raise NotImplementedError('The update() method needs to be defined in a brand-specific scale class.')
+    @classmethod
+    def _output_mode_setting(cls, value):
+        """Returns the OutputMode for a config setting, or None when it's empty or the scale can't switch to it."""
+        if not value:
+            return None
+        mode = OutputMode(value)
+        if mode not in cls.output_modes:
+            logging.info('%s has no %s output mode, leaving the scale as it is.', cls.__name__, mode.value)
+            return None
+        return mode
+
+    def set_output_mode(self, mode):
+        """Switches the scale to an OutputMode, resetting the sample rate. Returns a future completed once switched.
+
+        Does nothing for a mode of None, or one the scale is already in.
+        """
+        if mode is None or mode is self.output_mode:
+            future = concurrent.futures.Future()
+            future.set_result(None)
+            return future
+        name = self.output_modes.get(mode)
+        if mode is OutputMode.STREAM:
+            # Streaming has started once weight frames arrive, whether or not they were asked for.
+            future = self.send_command(name, lambda frame: frame.counts is not None)
+        else:
+            future = self.send_command(name, self._acknowledged)
+
+        def switched(future):
+            if future.exception() is not None:
+                logging.warning('Scale did not switch to %s output mode: %s', mode.value, future.exception())
+                return
+            logging.info('Scale switched to %s output mode after %.1f frames/s.', mode.value, self.sample_rate or 0)
+            self.output_mode = mode
+            self.reset_sample_rate()
+
+        future.add_done_callback(switched)
+        return future
+
+    @property
+    def sample_rate(self):
+        """Returns the effective rate, in frames/second, of the frames read since the last reset, or None."""
+        if self._rate_frames < 2 or self._last_arrival == self._rate_first:
+            return None
+        return (self._rate_frames - 1) * 1e9 / (self._last_arrival - self._rate_first)
+
+    def reset_sample_rate(self):
+        """Start measuring the sample rate again, such as at the start of a charge."""
+        self._rate_frames = 0
+        self._rate_first = None
+
+    def dump_metrics(self):
+        """Log the scale I/O histograms and counters, such as from a signal handler."""
+        self.metrics.dump()
+        logging.info('scale metrics: sample_rate=%.3g frames/s output_mode=%s', self.sample_rate or 0,
+            self.output_mode.value if self.output_mode else 'unknown')
+        if self._frames:
+            logging.info('scale metrics: frame buffer %r', self.frame_stats)
+
+    def stream(self, policy=None, maxsize=None):
+        """Returns an async iterator of Readings, read by the running asyncio event loop.
+
+        All streams from one scale share a single reader. The 'latest' policy only keeps the newest reading for a
+        slow consumer, while 'all' queues up to maxsize readings and pauses the reader while the queue is full.
+        """
+        if self._frames:
+            raise ScaleException('stream() cannot be used while a background reader is running.')
+        if self._stream is None:
+            self._stream = ScaleStream(self)
+        return self._stream.subscribe(policy or self._stream_policy, maxsize or self._stream_length)
+
+
+class StreamSubscription:
+    """Async iterator over the Readings delivered to one stream() consumer."""
+
+    def __init__(self, stream, policy, maxsize):
+        """Constructor."""
+        if policy not in ('latest', 'all'):
+            raise ValueError(f'Unknown stream policy: {policy!r}')
+        self._stream = stream
+        self.policy = policy
+        self.maxsize = maxsize
+        self._readings = collections.deque()
+        self._ready = asyncio.Event()
+        self._closed = False
+        # Readings replaced by a newer one before this consumer got to them (latest policy only).
+        self.dropped = 0
+
+    @property
+    def full(self):
+        """Returns True when this consumer is holding back the reader."""
+        return self.policy == 'all' and len(self._readings) >= self.maxsize
+
+    def deliver(self, reading):
+        """Hand a new reading to this consumer, following its policy."""
+        if self.policy == 'latest' and self._readings:
+            self._readings.clear()
+            self.dropped += 1
+        self._readings.append(reading)
+        self._ready.set()
+
+    def close(self):
+        """Stop receiving readings and end the iteration."""
+        if not self._closed:
+            self._closed = True
+            self._ready.set()
+            self._stream.unsubscribe(self)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._readings:
+            if self._closed:
+                raise StopAsyncIteration
+            self._ready.clear()
+            await self._ready.wait()
+        reading = self._readings.popleft()
+        if self.policy == 'all':
+            self._stream.resume()
+        return reading
+
+
+class ScaleStream:
+    """Reads a scale from the asyncio event loop and fans each Reading out to every subscriber.
+
+    The serial port's file descriptor is registered with the loop, so nothing blocks on readline().
+    """
+
+    def __init__(self, scale):
+        """Constructor."""
+        self._scale = scale
+        self._subscribers = []
+        self._pending = bytearray()
+        self._loop = None
+        self._reading = False
+
+    def subscribe(self, policy, maxsize):
+        """Adds a consumer and starts reading if this is the first one."""
+        subscription = StreamSubscription(self, policy, maxsize)
+        self._subscribers.append(subscription)
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+            # Frames sitting in the buffer are stale, start fresh.
+            self._scale._serial.reset_input_buffer() # pylint: disable=protected-access;
+        self.resume()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Removes a consumer and stops reading once there are none left."""
+        if subscription in self._subscribers:
+            self._subscribers.remove(subscription)
+        if not self._subscribers:
+            self._pause()
+        else:
+            self.resume()
+
+    def resume(self):
+        """Registers the reader with the event loop, unless a consumer is still full."""
+        if self._reading or not self._subscribers or any(x.full for x in self._subscribers):
+            return
+        self._loop.add_reader(self._scale._serial.fileno(), self._on_readable) # pylint: disable=protected-access;
+        self._reading = True
+        if b'\n' in self._pending:
+            # Frames left over from before the pause.
+            self._loop.call_soon(self._drain)
+
+    def _pause(self):
+        """Unregisters the reader from the event loop, leaving unread bytes in the serial buffer."""
+        if self._reading:
+            self._loop.remove_reader(self._scale._serial.fileno()) # pylint: disable=protected-access;
+            self._reading = False
+
+    def _on_readable(self):
+        """Event loop callback: read what's available, then parse and deliver each complete frame."""
+        port = self._scale._serial # pylint: disable=protected-access;
+        self._pending += port.read(port.in_waiting or 1)
+        self._drain()
+
+    def _drain(self):
+        """Parse and deliver each complete frame that has been read so far."""
+        timestamp = time.monotonic_ns()
+        while self._reading:
+            end = self._pending.find(b'\n')
+            if end < 0:
+                break
+            raw = bytes(self._pending[:end + 1])
+            del self._pending[:end + 1]
+            self._scale._arrived(timestamp, raw) # pylint: disable=protected-access;
+            if self._scale._handle_frame(raw, timestamp) is None: # pylint: disable=protected-access;
+                continue
+            reading = self._scale.reading
+            for subscription in self._subscribers:
+                subscription.deliver(reading)
+            if any(x.full for x in self._subscribers):
+                # Backpressure: stop reading until the slow consumer catches up.
+                self._pause()
+                break
 
 
 class ANDScale(SerialScale):
@@ -184,96 +1282,50 @@ class ANDScale(SerialScale):
             cls.Units.GRAMS: decimal.Decimal('0.0001'),
         }
 
-    def change_unit(self):
-        """Changes the unit of weight on the scale."""
-        logging.debug('changing weight unit on scale from: %r', self.unit)
-        # Send Mode button command.
-        self._serial.write(b'U\r\n')
-        # Sleep 1s and wait for change to take effect.
-        time.sleep(1)
-        # Run update fn to set latest values.
-        self.update()
-
-    def update(self):
-        """Read from the serial port and update an instance of this class with the most recent values."""
-        # Status values (provided by the AND scales) mapped to functions to handle those cases.
-        handlers = {
-            'ST': self._stable,
-            'US': self._unstable,
-            'OL': self._overload,
-            'EC': self._error,
-            'AK': self._acknowledge,
-            'TN': self._model_number,
-            'SN': self._serial_number,
-            None: noop,
-        }
-
-        # Note: The input buffer can fill up, causing latency. Clear it before reading.
-        self._serial.reset_input_buffer()
-        raw = self._serial.readline()
-        logging.debug(raw)
-        try:
-            # Remove all leading and trailing whitespace characters then decode from bytestring into unicode.
-            line = raw.strip().decode('utf-8')
-        except UnicodeDecodeError:
-            logging.debug('Could not decode bytes to unicode.')
-        else:
-            # Pull the first characters (status code, on this scale)
-            prefix = line[0:2]
-            # Get a handler function based on the prefix
-            handler = handlers.get(prefix, noop)
-            # Run the function to handle the input.
-            handler(line)
-
-    def _stable_unstable(self, line):
-        """Update the scale when status is stable or unstable."""
-        # Store the numeric weight from the scale reading.
-        weight = line[3:12].strip()
-        self.weight = decimal.Decimal(weight)
-        # Get the unit of measurement from the scale reading and store the mapped value.
-        unit = line[12:15].strip()
-        self.unit = self.unit_map[unit]
-        # Update the resolution according to the current unit of measure and supported resolutions.
-        self.resolution = self.resolution_map[self.unit]
-        # Update memcache values.
-        self._update_memcache()
-
-    def _stable(self, line):
-        """Scale is stable."""
-        self.status = self.StatusMap.STABLE
-        self._stable_unstable(line)
+    status_codes = {
+        b'ST': 'STABLE',
+        b'US': 'UNSTABLE',
+        b'OL': 'OVERLOAD',
+        b'EC': 'ERROR',
+        b'AK': 'ACKNOWLEDGE',
+        b'TN': 'MODEL_NUMBER',
+        b'SN': 'SERIAL_NUMBER',
+    }
+    weighing_codes = (b'ST', b'US')
+    unit_field_width = 3
+    command_codes = {
+        # Same as pressing the Mode button.
+        'unit': b'U',
+        'tare': b'T',
+        'zero': b'R',
+        'model_number': b'?TN',
+        'serial_number': b'?SN',
+        # Stream weight continuously, stop streaming, and send one weight.
+        'stream': b'SIR',
+        'cancel': b'C',
+        'poll': b'Q',
+    }
+    output_modes = {
+        OutputMode.STREAM: 'stream',
+        OutputMode.POLL: 'cancel',
+    }
+    poll_command = 'poll'
+    baudrates = (19200, 9600)
 
-    def _unstable(self, line):
-        """Scale is unstable."""
-        self.status = self.StatusMap.UNSTABLE
-        self._stable_unstable(line)
-
-    def _overload(self, line):
-        """Scale is overloaded."""
-        self.status = self.StatusMap.OVERLOAD
-        self._update_memcache()
-
-    def _error(self, line):
-        """Scale has an error."""
-        self.status = self.StatusMap.ERROR
-        self._update_memcache()
-
-    def _acknowledge(self, line):
-        """Scale has acknowledged a command."""
-        self.status = self.StatusMap.ACKNOWLEDGE
-        self._update_memcache()
-
-    def _model_number(self, line):
-        """Gets & prints the scale's model number."""
-        self.status = self.StatusMap.MODEL_NUMBER
-        model_number = line[3:]
-        logging.info('scale model number: %s', model_number)
-
-    def _serial_number(self, line):
-        """Gets & prints the scale's serial number."""
-        self.status = self.StatusMap.SERIAL_NUMBER
-        serial_number = line[3:]
-        logging.info('scale serial number: %s', serial_number)
+    @classmethod
+    def _parse_frame(cls, raw):
+        """Parse a raw frame, such as b'ST,+00012.34 GN\\r\\n', into a Frame."""
+        tables = cls._frame_tables()
+        # The first two characters are the status code on this scale.
+        prefix = raw[0:2]
+        if prefix in tables.weighing:
+            return cls._weight_frame(tables, tables.statuses[prefix], raw[3:12], raw[12:15])
+        status = tables.statuses.get(prefix)
+        if status is None:
+            return None
+        if status in (cls.StatusMap.MODEL_NUMBER, cls.StatusMap.SERIAL_NUMBER, cls.StatusMap.ERROR):
+            return Frame(status, None, None, None, None, raw[3:].strip().decode('ascii', 'replace'))
+        return Frame(status, None, None, None, None, None)
 
 
 class CreedmoorScale(SerialScale):
@@ -305,57 +1357,19 @@ class CreedmoorScale(SerialScale):
         }
 
     # Note(eric): There is no documentation on how to do this for this scale.
-    def change_unit(self):
-        """Changes the unit of weight on the scale."""
-        logging.debug('changing weight unit on scale from: %r', self.unit)
-        # Send Mode button command.
-        self._serial.write(b'U\r\n')
-        # Sleep 1s and wait for change to take effect.
-        time.sleep(1)
-        # Run update fn to set latest values.
-        self.update()
-
-    def update(self):
-        """Read from the serial port and update an instance of this class with the most recent values."""
-        handlers = {
-            '+': self._stable_unstable,
-            '-': self._stable_unstable,
-            None: noop,
-        }
+    command_codes = {
+        # Same as pressing the Mode button.
+        'unit': b'U',
+    }
+    baudrates = (9600,)
 
-        # Note: The input buffer can fill up, causing latency. Clear it before reading.
-        self._serial.reset_input_buffer()
-        raw = self._serial.readline()
-        logging.debug(raw)
-        try:
-            # Remove trailing newline characters, then decode from bytestring into unicode.
-            line = raw.rstrip(b'\r\n').decode('utf-8')
-        except UnicodeDecodeError:
-            logging.debug('Could not decode bytes to unicode.')
-        else:
-            # Pull the first character (positive or negative, on this scale)
-            prefix = line[0:1]
-            # Get a handler function based on the prefix
-            handler = handlers.get(prefix, noop)
-            # Run the function to handle the input.
-            handler(line)
-
-    def _stable_unstable(self, line):
-        """Update the scale when status is stable or unstable."""
-        # Push the latest reading into the internal list.
-        self._readings.append(line)
-        # Update internal stability bit.
-        self._check_stability()
-        # Store the numeric weight from the scale reading.
-        weight = line[0:8]
-        self.weight = decimal.Decimal(weight)
-        # Get the unit of measurement from the scale reading and store the mapped value.
-        unit = line[9:11]
-        self.unit = self.unit_map[unit]
-        # Update the resolution according to the current unit of measure and supported resolutions.
-        self.resolution = self.resolution_map[self.unit]
-        # Update memcache values.
-        self._update_memcache()
+    @classmethod
+    def _parse_frame(cls, raw):
+        """Parse a raw frame, such as b'+0012.34 GN\\r\\n', into a Frame."""
+        # The first character is the sign of the weight on this scale, and there is no status code.
+        if raw[0:1] not in (b'+', b'-'):
+            return None
+        return cls._weight_frame(cls._frame_tables(), None, raw[0:8], raw[9:11])
 
 
 class USSolidScale(SerialScale):
@@ -386,54 +1400,25 @@ class USSolidScale(SerialScale):
             cls.Units.GRAMS: decimal.Decimal('0.001'),
         }
 
+    baudrates = (9600,)
+    # Set once the unsupported unit change has been logged, as the control loop asks on every pass.
+    _unit_change_logged = False
+
     # Note(eric): There is no documentation on how to do this for this scale.
     def change_unit(self):
         """Changes the unit of weight on the scale."""
-        logging.info('This scale does not support changing units through RS232')
-        self.update()
-
-    def update(self):
-        """Read from the serial port and update an instance of this class with the most recent values."""
-        handlers = {
-            '+': self._stable_unstable,
-            '-': self._stable_unstable,
-            None: noop,
-        }
+        if not self._unit_change_logged:
+            logging.info('This scale does not support changing units through RS232')
+            self._unit_change_logged = True
+        return super().change_unit()
 
-        # Note: The input buffer can fill up, causing latency. Clear it before reading.
-        self._serial.reset_input_buffer()
-        raw = self._serial.readline()
-        logging.debug(raw)
-        try:
-            # Remove trailing newline characters, then decode from bytestring into unicode.
-            line = raw.rstrip(b'\r\n').decode('utf-8')
-        except UnicodeDecodeError:
-            logging.debug('Could not decode bytes to unicode.')
-        else:
-            # Pull the first character (positive or negative, on this scale)
-            prefix = line[0:1]
-            # Get a handler function based on the prefix
-            handler = handlers.get(prefix, noop)
-            # Run the function to handle the input.
-            handler(line)
-
-    def _stable_unstable(self, line):
-        """Update the scale when status is stable or unstable."""
-        # Push the latest reading into the internal list.
-        self._readings.append(line)
-        # Update internal stability bit.
-        self._check_stability()
-        # Store the numeric weight from the scale reading.
-        weight = line[0:9]
-        weight = weight.replace(' ', '')
-        self.weight = decimal.Decimal(weight)
-        # Get the unit of measurement from the scale reading and store the mapped value.
-        unit = line[9:11].strip()
-        self.unit = self.unit_map[unit]
-        # Update the resolution according to the current unit of measure and supported resolutions.
-        self.resolution = self.resolution_map[self.unit]
-        # Update memcache values.
-        self._update_memcache()
+    @classmethod
+    def _parse_frame(cls, raw):
+        """Parse a raw frame, such as b'+   1.234gn\\r\\n', into a Frame."""
+        # The first character is the sign of the weight on this scale, and there is no status code.
+        if raw[0:1] not in (b'+', b'-'):
+            return None
+        return cls._weight_frame(cls._frame_tables(), None, raw[0:9], raw[9:11])
 
 
 SCALES = {
@@ -445,10 +1430,221 @@ SCALES = {
 }
 
 
+def model_name(cls):
+    """Returns the SCALES name of a scale class."""
+    for name, scale_cls in SCALES.items():
+        if scale_cls is cls:
+            return name
+    return cls.__name__
+
+
+def replay(path, config, speed=1.0, **kwargs):
+    """Returns a scale of the recorded model which reads its frames back from a capture file."""
+    model = CaptureReader(path).model
+    return SCALES[model](config, port=REPLAY_PREFIX + path, replay_speed=speed, **kwargs)
+
+
+def identify(lines, candidates, min_frames=2):
+    """Returns the names of the candidate scale models whose parser accepts the raw lines."""
+    matches = []
+    for name, cls in candidates.items():
+        parsed = 0
+        try:
+            for raw in lines:
+                frame = cls._parse_frame(raw) # pylint: disable=protected-access;
+                if frame is not None:
+                    parsed += 1
+                    if frame.text is not None:
+                        # A model number reply identifies the scale on its own.
+                        parsed = max(parsed, min_frames)
+        except (KeyError, ValueError):
+            continue
+        if parsed >= min_frames:
+            matches.append(name)
+    return matches
+
+
+def _listen(conn, listen_time, max_lines=6):
+    """Reads complete lines from an open serial port for up to listen_time seconds."""
+    lines = []
+    deadline = time.monotonic() + listen_time
+    while len(lines) < max_lines and time.monotonic() < deadline:
+        raw = conn.readline()
+        if raw.endswith(b'\n') and raw.strip():
+            lines.append(raw)
+    return lines
+
+
+def probe_port(port, candidates, listen_time=1.5, query=False):
+    """Listens to a port at each candidate baud rate and returns a scale profile dict, or None if no scale answers.
+
+    When query is set and the port is silent, the A&D model number command is sent in case the scale isn't streaming.
+    """
+    baudrates = []
+    for cls in candidates.values():
+        baudrates.extend(x for x in cls.baudrates if x not in baudrates)
+    for baudrate in baudrates:
+        try:
+            conn = serial.Serial(port=port, baudrate=baudrate, timeout=0.1)
+        except (serial.SerialException, OSError):
+            return None
+        try:
+            conn.reset_input_buffer()
+            lines = _listen(conn, listen_time)
+            if not lines and query:
+                conn.write(ANDScale.command_codes['model_number'] + b'\r\n')
+                lines = _listen(conn, listen_time)
+        except (serial.SerialException, OSError):
+            logging.debug('Failed to read from %s at %d baud.', port, baudrate, exc_info=True)
+            lines = []
+        finally:
+            conn.close()
+        matches = identify(lines, candidates)
+        logging.debug('Probed %s at %d baud: %d lines, matches %r', port, baudrate, len(lines), matches)
+        if matches:
+            profile = {'model': matches[0], 'port': port, 'baudrate': baudrate}
+            for raw in lines:
+                frame = candidates[matches[0]]._parse_frame(raw) # pylint: disable=protected-access;
+                if frame is not None and frame.status is SerialScale.StatusMap.MODEL_NUMBER:
+                    profile['model_number'] = frame.text
+            return profile
+    return None
+
+
+def port_in_use(port):
+    """Returns True if another process has the port open, going by the file descriptors in /proc."""
+    try:
+        device = os.stat(port).st_rdev
+    except OSError:
+        return False
+    own = str(os.getpid())
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit() or pid == own:
+            continue
+        try:
+            fds = os.listdir(f'/proc/{pid}/fd')
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                if os.stat(f'/proc/{pid}/fd/{fd}').st_rdev == device:
+                    return True
+            except OSError:
+                continue
+    return False
+
+
+def probe(config):
+    """Scans the candidate serial ports concurrently and returns the profile of the first scale found, or None.
+
+    Besides the configured port, ports another process has open and the Pi's Bluetooth UART are left alone, since
+    they belong to other devices.
+    """
+    scale_config = config['scale']
+    configured_port = scale_config['port']
+    ports = [configured_port]
+    # /dev/serial1 is the Raspberry Pi OS link to the UART wired to the Bluetooth chip.
+    bluetooth = os.path.realpath('/dev/serial1') if os.path.exists('/dev/serial1') else None
+    for pattern in scale_config.get('probe_ports', '/dev/ttyUSB*').split(','):
+        for port in sorted(glob.glob(pattern.strip())):
+            if port in ports:
+                continue
+            if os.path.realpath(port) == bluetooth:
+                logging.debug('Not probing %s, it is the Bluetooth UART.', port)
+            elif port_in_use(port):
+                logging.debug('Not probing %s, another process has it open.', port)
+            else:
+                ports.append(port)
+    # Try the configured model first, and only once per class.
+    candidates = {}
+    for name in [scale_config['model']] + list(SCALES):
+        if name in SCALES and SCALES[name] not in candidates.values():
+            candidates[name] = SCALES[name]
+    listen_time = float(scale_config.get('probe_listen_time', 1.5))
+    logging.info('Probing %r for a scale...', ports)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(ports)) as executor:
+        # Only the configured port is sent a query, since other ports may belong to other devices.
+        futures = [executor.submit(probe_port, port, candidates, listen_time, port == configured_port)
+            for port in ports if os.path.exists(port)]
+        profiles = [x.result() for x in futures]
+    for profile in profiles:
+        if profile:
+            logging.info('Found scale: %r', profile)
+            return profile
+    return None
+
+
+def load_profile(path):
+    """Returns the cached scale profile, or None."""
+    try:
+        with open(path, encoding='utf-8') as profile_file:
+            return json.load(profile_file)
+    except (OSError, ValueError):
+        return None
+
+
+def save_profile(path, profile):
+    """Caches a scale profile so that the next start connects on the first try."""
+    try:
+        with open(path, 'w', encoding='utf-8') as profile_file:
+            json.dump(profile, profile_file)
+    except OSError:
+        logging.exception('Could not save the scale profile to %s', path)
+
+
+def _open_verified(config, profile, **kwargs):
+    """Opens the scale described by a profile and waits for frames which parse."""
+    scale = SCALES[profile['model']](config, port=profile['port'], baudrate=profile['baudrate'], **kwargs)
+    try:
+        scale.verify(timeout=float(config['scale'].get('verify_timeout', 2.0)))
+    except ScaleException:
+        scale.close()
+        raise
+    return scale
+
+
+def connect(config, **kwargs):
+    """Connects to the scale, trying the cached profile, then the config file, then probing the serial ports.
+
+    Raises ScaleNotReady if no scale answers, or ScaleMisconfigured if the configured scale sends data that doesn't
+    parse and no other setting works either.
+    """
+    scale_config = config['scale']
+    cache_path = scale_config.get('profile_cache', '/var/tmp/opentrickler_scale_profile.json')
+    auto_detect = scale_config.getboolean('auto_detect', False)
+    configured = {
+        'model': scale_config['model'],
+        'port': kwargs.pop('port', scale_config['port']),
+        'baudrate': int(kwargs.pop('baudrate', scale_config['baudrate'])),
+    }
+
+    profile = load_profile(cache_path) if auto_detect else None
+    if profile and profile.get('model') in SCALES:
+        try:
+            return _open_verified(config, profile, **kwargs)
+        except ScaleException:
+            logging.info('Cached scale profile %r did not work, trying the config.', profile)
+
+    try:
+        scale = _open_verified(config, configured, **kwargs)
+    except ScaleException as exc:
+        if not auto_detect:
+            raise
+        logging.info('Configured scale did not work (%s), probing for it.', exc)
+        configured = probe(config)
+        if configured is None:
+            raise
+        scale = _open_verified(config, configured, **kwargs)
+    if auto_detect and configured != profile:
+        save_profile(cache_path, configured)
+    return scale
+
+
 # Handle command-line execution.
 if __name__ == '__main__':
     import argparse
     import configparser
+    import signal
 
 
     # Default argument values.
@@ -467,6 +1663,12 @@ if __name__ == '__main__':
     parser.add_argument('--scale_port')
     parser.add_argument('--scale_baudrate', type=int)
     parser.add_argument('--scale_timeout', type=float)
+    parser.add_argument('--reader_thread', action='store_true')
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument('--capture', help='Record every raw frame to this capture file.')
+    parser.add_argument('--replay', help='Read frames from this capture file instead of the serial port.')
+    parser.add_argument('--speed', type=float, default=1.0, help='Replay speed, 0 for as fast as possible.')
+    parser.add_argument('--output_mode', choices=[x.value for x in OutputMode])
     args = parser.parse_args()
 
     # Parse the config file.
@@ -493,6 +1695,10 @@ if __name__ == '__main__':
         kwargs['baudrate'] = args.scale_baudrate
     if args.scale_timeout is not None:
         kwargs['timeout'] = args.scale_timeout
+    if args.reader_thread:
+        kwargs['reader_thread'] = args.reader_thread
+    if args.capture:
+        kwargs['capture_file'] = args.capture
 
     # Configure Python logging.
     LOG_LEVEL = logging.INFO
@@ -500,15 +1706,30 @@ if __name__ == '__main__':
         LOG_LEVEL = logging.DEBUG
     helpers.setup_logging(LOG_LEVEL)
 
-    # Setup memcache.
-    memcache_client = helpers.get_mc_client()
+    # Setup memcache, or the shared-memory state bus if configured.
+    memcache_client = helpers.get_state_client(config)
 
     # Create a Scale instance and run .update() in a loop, which should print the values.
-    scale_cls = SCALES[SCALE_MODEL]
-    scale = scale_cls(
-        config=config,
-        memcache=memcache_client,
-        **kwargs)
-
+    if args.replay:
+        scale = replay(args.replay, config, speed=args.speed, memcache=memcache_client, **kwargs)
+    else:
+        scale_cls = SCALES[SCALE_MODEL]
+        scale = scale_cls(
+            config=config,
+            memcache=memcache_client,
+            **kwargs)
+
+    async def print_stream():
+        """Print every reading from the asyncio stream."""
+        async for reading in scale.stream(policy='all'):
+            logging.info('%s %s %s', reading.weight, reading.unit, reading.status)
+
+    # Dump the scale I/O metrics on demand with: kill -USR1 <pid>
+    signal.signal(signal.SIGUSR1, lambda *_: scale.dump_metrics())
+    if args.output_mode:
+        scale.set_output_mode(scale._output_mode_setting(args.output_mode)) # pylint: disable=protected-access;
+
+    if args.stream:
+        asyncio.run(print_stream())
     while 1:
         scale.update()
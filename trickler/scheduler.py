@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+
+Fixed-rate scheduling of the control loop, with deadline, jitter and per-phase time accounting.
+"""
+
+import time
+
+import metrics
+
+
+# Phases of a control loop tick, in order.
+PHASES = ('read', 'compute', 'actuate', 'publish')
+
+
+class LoopScheduler:
+    """Runs a loop at a fixed rate on time.monotonic_ns(), measuring how well each tick keeps to its period.
+
+    Usage:
+        for now in loop_scheduler.ticks():
+            ...
+            loop_scheduler.phase('read')
+            ...
+            loop_scheduler.phase('compute')
+
+    Ticks start on a fixed grid of deadlines, so lateness doesn't accumulate. A tick which runs past the next deadline
+    is a deadline miss, and the ticks it overran are skipped rather than run back to back. A rate of 0 runs ticks
+    back to back, with no deadlines.
+    """
+
+    def __init__(self, rate, budgets=None, interval=0):
+        """Constructor. budgets is a dict of phase names to their time budget in seconds."""
+        self.period = int(1e9 / rate) if rate else 0
+        self.budgets = {k: int(v * 1e9) for k, v in (budgets or {}).items()}
+        self.metrics = metrics.Metrics('control loop', interval)
+        # How late each tick started after its deadline.
+        self._jitter = self.metrics.histogram('jitter', 'ms', 1e6)
+        self._busy = self.metrics.histogram('tick', 'ms', 1e6)
+        self._phases = {x: self.metrics.histogram(x, 'ms', 1e6) for x in PHASES}
+        self._mark = None
+
+    def reset(self):
+        """Forget all recorded values, such as at the start of a charge."""
+        self.metrics.reset()
+
+    def ticks(self):
+        """Yields the start time (monotonic ns) of each tick, sleeping until it's due."""
+        deadline = time.monotonic_ns()
+        while 1:
+            now = time.monotonic_ns()
+            if now < deadline:
+                time.sleep((deadline - now) / 1e9)
+                now = time.monotonic_ns()
+            self._jitter.record(now - deadline)
+            self._mark = now
+            yield now
+            end = time.monotonic_ns()
+            self._busy.record(end - now)
+            self.metrics.count('ticks')
+            self.metrics.maybe_dump(end)
+            deadline += self.period
+            if self.period and end > deadline:
+                skipped = (end - deadline) // self.period + 1
+                self.metrics.count('deadline_misses')
+                self.metrics.count('skipped_ticks', skipped)
+                deadline += skipped * self.period
+            elif not self.period:
+                deadline = end
+
+    def phase(self, name):
+        """Marks the end of a phase of the current tick, which started at the end of the previous phase."""
+        now = time.monotonic_ns()
+        elapsed = now - self._mark
+        self._mark = now
+        self._phases[name].record(elapsed)
+        budget = self.budgets.get(name)
+        if budget is not None and elapsed > budget:
+            self.metrics.count(f'{name}_over_budget')
+
+    def summary(self):
+        """Returns a one line summary of the ticks, misses, jitter and phase times since the last reset."""
+        counters = self.metrics.counters
+        p99 = ' '.join(f'{x}={(self._phases[x].percentile(99) or 0) / 1e6:.3g}' for x in PHASES)
+        return (
+            f'{counters.get("ticks", 0)} ticks at {1e9 / self.period if self.period else 0:.3g}/s, '
+            f'{counters.get("deadline_misses", 0)} deadline misses, '
+            f'jitter p99={(self._jitter.percentile(99) or 0) / 1e6:.3g}ms, phase p99 (ms): {p99}')
+
+
+def from_config(config):
+    """Returns a LoopScheduler configured by the [scheduler] section of the config, if there is one."""
+    if not config.has_section('scheduler'):
+        return LoopScheduler(0)
+    scheduler_config = config['scheduler']
+    budgets = {}
+    for phase in PHASES:
+        budget = scheduler_config.get(f'{phase}_budget')
+        if budget:
+            budgets[phase] = float(budget) / 1000
+    return LoopScheduler(
+        float(scheduler_config.get('rate', 0)),
+        budgets,
+        float(scheduler_config.get('metrics_interval', 0)))
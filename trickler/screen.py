@@ -207,7 +207,7 @@ if __name__ == "__main__":
     logging.info('Screen is setup.')
     
     # Initialize memcache client
-    memcache_client = helpers.get_mc_client()
+    memcache_client = helpers.get_state_client(config)
     
     app = MiniPiTFTApp(disp, button1_gpio, button2_gpio, font_path, colors, config, memcache_client, target_weight, auto_mode)
     app.run()
@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+
+Virtual scale emulator for developing and benchmarking OpenTrickler without a scale attached.
+
+A pseudo-terminal speaks the same line formats as the scales in scales.SCALES, so the real scale classes can connect
+to it through config['scale']['port']. Weight comes from a physical model of powder flowing from the trickler motors.
+"""
+
+import atexit
+import collections
+import decimal
+import enum
+import logging
+import os
+import random
+import select
+import threading
+import time
+import tty
+
+import helpers
+import scales
+
+
+GRAINS_PER_GRAM = scales.GRAINS_PER_GRAM
+
+
+class PowderModel: # pylint: disable=too-many-instance-attributes;
+    """Physical model of powder trickling from one or more motors onto a scale pan.
+
+    All masses are in grams and all times in seconds. Call step() with the elapsed time and the current PWM of each
+    motor (0 - 1) to advance the model.
+    """
+
+    def __init__(self, **kwargs):
+        """Constructor."""
+        # Powder flow at full PWM, per motor, in grams/second.
+        self.flow_rates = list(kwargs.get('flow_rates', (0.02, 0.06)))
+        # Below this PWM the motor doesn't vibrate hard enough to move powder.
+        self.stall_pwm = kwargs.get('stall_pwm', 0.25)
+        # Time for powder leaving the tube to land on the pan.
+        self.fall_time = kwargs.get('fall_time', 0.35)
+        # Time for powder still in the tube to stop flowing after the motor turns off.
+        self.spill_time = kwargs.get('spill_time', 0.15)
+        # Time constant of the scale's filter, in seconds.
+        self.scale_lag = kwargs.get('scale_lag', 0.25)
+        # Relative noise on flow, as powder falls in clumps rather than a smooth stream.
+        self.flow_noise = kwargs.get('flow_noise', 0.3)
+        self.pan_mass = kwargs.get('pan_mass', 10.0)
+        self._random = random.Random(kwargs.get('seed'))
+
+        self.time = 0.0
+        self.pan_present = True
+        self.tare_mass = self.pan_mass
+        # Mass resting on the pan, and mass still falling as (landing time, grams).
+        self.landed = 0.0
+        self.in_flight = collections.deque()
+        # What the scale's load cell reports after its filter.
+        self.reading = 0.0
+        self._flows = [0.0] * len(self.flow_rates)
+
+    def _flow(self, motor, pwm):
+        """Returns the flow in grams/second for a motor at a PWM."""
+        if pwm <= self.stall_pwm:
+            return 0.0
+        return self.flow_rates[motor] * (pwm - self.stall_pwm) / (1 - self.stall_pwm)
+
+    def step(self, dt, pwms):
+        """Advance the model by dt seconds with the given PWM (0 - 1) for each motor."""
+        self.time += dt
+        mass = 0.0
+        for motor, pwm in enumerate(pwms):
+            # Flow follows the motor with a short spill time, so powder keeps dribbling after it stops.
+            target = self._flow(motor, pwm or 0.0)
+            self._flows[motor] += (target - self._flows[motor]) * min(dt / self.spill_time, 1.0)
+            mass += self._flows[motor] * dt
+        if mass > 0:
+            mass *= max(0.0, self._random.gauss(1.0, self.flow_noise))
+            self.in_flight.append((self.time + self.fall_time, mass))
+        while self.in_flight and self.in_flight[0][0] <= self.time:
+            self.landed += self.in_flight.popleft()[1]
+        gross = self.landed + (self.pan_mass if self.pan_present else 0.0)
+        self.reading += (gross - self.tare_mass - self.reading) * min(dt / self.scale_lag, 1.0)
+        return self.reading
+
+    def dump(self, mass):
+        """Drop a charge of powder from the measure onto the pan."""
+        self.in_flight.append((self.time + self.fall_time, mass))
+
+    def tare(self):
+        """Zero the scale on whatever is on it."""
+        self.tare_mass = self.landed + (self.pan_mass if self.pan_present else 0.0)
+        self.reading = 0.0
+
+    def toggle_pan(self):
+        """Remove or replace the pan, emptying it when it is removed."""
+        self.pan_present = not self.pan_present
+        if not self.pan_present:
+            self.landed = 0.0
+            self.in_flight.clear()
+
+    @property
+    def flowing(self):
+        """Returns True while powder is leaving the tube or in the air."""
+        return bool(self.in_flight) or any(x > 1e-6 for x in self._flows)
+
+
+class VirtualScale: # pylint: disable=too-many-instance-attributes;
+    """Formats PowderModel readings as frames in a scale's protocol and answers its commands."""
+
+    class Mode(enum.Enum):
+        """Data output modes."""
+        STREAM = 0
+        COMMAND = 1
+
+    def __init__(self, model, powder=None, **kwargs):
+        """Constructor."""
+        self.model = model
+        self.scale_cls = scales.SCALES[model]
+        self.powder = powder or PowderModel()
+        self.unit = kwargs.get('unit', self.scale_cls.Units.GRAINS)
+        # Time the displayed value must hold still before the scale calls it stable.
+        self.stable_time = kwargs.get('stable_time', 0.5)
+        self.mode = self.Mode.STREAM
+        self.model_number = kwargs.get('model_number', 'FX-120i')
+        self.serial_number = kwargs.get('serial_number', '0123456')
+        self._displayed = None
+        self._changed_at = 0.0
+        self._replies = collections.deque()
+        self._stable_pending = False
+
+    @property
+    def resolution(self):
+        """Returns the resolution of the current unit."""
+        return self.scale_cls.resolution_map[self.unit] # pylint: disable=unsubscriptable-object;
+
+    def displayed(self):
+        """Returns the weight shown on the display as a decimal.Decimal, in the current unit."""
+        grams = self.powder.reading
+        value = grams * GRAINS_PER_GRAM if self.unit == self.scale_cls.Units.GRAINS else grams
+        resolution = self.resolution
+        steps = decimal.Decimal(value / float(resolution)).to_integral_value(rounding=decimal.ROUND_HALF_EVEN)
+        weight = steps * resolution
+        if weight != self._displayed:
+            self._displayed = weight
+            self._changed_at = self.powder.time
+        return weight
+
+    @property
+    def is_stable(self):
+        """Returns True if the display has held still for stable_time."""
+        return self.powder.time - self._changed_at >= self.stable_time
+
+    def frame(self):
+        """Returns the next frame to send in the scale's line format, as bytes."""
+        if self._replies:
+            return self._replies.popleft()
+        weight = self.displayed()
+        if self._stable_pending and self.is_stable:
+            self._stable_pending = False
+            return self._format(weight, True)
+        if self.mode == self.Mode.COMMAND:
+            return None
+        return self._format(weight, self.is_stable)
+
+    def _format(self, weight, stable):
+        """Formats a weight as a frame of this scale's protocol."""
+        unit = self.scale_cls.reverse_unit_map[self.unit] # pylint: disable=unsubscriptable-object;
+        places = -self.resolution.as_tuple().exponent
+        if self.model in ('and', 'and-fx120'):
+            status = 'ST' if stable else 'US'
+            return f'{status},{weight:+09.{places}f}{unit:>3}\r\n'.encode('ascii')
+        if self.model == 'creedmoor':
+            return f'{weight:+08.{places}f} {unit}\r\n'.encode('ascii')
+        return f'{weight: =+9.{places}f}{unit:>2}\r\n'.encode('ascii')
+
+    def command(self, line):
+        """Handle a command line sent by the host, queueing any reply frames."""
+        line = line.strip().upper()
+        if not line:
+            return
+        logging.debug('virtual scale received command: %r', line)
+        if self.model == 'ussolid':
+            # This scale doesn't take commands over RS232.
+            return
+        if line == b'U':
+            units = list(self.scale_cls.Units)
+            self.unit = units[(units.index(self.unit) + 1) % len(units)]
+            self._displayed = None
+            self._ack()
+        elif self.model == 'creedmoor':
+            return
+        elif line in (b'T', b'R', b'Z'):
+            self.powder.tare()
+            self._ack()
+        elif line == b'Q':
+            self._replies.append(self._format(self.displayed(), self.is_stable))
+        elif line == b'S':
+            self._stable_pending = True
+        elif line in (b'SIR', b'SI'):
+            self.mode = self.Mode.STREAM
+        elif line == b'C':
+            self.mode = self.Mode.COMMAND
+            self._ack()
+        elif line == b'?TN':
+            self._replies.append(f'TN,{self.model_number:>7}\r\n'.encode('ascii'))
+        elif line == b'?SN':
+            self._replies.append(f'SN,{self.serial_number:>8}\r\n'.encode('ascii'))
+        else:
+            self._replies.append(b'EC,E1\r\n')
+
+    def _ack(self):
+        """Queue an acknowledgement, on scales that send them."""
+        if self.model in ('and', 'and-fx120'):
+            self._replies.append(b'AK\r\n')
+
+
+class PtyScale:
+    """Serves a VirtualScale on a pseudo-terminal at a fixed frame rate and baud rate."""
+
+    def __init__(self, virtual_scale, pwm_sources, **kwargs):
+        """Constructor. pwm_sources is a list of callables returning the current PWM (0 - 1) of each motor."""
+        self.virtual_scale = virtual_scale
+        self.pwm_sources = pwm_sources
+        self.baudrate = int(kwargs.get('baudrate', 19200))
+        self.frame_rate = float(kwargs.get('frame_rate', 10))
+        self.link = kwargs.get('link')
+        self._master, self._slave = os.openpty()
+        # Raw mode on both ends so line endings pass through untouched and nothing is echoed back.
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        os.set_blocking(self._master, False)
+        self.port = os.ttyname(self._slave)
+        if self.link:
+            if os.path.islink(self.link):
+                os.unlink(self.link)
+            os.symlink(self.port, self.link)
+        self._stop = threading.Event()
+        self.frames_sent = 0
+        self.frames_unread = 0
+        atexit.register(self.close)
+
+    def close(self):
+        """Stop serving and remove the symlink."""
+        self._stop.set()
+        if self.link and os.path.islink(self.link):
+            os.unlink(self.link)
+
+    def run(self):
+        """Emit frames and handle commands until close() is called."""
+        interval = 1.0 / self.frame_rate
+        # Each byte on the wire is 10 bits (start, 8 data, stop) at the configured baud rate.
+        byte_time = 10.0 / self.baudrate
+        commands = b''
+        last = time.monotonic()
+        next_frame = last
+        while not self._stop.is_set():
+            readable, _, _ = select.select([self._master], [], [], max(0.0, next_frame - time.monotonic()))
+            now = time.monotonic()
+            self.virtual_scale.powder.step(now - last, [source() for source in self.pwm_sources])
+            last = now
+            if readable:
+                try:
+                    commands += os.read(self._master, 1024)
+                except BlockingIOError:
+                    pass
+                while b'\n' in commands:
+                    line, commands = commands.split(b'\n', 1)
+                    self.virtual_scale.command(line)
+            if now < next_frame:
+                continue
+            frame = self.virtual_scale.frame()
+            next_frame = now + interval
+            if frame is None:
+                continue
+            next_frame = now + max(interval, len(frame) * byte_time)
+            try:
+                os.write(self._master, frame)
+                self.frames_sent += 1
+            except BlockingIOError:
+                # Nobody is reading the port and its buffer is full, same as a real scale with nothing attached.
+                self.frames_unread += 1
+
+
+def read_console(virtual_scale):
+    """Reads simple commands from stdin: 'd <grains>' dumps a charge, 'p' removes/replaces the pan, 't' tares."""
+    while 1:
+        try:
+            parts = input().split()
+        except EOFError:
+            return
+        if not parts:
+            continue
+        if parts[0] == 'd' and len(parts) > 1:
+            virtual_scale.powder.dump(float(parts[1]) / GRAINS_PER_GRAM)
+        elif parts[0] == 'p':
+            virtual_scale.powder.toggle_pan()
+        elif parts[0] == 't':
+            virtual_scale.powder.tare()
+        logging.info('pan: %s grams, reading: %s', virtual_scale.powder.landed, virtual_scale.displayed())
+
+
+# Handle command-line execution.
+if __name__ == '__main__':
+    import argparse
+    import configparser
+
+
+    # Default argument values.
+    DEFAULTS = dict(
+        verbose = False,
+    )
+
+    parser = argparse.ArgumentParser(description='Run a virtual scale on a pseudo-terminal.')
+    parser.add_argument('config_file')
+    parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('--scale', choices=scales.SCALES.keys())
+    parser.add_argument('--baudrate', type=int)
+    parser.add_argument('--frame_rate', type=float)
+    parser.add_argument('--link', help='Symlink to create for the pty, such as /tmp/ttyOT0.')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    # Parse the config file.
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read(args.config_file)
+
+    # Order of priority is 1) command-line argument, 2) config file, 3) default.
+    VERBOSE = DEFAULTS['verbose'] or config['general']['verbose']
+    if args.verbose is not None:
+        VERBOSE = args.verbose
+
+    # Configure Python logging.
+    LOG_LEVEL = logging.INFO
+    if VERBOSE:
+        LOG_LEVEL = logging.DEBUG
+    helpers.setup_logging(LOG_LEVEL)
+
+    sim_config = config['simulator'] if config.has_section('simulator') else {}
+    constants = enum.Enum('memcache_vars', dict(config['memcache_vars']))
+    memcache_client = helpers.get_state_client(config)
+
+    def motor_speed(key):
+        """Returns a function reading a trickler motor speed published by motors.TricklerMotor."""
+        return lambda: float(memcache_client.get(key) or 0.0)
+
+    powder_model = PowderModel(
+        flow_rates=[float(x) for x in sim_config.get('flow_rates', '0.02, 0.06').split(',')],
+        stall_pwm=float(sim_config.get('stall_pwm', 0.25)),
+        fall_time=float(sim_config.get('fall_time', 0.35)),
+        scale_lag=float(sim_config.get('scale_lag', 0.25)),
+        seed=args.seed)
+    scale_model = args.scale or config['scale']['model']
+    pty_scale = PtyScale(
+        VirtualScale(scale_model, powder_model),
+        # Each motor is driven by its own TRICKLER_MOTOR_SPEED_N key, or by the speed every motor publishes to without
+        # one, as if all of them ran at the speed last set.
+        [motor_speed(config['memcache_vars'].get(f'TRICKLER_MOTOR_SPEED_{x + 1}', constants.TRICKLER_MOTOR_SPEED.value))
+            for x in range(len(powder_model.flow_rates))],
+        baudrate=args.baudrate or config['scale']['baudrate'],
+        frame_rate=args.frame_rate or float(sim_config.get('frame_rate', 10)),
+        link=args.link or sim_config.get('link'))
+    logging.info('Virtual %s scale listening on %s', scale_model, pty_scale.link or pty_scale.port)
+    threading.Thread(target=read_console, args=(pty_scale.virtual_scale,), daemon=True).start()
+    pty_scale.run()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+
+Stability detectors for scales, fed one weight reading at a time in integer resolution ticks.
+"""
+
+import collections
+
+
+class StabilityDetector:
+    """Base class for stability detectors. Every call to push() is O(1)."""
+
+    def push(self, ticks, timestamp):
+        """Add a reading (resolution ticks, monotonic ns) and return True if the scale is considered stable."""
+        raise NotImplementedError('The push() method needs to be defined in a stability detector class.')
+
+    def reset(self):
+        """Forget all readings, such as after a change of unit."""
+        raise NotImplementedError('The reset() method needs to be defined in a stability detector class.')
+
+
+class IdenticalReadings(StabilityDetector):
+    """Stable once the last `length` readings are identical."""
+
+    def __init__(self, length):
+        """Constructor."""
+        self.length = length
+        self._last = None
+        self._count = 0
+
+    def push(self, ticks, timestamp):
+        """Add a reading and return True if the scale is considered stable."""
+        if ticks == self._last:
+            self._count += 1
+        else:
+            self._last = ticks
+            self._count = 1
+        return self._count >= self.length
+
+    def reset(self):
+        """Forget all readings."""
+        self._last = None
+        self._count = 0
+
+
+class StatisticalStability(StabilityDetector): # pylint: disable=too-many-instance-attributes;
+    """Stable once the readings in a sliding window have a small spread and no trend, for long enough.
+
+    Running sums over the window give the mean, variance and least-squares slope without revisiting old readings,
+    so a last digit flickering by a tick doesn't reset stability the way identical readings would.
+    """
+
+    def __init__(self, window, tolerance, slope, settle_time):
+        """Constructor.
+
+        window: number of readings to consider.
+        tolerance: maximum standard deviation, in ticks.
+        slope: maximum trend, in ticks/second.
+        settle_time: seconds the first two conditions must hold before the scale is considered stable.
+        """
+        self.window = window
+        self.tolerance = tolerance
+        self.slope_limit = slope
+        self.settle_ns = int(settle_time * 1e9)
+        self._readings = collections.deque()
+        self.reset()
+
+    def reset(self):
+        """Forget all readings."""
+        self._readings.clear()
+        # Readings are numbered from zero as they arrive, so the slope can be fit against the reading number.
+        self._index = 0
+        self._sum = 0
+        self._sum_squares = 0
+        self._sum_products = 0
+        self._settled_since = None
+        self.mean = None
+        self.variance = None
+        self.slope = None
+
+    def push(self, ticks, timestamp):
+        """Add a reading and return True if the scale is considered stable."""
+        readings = self._readings
+        readings.append((self._index, ticks, timestamp))
+        self._sum += ticks
+        self._sum_squares += ticks * ticks
+        self._sum_products += self._index * ticks
+        self._index += 1
+        if len(readings) > self.window:
+            index, old, _ = readings.popleft()
+            self._sum -= old
+            self._sum_squares -= old * old
+            self._sum_products -= index * old
+        count = len(readings)
+        if count < self.window:
+            self._settled_since = None
+            return False
+
+        self.mean = self._sum / count
+        self.variance = (count * self._sum_squares - self._sum * self._sum) / (count * count)
+        # Least-squares slope against the reading number, using closed forms for the sums of the reading numbers.
+        first = readings[0][0]
+        sum_index = count * first + count * (count - 1) // 2
+        sum_index_squares = (
+            count * first * first + first * count * (count - 1) + (count - 1) * count * (2 * count - 1) // 6)
+        denominator = count * sum_index_squares - sum_index * sum_index
+        per_reading = (count * self._sum_products - sum_index * self._sum) / denominator if denominator else 0.0
+        elapsed = (readings[-1][2] - readings[0][2]) / 1e9
+        self.slope = per_reading * (count - 1) / elapsed if elapsed > 0 else 0.0
+
+        if self.variance > self.tolerance * self.tolerance or abs(self.slope) > self.slope_limit:
+            self._settled_since = None
+            return False
+        if self._settled_since is None:
+            self._settled_since = timestamp
+        return timestamp - self._settled_since >= self.settle_ns
+
+
+def from_config(config, **kwargs):
+    """Returns the stability detector selected by the [scale] section of the config."""
+    scale_config = config['scale']
+    detector = kwargs.get('stability', scale_config.get('stability', 'identical'))
+    if detector == 'statistical':
+        return StatisticalStability(
+            int(kwargs.get('stable_window', scale_config.get('stable_window', 8))),
+            float(kwargs.get('stable_tolerance', scale_config.get('stable_tolerance', 1.0))),
+            float(kwargs.get('stable_slope', scale_config.get('stable_slope', 2.0))),
+            float(kwargs.get('stable_settle_time', scale_config.get('stable_settle_time', 0.2))))
+    if detector == 'identical':
+        return IdenticalReadings(int(scale_config['stable_reading_length']))
+    raise ValueError(f'Unknown stability detector: {detector!r}')
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+
+Local mirror of the settings other processes change through memcache, so the control loop reads them from memory.
+"""
+
+import atexit
+import logging
+import threading
+
+import helpers
+import statebus
+
+
+class StateMirror:
+    """Keeps a local copy of memcache keys, refreshed from a background thread with one get_multi() per interval.
+
+    Reads never touch the network, and a change made by another process (the app, screen or BLE) is seen within one
+    interval. Writes go straight through to memcache and are visible locally right away.
+    """
+
+    def __init__(self, memcache, keys, interval=0.02, client=None):
+        """Constructor. memcache is used for writes from the caller's thread, client for polling in the background.
+        Without a client, one is made for the default memcache server."""
+        self._memcache = memcache
+        # Memcache clients aren't thread-safe, so the background thread has its own.
+        self._client = client or helpers.get_mc_client()
+        self._keys = list(keys)
+        self._interval = interval
+        self._values = {}
+        self._lock = threading.Lock()
+        # Bumped by every local write, so a poll that started before the write doesn't replace it with older values.
+        self._writes = 0
+        self._failing = False
+        self._stop = threading.Event()
+        self.refreshes = 0
+        self.errors = 0
+        self._refresh()
+        self._thread = threading.Thread(target=self._run, name='state-mirror', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def get(self, key, default=None):
+        """Returns the mirrored value of a key."""
+        return self._values.get(key, default)
+
+    def set(self, key, value):
+        """Writes a value to memcache and the mirror."""
+        self.set_multi({key: value})
+
+    def set_multi(self, values):
+        """Writes a dict of values to memcache and the mirror."""
+        self._memcache.set_multi(values)
+        with self._lock:
+            self._writes += 1
+            self._values = {**self._values, **values}
+
+    def close(self):
+        """Stop the background thread."""
+        self._stop.set()
+        self._thread.join(timeout=self._interval * 4 + 1)
+
+    def _refresh(self):
+        """Fetch the mirrored keys from memcache."""
+        writes = self._writes
+        try:
+            values = self._client.get_multi(self._keys)
+        except Exception: # pylint: disable=broad-except;
+            self.errors += 1
+            if not self._failing:
+                # Only log the first failure in a row, the mirror keeps its last values until memcache is back.
+                logging.exception('State mirror failed to read from memcache, will keep trying.')
+                self._failing = True
+            return
+        if self._failing:
+            logging.info('State mirror reading from memcache again after %d failures.', self.errors)
+            self._failing = False
+        self.refreshes += 1
+        with self._lock:
+            if writes != self._writes:
+                return
+            # Replaced rather than updated, so readers always see a complete snapshot.
+            self._values = {**self._values, **values}
+
+    def _run(self):
+        """Background thread which keeps the mirror up to date."""
+        while not self._stop.wait(self._interval):
+            self._refresh()
+
+
+def mirror_settings(config, memcache, constants):
+    """Returns a StateMirror of the settings the trickler takes from other processes.
+
+    The shared-memory state bus is already read from memory, so it's returned as it is.
+    """
+    if isinstance(memcache, statebus.StateBusClient):
+        return memcache
+    interval = 0.02
+    if config.has_section('state'):
+        interval = float(config['state'].get('poll_interval', interval))
+    keys = (constants.AUTO_MODE.value, constants.TARGET_WEIGHT.value, constants.TARGET_UNIT.value)
+    # The polling client is built as the caller's was, so it reaches the same [state] memcache_server.
+    return StateMirror(memcache, keys, interval, helpers.get_state_client(config))
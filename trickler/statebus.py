@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+
+Shared-memory state bus for the trickler daemons, in place of memcache.
+
+The segment holds one fixed-size slot per [memcache_vars] variable, in a binary layout every process derives from the
+config. Each slot has a sequence number which is odd while it's being written, so readers copy the value and retry if
+the sequence changed underneath them (a seqlock) instead of taking a lock. The sequence number also serves as the
+field's generation counter, so readers can tell when it has changed. Writers from any process are serialized by a lock
+file, so a slot still odd once a reader holds the lock was left by a writer which died mid-write, and is cleared.
+"""
+
+import decimal
+import fcntl
+import logging
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+
+from multiprocessing import shared_memory
+from multiprocessing import resource_tracker
+
+
+MAGIC = b'OTSB'
+VERSION = 1
+# Magic, version, field count, layout checksum, then the count of changes to any field.
+HEADER = struct.Struct('<4sHHI4xQ')
+CHANGES_OFFSET = 16
+# Sequence number and length of the value, followed by the value itself.
+SLOT_HEADER = struct.Struct('<QI')
+SEQUENCE = struct.Struct('<Q')
+BOOL = struct.Struct('<?')
+FLOAT = struct.Struct('<d')
+# Decimal as an integer count of 10**exponent.
+DECIMAL = struct.Struct('<qb')
+DECIMAL_COUNTS = (-2 ** 63, 2 ** 63 - 1)
+DECIMAL_EXPONENTS = (-128, 127)
+# Times read() retries a slot being written before yielding the CPU between tries, and the seconds before it checks
+# whether the writer died.
+READ_SPINS = 100
+READ_TIMEOUT = 0.1
+
+
+class StateBusError(Exception):
+    """Shared-memory state bus could not be opened."""
+
+
+class Field:
+    """Encoding of one variable in its slot. Values which don't fit are pickled."""
+
+    def __init__(self, kind, capacity=None):
+        """Constructor."""
+        self.kind = kind
+        self.capacity = capacity or {'bool': BOOL.size, 'float': FLOAT.size, 'decimal': DECIMAL.size}[kind]
+
+    def encode(self, value):
+        """Returns the bytes for a value, or b'' for None."""
+        if value is None:
+            return b''
+        if self.kind == 'bool':
+            return BOOL.pack(value)
+        if self.kind == 'float':
+            return FLOAT.pack(value)
+        if self.kind == 'decimal':
+            # A float is stored as its shortest repr, rather than every digit of its binary value.
+            number = decimal.Decimal(repr(value) if isinstance(value, float) else value)
+            if not number.is_finite():
+                raise ValueError(f'{value!r} is not a finite decimal.')
+            sign, digits, exponent = number.as_tuple()
+            counts = int(''.join(map(str, digits)))
+            counts = -counts if sign else counts
+            if not (DECIMAL_COUNTS[0] <= counts <= DECIMAL_COUNTS[1]
+                    and DECIMAL_EXPONENTS[0] <= exponent <= DECIMAL_EXPONENTS[1]):
+                raise ValueError(f'{value!r} has too many digits for a decimal slot.')
+            return DECIMAL.pack(counts, exponent)
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.capacity:
+            raise ValueError(f'{value!r} is {len(data)} bytes pickled, more than the {self.capacity} byte slot.')
+        return data
+
+    def decode(self, data):
+        """Returns the value for the bytes of a slot."""
+        if not data:
+            return None
+        if self.kind == 'bool':
+            return BOOL.unpack(data)[0]
+        if self.kind == 'float':
+            return FLOAT.unpack(data)[0]
+        if self.kind == 'decimal':
+            counts, exponent = DECIMAL.unpack(data)
+            return decimal.Decimal(counts).scaleb(exponent)
+        return pickle.loads(data)
+
+
+# Encodings of the known variables, by their [memcache_vars] name. Anything else is pickled into a DEFAULT_FIELD slot.
+FIELDS = {
+    'AUTO_MODE': Field('bool'),
+    'SCALE_IS_STABLE': Field('bool'),
+    'SCALE_RESOLUTION': Field('decimal'),
+    'SCALE_STATUS': Field('pickle', 96),
+    'SCALE_UNIT': Field('pickle', 96),
+    'SCALE_UNITS': Field('pickle', 512),
+    'SCALE_WEIGHT': Field('decimal'),
+    'SCALE_UNIT_MAP': Field('pickle', 512),
+    'SCALE_REVERSE_UNIT_MAP': Field('pickle', 512),
+    'SCALE_STATUS_MAP': Field('pickle', 512),
+    'SCALE_RESOLUTION_MAP': Field('pickle', 512),
+    'TARGET_WEIGHT': Field('decimal'),
+    'TARGET_UNIT': Field('pickle', 96),
+    'TRICKLER_MOTOR_SPEED': Field('float'),
+    'TRICKLER_MOTOR_SPEED_1': Field('float'),
+    'TRICKLER_MOTOR_SPEED_2': Field('float'),
+    'TRICKLER_MOTOR_SPEED_3': Field('float'),
+}
+DEFAULT_FIELD = Field('pickle', 256)
+
+
+def layout(memcache_vars):
+    """Returns the slots as a dict of key: (offset, Field), the segment size and a checksum of the layout."""
+    slots = {}
+    offset = HEADER.size
+    description = []
+    for name, key in memcache_vars.items():
+        field = FIELDS.get(name, DEFAULT_FIELD)
+        slots[key] = (offset, field)
+        description.append(f'{key}:{field.kind}:{field.capacity}')
+        # Keep every sequence number 8-byte aligned.
+        offset += (SLOT_HEADER.size + field.capacity + 7) // 8 * 8
+    return slots, offset, zlib.crc32(','.join(description).encode('utf-8'))
+
+
+class StateBus:
+    """Shared-memory segment holding the trickler state, created by whichever process opens it first."""
+
+    def __init__(self, name, memcache_vars):
+        """Constructor."""
+        self.name = name
+        self.slots, size, checksum = layout(memcache_vars)
+        try:
+            self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            created = True
+        except FileExistsError:
+            self._shm = shared_memory.SharedMemory(name=name)
+            created = False
+        # The segment outlives every process using it, so don't let this one's resource tracker remove it at exit.
+        resource_tracker.unregister(self._shm._name, 'shared_memory') # pylint: disable=protected-access;
+        self._buf = self._shm.buf
+        self._lock = threading.Lock()
+        self._lock_file = os.open(os.path.join('/dev/shm', f'{name}.lock'), os.O_RDWR | os.O_CREAT, 0o666)
+        if created:
+            # The magic number goes in last, so other processes know the header is complete.
+            HEADER.pack_into(self._buf, 0, b'\0\0\0\0', VERSION, len(self.slots), checksum, 0)
+            self._buf[0:4] = MAGIC
+        else:
+            self._check_header(size, checksum)
+
+    def _check_header(self, size, checksum):
+        """Wait for a segment created by another process to be ready, and make sure it has the same layout."""
+        deadline = time.monotonic() + 1
+        while bytes(self._buf[0:4]) != MAGIC:
+            if time.monotonic() > deadline:
+                raise StateBusError(f'Shared memory {self.name} is not a state bus.')
+            time.sleep(0.01)
+        _, version, _, existing, _ = HEADER.unpack_from(self._buf, 0)
+        if version != VERSION or existing != checksum or self._shm.size < size:
+            raise StateBusError(
+                f'Shared memory {self.name} has a different layout, [memcache_vars] may have changed. Stop every '
+                f'trickler daemon and remove /dev/shm/{self.name} to recreate it.')
+
+    def read(self, key):
+        """Returns the (generation, bytes) of a slot, consistently with any concurrent write."""
+        offset, _ = self.slots[key]
+        buf = self._buf
+        tries = 0
+        deadline = None
+        while 1:
+            sequence, length = SLOT_HEADER.unpack_from(buf, offset)
+            if not sequence & 1:
+                data = bytes(buf[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + length])
+                if SEQUENCE.unpack_from(buf, offset)[0] == sequence:
+                    return sequence >> 1, data
+            # A write is in progress.
+            tries += 1
+            if tries < READ_SPINS:
+                continue
+            now = time.monotonic()
+            if deadline is None:
+                deadline = now + READ_TIMEOUT
+            elif now >= deadline:
+                self._recover(key)
+                deadline = None
+            time.sleep(0)
+
+    def _recover(self, key):
+        """Clears a slot left mid-write by a writer which died, so readers don't wait on it forever."""
+        offset, _ = self.slots[key]
+        with self._lock:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                sequence = SEQUENCE.unpack_from(self._buf, offset)[0]
+                # Holding the lock, no write is in progress, so the value may be torn.
+                if sequence & 1:
+                    logging.warning('State bus field %s was left mid-write, clearing it.', key)
+                    SLOT_HEADER.pack_into(self._buf, offset, sequence + 1, 0)
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def generation(self, key):
+        """Returns the number of times a field has been written."""
+        offset, _ = self.slots[key]
+        return SEQUENCE.unpack_from(self._buf, offset)[0] + 1 >> 1
+
+    @property
+    def changes(self):
+        """Returns the number of writes to any field."""
+        return SEQUENCE.unpack_from(self._buf, CHANGES_OFFSET)[0]
+
+    def write(self, values):
+        """Writes a dict of key: bytes, each as one atomic update of its slot."""
+        buf = self._buf
+        with self._lock:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                for key, data in values.items():
+                    offset, _ = self.slots[key]
+                    sequence = SEQUENCE.unpack_from(buf, offset)[0]
+                    # Odd while writing, so readers retry.
+                    SLOT_HEADER.pack_into(buf, offset, sequence + 1, len(data))
+                    buf[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + len(data)] = data
+                    SEQUENCE.pack_into(buf, offset, sequence + 2)
+                SEQUENCE.pack_into(buf, CHANGES_OFFSET, self.changes + len(values))
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def close(self):
+        """Detach from the segment, leaving it in place for the other processes."""
+        self._buf = None
+        self._shm.close()
+        os.close(self._lock_file)
+
+
+class StateBusClient:
+    """Drop-in replacement for the memcache client calls the trickler daemons make: get, get_multi, set, set_multi.
+
+    Decoded values are cached per field until its generation changes, so repeated reads of a field are one sequence
+    number check. Values are shared between readers in a process, so don't modify them in place.
+    """
+
+    def __init__(self, name, memcache_vars):
+        """Constructor."""
+        self.bus = StateBus(name, memcache_vars)
+        self._cache = {}
+
+    def get(self, key, default=None):
+        """Returns the value of a key, or default if it was never set."""
+        offset, field = self.bus.slots[key]
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] == SEQUENCE.unpack_from(self.bus._buf, offset)[0] >> 1: # pylint: disable=protected-access;
+            value = cached[1]
+        else:
+            generation, data = self.bus.read(key)
+            value = field.decode(data)
+            self._cache[key] = (generation, value)
+        return default if value is None else value
+
+    def get_multi(self, keys):
+        """Returns a dict of the keys which are set."""
+        values = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def set(self, key, value, *args, **kwargs): # pylint: disable=unused-argument;
+        """Sets the value of a key. Returns True, like memcache."""
+        self.set_multi({key: value})
+        return True
+
+    def set_multi(self, values, *args, **kwargs): # pylint: disable=unused-argument;
+        """Sets the values of a dict of keys. Returns the list of keys which failed, which is always empty."""
+        self.bus.write({key: self.bus.slots[key][1].encode(value) for key, value in values.items()})
+        return []
+
+    def generation(self, key):
+        """Returns the number of times a key has been set."""
+        return self.bus.generation(key)
+
+    def close(self):
+        """Detach from the state bus."""
+        self.bus.close()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+
+Multi-station mode: several tricklers, each with its own scale, motors and servo, driven from one process.
+
+Each [station.X] section of the config overrides options of the shared sections with section.option keys, such as
+scale.port = /dev/ttyUSB1 or motor1.trickler_pin = 13. Every station's memcache_vars are prefixed with its key_prefix
+(X_ by default) so the stations don't share state. All of the scales are read by one selector-based I/O thread, and
+every station runs its control loop in its own thread, so a slow scale or station doesn't hold up the others.
+"""
+
+import configparser
+import enum
+import logging
+import os
+import selectors
+import signal
+import threading
+import time
+
+import serial # pylint: disable=import-error;
+
+import calibration
+import cascade
+import charges
+import controller
+import cutoff
+import dump
+import helpers
+import main
+import motors
+import scales
+import scheduler
+import state
+import telemetry
+
+
+# Config sections which declare a station, followed by its name.
+STATION_PREFIX = 'station.'
+
+
+def station_names(config):
+    """Returns the names of the stations declared in the config, in order."""
+    return [x[len(STATION_PREFIX):] for x in config.sections() if x.startswith(STATION_PREFIX)]
+
+
+def station_config(config, name):
+    """Returns a copy of the config with the [station.name] overrides applied and namespaced memcache_vars."""
+    station = config[STATION_PREFIX + name]
+    derived = configparser.ConfigParser()
+    derived.optionxform = str
+    derived.read_dict({x: dict(config[x]) for x in config.sections() if not x.startswith(STATION_PREFIX)})
+    # Stations must not share a cached scale profile, state bus or probe each other's ports, unless configured to.
+    if derived.has_section('state'):
+        derived['state']['bus_name'] = f'{derived["state"].get("bus_name", "opentrickler")}_{name}'
+    derived['scale']['profile_cache'] = f'/var/tmp/opentrickler_scale_profile_{name}.json'
+    if not derived.has_section('telemetry'):
+        derived.add_section('telemetry')
+    root, ext = os.path.splitext(derived['telemetry'].get('file', '/var/tmp/opentrickler_telemetry.bin'))
+    derived['telemetry']['file'] = f'{root}_{name}{ext}'
+    derived['scale']['auto_detect'] = 'False'
+    for key, value in station.items():
+        if key == 'key_prefix':
+            continue
+        section, _, option = key.partition('.')
+        if not option:
+            raise ValueError(f'[{STATION_PREFIX}{name}] option {key!r} must be in the form section.option')
+        if not derived.has_section(section):
+            derived.add_section(section)
+        derived[section][option] = value
+    prefix = station.get('key_prefix', f'{name}_')
+    for key, value in config['memcache_vars'].items():
+        derived['memcache_vars'][key] = prefix + value
+    return derived
+
+
+class ScaleMultiplexer:
+    """Reads the serial ports of many scales from one thread with a selector, filling each scale's frame buffer."""
+
+    def __init__(self, poll_interval=0.05):
+        """Constructor. poll_interval (seconds) bounds how late a command retry or timeout can be."""
+        self._selector = selectors.DefaultSelector()
+        self._scales = []
+        self._poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, scale):
+        """Start reading a scale. Scales must be added before start()."""
+        scale.buffer_frames()
+        self._selector.register(scale.fileno(), selectors.EVENT_READ, scale)
+        self._scales.append(scale)
+
+    def start(self):
+        """Start the I/O thread."""
+        self._thread = threading.Thread(target=self._run, name='scale-multiplexer', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Stop the I/O thread."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=self._poll_interval * 4)
+        self._selector.close()
+
+    def _run(self):
+        """I/O loop, which only wakes up when a scale has sent something."""
+        while not self._stop.is_set():
+            for key, _ in self._selector.select(self._poll_interval):
+                try:
+                    key.data.read_available()
+                except (serial.SerialException, OSError):
+                    logging.exception('Failed to read from scale on fd %r, no longer reading it.', key.fd)
+                    self._selector.unregister(key.fd)
+            for scale in self._scales:
+                scale.poll_commands()
+
+
+class Station: # pylint: disable=too-many-instance-attributes;
+    """One trickler with its own scale, trickler motors, servo and PID controller."""
+
+    def __init__(self, name, config, pid_tune=False):
+        """Constructor. pid_tune records telemetry of every charge."""
+        self.name = name
+        self.config = station_config(config, name)
+        # Memcache clients aren't thread-safe, so every station gets its own.
+        memcache = helpers.get_state_client(self.config)
+        self.constants = enum.Enum('memcache_vars', self.config['memcache_vars'])
+        self.pid = controller.from_config(self.config)
+        self.cascade = cascade.from_config(
+            self.config, self.pid, lambda x: motors.TricklerMotor(x, self.config, memcache=memcache))
+        self.servo_motor = motors.ServoMotor(self.config, memcache=memcache)
+        # The multiplexer reads the scale, so it mustn't start its own reader thread.
+        self.scale = scales.connect(self.config, memcache=memcache, reader_thread=False)
+        logging.debug('station %s: scale %r on %s', name, self.scale, self.config['scale']['port'])
+        self.loop_scheduler = scheduler.from_config(self.config)
+        self.settings = state.mirror_settings(self.config, memcache, self.constants)
+        self.recorder = telemetry.from_config(self.config, pid_tune)
+        # Stations share the charge database, with the station's name on every charge.
+        self.charge_log = charges.from_config(self.config, name)
+        # Stations share the cutoff profiles file too. Set cutoff.profile for the powder each station trickles.
+        self.cutoff = cutoff.from_config(self.config)
+        self.dump_sequence = dump.from_config(self.config)
+        self.dump_calibration = calibration.from_config(self.config)
+        self._thread = None
+
+    def start(self, args):
+        """Run the station's control loop in its own thread."""
+        self._thread = threading.Thread(
+            target=main.control_loop,
+            args=(self.settings, self.constants, self.pid, self.cascade,
+                self.servo_motor, self.scale, args, self.recorder, self.loop_scheduler, self.charge_log,
+                self.cutoff, self.dump_sequence, self.dump_calibration),
+            name=f'station-{self.name}',
+            daemon=True)
+        self._thread.start()
+
+    @property
+    def running(self):
+        """Returns True while the control loop is running."""
+        return self._thread is not None and self._thread.is_alive()
+
+
+def run(config, args, pid_tune=False):
+    """Set up every station declared in the config and run them until one of them stops."""
+    multiplexer = ScaleMultiplexer()
+    stations = []
+    for name in station_names(config):
+        # Wait until the scale is ready, as in main.main().
+        while 1:
+            try:
+                station = Station(name, config, pid_tune)
+            except scales.ScaleNotReady:
+                logging.info('Station %s scale not ready, trying again...', name)
+                time.sleep(10)
+            else:
+                break
+        multiplexer.add(station.scale)
+        stations.append(station)
+    multiplexer.start()
+
+    def dump_metrics(*_):
+        for station in stations:
+            logging.info('station %s:', station.name)
+            station.scale.dump_metrics()
+            station.loop_scheduler.metrics.dump()
+
+    # Dump the scale I/O and control loop metrics of every station on demand with: kill -USR1 <pid>
+    signal.signal(signal.SIGUSR1, dump_metrics)
+
+    logging.info('Running stations: %s', ', '.join(x.name for x in stations))
+    for station in stations:
+        station.start(args)
+    while all(x.running for x in stations):
+        time.sleep(1)
+    stopped = [x.name for x in stations if not x.running]
+    multiplexer.close()
+    raise RuntimeError(f'Station control loop stopped: {", ".join(stopped)}')
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+
+Binary telemetry of the trickler control loop, in a ring of fixed-width records in a memory-mapped file.
+
+The control loop writes one record per tick with pack_into() on the mapping, which costs about as much as a dict
+update and never waits on the disk. The file is preallocated, so the oldest records are overwritten once it's full.
+Records are read back as NumPy arrays over the same mapping, and can be exported to CSV for pidtuner.com:
+
+    python3 telemetry.py /var/tmp/opentrickler_telemetry.bin --csv charge.csv
+"""
+
+import atexit
+import mmap
+import os
+import struct
+import time
+
+
+MAGIC = b'OTTM'
+VERSION = 2
+# Magic, version, record size, capacity, then the count of records ever written. Padded to 64 bytes so the records
+# are aligned.
+HEADER = struct.Struct('<4sHHI4xQ')
+HEADER_SIZE = 64
+COUNT = struct.Struct('<Q')
+COUNT_OFFSET = 16
+# Columns of a record, in order, with their struct codes.
+COLUMNS = (
+    ('timestamp', 'q'),     # time.monotonic_ns() of the control loop tick.
+    ('wall_offset', 'q'),   # Offset of the wall clock from the monotonic timestamps at the start of the charge, in ns.
+    ('charge', 'I'),        # Number of the charge, counting up for the life of the file.
+    ('weight_ticks', 'i'),  # Scale weight, in counts of the resolution.
+    ('target_ticks', 'i'),  # Target weight, in counts of the resolution.
+    ('resolution', 'f'),    # Weight of one tick, in the scale unit.
+    ('p', 'f'),             # Proportional, integral and derivative terms of the PID output.
+    ('i', 'f'),
+    ('d', 'f'),
+    ('output', 'f'),        # PID output.
+    ('motor1', 'f'),        # Speeds of trickler motors 1 and 2, 0 - 1.
+    ('motor2', 'f'),
+    ('phase', 'B'),         # The first running stage of the cascade, counting from 1.
+)
+RECORD = struct.Struct('<' + ''.join(x[1] for x in COLUMNS) + '7x')
+
+
+class TelemetryError(Exception):
+    """Telemetry file could not be read."""
+
+
+class Recorder:
+    """Writes control loop telemetry into a ring file, creating it or appending to an existing one."""
+
+    def __init__(self, path, capacity=65536):
+        """Constructor. capacity is the number of records in the ring."""
+        self.path = path
+        size = HEADER_SIZE + capacity * RECORD.size
+        self._file = open(path, 'a+b') # pylint: disable=consider-using-with;
+        self._file.seek(0)
+        header = self._file.read(HEADER.size)
+        reuse = False
+        if len(header) == HEADER.size:
+            magic, version, record_size, existing, _ = HEADER.unpack(header)
+            reuse = (magic, version, record_size, existing) == (MAGIC, VERSION, RECORD.size, capacity)
+        if not reuse:
+            self._file.truncate(0)
+            self._file.truncate(size)
+        self._mmap = mmap.mmap(self._file.fileno(), size)
+        self.capacity = capacity
+        self.wall_offset = time.time_ns() - time.monotonic_ns()
+        if reuse:
+            self.count = COUNT.unpack_from(self._mmap, COUNT_OFFSET)[0]
+            self.charge = self._last_charge()
+        else:
+            self.count = 0
+            self.charge = 0
+            HEADER.pack_into(self._mmap, 0, MAGIC, VERSION, RECORD.size, capacity, 0)
+        atexit.register(self.close)
+
+    def _last_charge(self):
+        """Returns the charge number of the newest record."""
+        if not self.count:
+            return 0
+        offset = HEADER_SIZE + (self.count - 1) % self.capacity * RECORD.size
+        return RECORD.unpack_from(self._mmap, offset)[2]
+
+    def start_charge(self):
+        """Starts numbering records with the next charge number."""
+        self.charge += 1
+        # The clocks drift apart over days of uptime, so each charge's records carry the offset from its start.
+        self.wall_offset = time.time_ns() - time.monotonic_ns()
+
+    def record(self, timestamp, weight_ticks, target_ticks, resolution, pid, motor1, motor2, phase): # pylint: disable=too-many-arguments;
+        """Writes a record for one tick of the control loop."""
+        offset = HEADER_SIZE + self.count % self.capacity * RECORD.size
+        RECORD.pack_into(
+            self._mmap,
+            offset,
+            timestamp,
+            self.wall_offset,
+            self.charge,
+            weight_ticks,
+            target_ticks,
+            resolution,
+            pid.PTerm,
+            # controller.Controller keeps the integral's share of the output through bands with a Ki of 0.
+            getattr(pid, 'integral_gain', pid.Ki) * pid.ITerm,
+            pid.Kd * pid.DTerm,
+            pid.output,
+            motor1,
+            motor2,
+            phase)
+        self.count += 1
+        # Published after the record, so a reader never sees a count which includes a partial record.
+        COUNT.pack_into(self._mmap, COUNT_OFFSET, self.count)
+
+    def close(self):
+        """Unmap the file. The kernel writes back whatever it hasn't yet."""
+        if not self._mmap.closed:
+            self._mmap.close()
+            self._file.close()
+
+
+def dtype():
+    """Returns the NumPy structured dtype of a record."""
+    import numpy # pylint: disable=import-outside-toplevel,import-error;
+    return numpy.dtype({
+        'names': [x[0] for x in COLUMNS],
+        'formats': ['<' + x[1] for x in COLUMNS],
+        'offsets': [struct.calcsize('<' + ''.join(x[1] for x in COLUMNS[:i])) for i in range(len(COLUMNS))],
+        'itemsize': RECORD.size,
+    })
+
+
+class Reader:
+    """Maps a telemetry file read-only and exposes its records as NumPy arrays, without copying them.
+
+    Records are only copied when the ring has wrapped, to put them back in order. A recorder may keep writing while
+    the file is read, so take the records once and work from that array.
+    """
+
+    def __init__(self, path):
+        """Constructor."""
+        import numpy # pylint: disable=import-outside-toplevel,import-error;
+        with open(path, 'rb') as telemetry_file:
+            self._mmap = mmap.mmap(telemetry_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size, self.capacity, _ = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+            raise TelemetryError(f'{path} is not a version {VERSION} telemetry file.')
+        self.ring = numpy.frombuffer(self._mmap, dtype(), self.capacity, HEADER_SIZE)
+
+    @property
+    def count(self):
+        """Returns the number of records ever written."""
+        return COUNT.unpack_from(self._mmap, COUNT_OFFSET)[0]
+
+    def records(self, charge=None):
+        """Returns the records in the ring, oldest first, optionally only those of one charge."""
+        import numpy # pylint: disable=import-outside-toplevel,import-error;
+        count = self.count
+        if count <= self.capacity:
+            records = self.ring[:count]
+        else:
+            start = count % self.capacity
+            records = numpy.concatenate((self.ring[start:], self.ring[:start]))
+        if charge is not None:
+            records = records[records['charge'] == charge]
+        return records
+
+    def column(self, name, charge=None):
+        """Returns one column of the records, such as 'weight_ticks'."""
+        return self.records(charge)[name]
+
+    def charges(self):
+        """Returns the charge numbers in the ring, in order."""
+        import numpy # pylint: disable=import-outside-toplevel,import-error;
+        return numpy.unique(self.records()['charge']).tolist()
+
+    def close(self):
+        """Unmap the file. Arrays returned by the reader must not be used afterwards."""
+        self.ring = None
+        self._mmap.close()
+
+
+def export_pidtuner(reader, output, charge=None):
+    """Writes records as CSV for pidtuner.com: wall clock seconds, input (motor %) and output (weight %)."""
+    records = reader.records(charge)
+    seconds = (records['timestamp'] + records['wall_offset']) / 1e9
+    motor = records['motor1'] * 100
+    weight = records['weight_ticks'] / records['target_ticks'].clip(1) * 100
+    output.write('timestamp, input (motor %), output (weight %)\n')
+    for row in zip(seconds.tolist(), motor.tolist(), weight.tolist()):
+        output.write('%.6f, %.4f, %.4f\n' % row)
+    return len(records)
+
+
+def from_config(config, enabled=False):
+    """Returns a Recorder for the [telemetry] section of the config, or None if telemetry is off."""
+    telemetry_config = config['telemetry'] if config.has_section('telemetry') else {}
+    if not (enabled or str(telemetry_config.get('enabled', False)).lower() in ('1', 'true', 'yes', 'on')):
+        return None
+    path = telemetry_config.get('file', '/var/tmp/opentrickler_telemetry.bin')
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    return Recorder(path, int(telemetry_config.get('capacity', 65536)))
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description='Read OpenTrickler control loop telemetry.')
+    parser.add_argument('telemetry_file')
+    parser.add_argument('--charge', type=int, help='Only this charge, default the latest. 0 for all of them.')
+    parser.add_argument('--csv', help='Export to a CSV file for pidtuner.com, - for stdout.')
+    args = parser.parse_args()
+
+    telemetry = Reader(args.telemetry_file)
+    charges = telemetry.charges()
+    if not charges:
+        print('No records.')
+        sys.exit(1)
+    selected = charges[-1] if args.charge is None else args.charge or None
+    if args.csv:
+        if args.csv == '-':
+            export_pidtuner(telemetry, sys.stdout, selected)
+        else:
+            with open(args.csv, 'w', encoding='utf-8') as csv_file:
+                print(f'Exported {export_pidtuner(telemetry, csv_file, selected)} records to {args.csv}')
+    else:
+        print(f'{telemetry.count} records written, {min(telemetry.count, telemetry.capacity)} in the ring')
+        for number in charges if selected is None else [selected]:
+            charge_records = telemetry.records(number)
+            if not len(charge_records): # pylint: disable=use-implicit-booleaness-not-len;
+                continue
+            duration = (charge_records['timestamp'][-1] - charge_records['timestamp'][0]) / 1e9
+            final = charge_records[-1]
+            print(
+                f'charge {number}: {len(charge_records)} records over {duration:.1f}s, '
+                f'final weight {final["weight_ticks"] * final["resolution"]:.3f} of '
+                f'{final["target_ticks"] * final["resolution"]:.3f}')
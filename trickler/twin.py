@@ -0,0 +1,529 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+
+Digital twin of a trickler, running the unmodified main.trickler_loop() against a physics model on a virtual clock.
+
+The control loop's modules get a VirtualClock in place of the time module, so every sleep and every wait on the scale
+moves the simulated world forward instead of waiting, and a charge takes milliseconds. The scale is a real scale class
+reading from TwinSerial, which serves simulator.VirtualScale frames from a simulator.PowderModel. The motors, servo and
+memcache are in-process stand-ins.
+
+The benchmark runs a matrix of target weights and powder profiles and reports charges/hour, overshoot and time to
+target, which can be saved and compared against, to gate changes to the controller:
+
+    python3 twin.py opentrickler_config.ini --save baseline.json
+    python3 twin.py opentrickler_config.ini --compare baseline.json
+"""
+
+import collections
+import contextlib
+import decimal
+import enum
+import io
+import logging
+import random
+import time
+
+import calibration
+import cascade
+import controller
+import cutoff
+import dump
+import main
+import metrics
+import PID
+import publisher
+import scales
+import scheduler
+import simulator
+
+
+# Powder flow of some typical powders, as simulator.PowderModel arguments. Flows are in grams/second.
+PROFILES = {
+    # Small round grains which meter smoothly.
+    'ball': dict(flow_rates=(0.025, 0.08), stall_pwm=0.25, fall_time=0.3, scale_lag=0.25, flow_noise=0.15),
+    # Thin flakes which flow a little unevenly.
+    'flake': dict(flow_rates=(0.02, 0.06), stall_pwm=0.25, fall_time=0.35, scale_lag=0.25, flow_noise=0.3),
+    # Long sticks which bridge in the tube and fall in clumps.
+    'extruded': dict(flow_rates=(0.015, 0.05), stall_pwm=0.3, fall_time=0.4, scale_lag=0.25, flow_noise=0.5),
+}
+# Modules whose time module is replaced by the virtual clock.
+CLOCKED_MODULES = (controller, cutoff, dump, main, metrics, PID, publisher, scales, scheduler)
+
+# Outcome of one simulated charge. Weights are in the scale unit and times in seconds.
+ChargeResult = collections.namedtuple('ChargeResult', 'target final overshoot trickle_time cycle_time timed_out')
+
+
+class VirtualClock:
+    """Stands in for the time module. Time only passes by sleeping, which steps the world forward."""
+
+    def __init__(self, world=None, start=1000.0):
+        """Constructor."""
+        self.world = world
+        self._now = int(start * 1e9)
+
+    def monotonic_ns(self):
+        """Returns the virtual time in ns."""
+        return self._now
+
+    def monotonic(self):
+        """Returns the virtual time in seconds."""
+        return self._now / 1e9
+
+    time = monotonic
+    time_ns = monotonic_ns
+    perf_counter = monotonic
+    perf_counter_ns = monotonic_ns
+
+    def sleep(self, seconds):
+        """Moves the virtual time forward."""
+        self.advance_to(self._now + max(int(seconds * 1e9), 0))
+
+    def advance_to(self, timestamp):
+        """Moves the virtual time forward to a monotonic ns timestamp, stepping the world along with it."""
+        if timestamp <= self._now:
+            return
+        if self.world:
+            self.world.run_until(timestamp)
+        self._now = timestamp
+
+    def __getattr__(self, name):
+        # Everything else, such as strftime(), comes from the real time module.
+        return getattr(time, name)
+
+    @contextlib.contextmanager
+    def installed(self, modules=CLOCKED_MODULES):
+        """Replaces the time module of the control loop's modules with this clock, for the duration."""
+        originals = [(x, x.time) for x in modules]
+        for module in modules:
+            module.time = self
+        try:
+            yield self
+        finally:
+            for module, original in originals:
+                module.time = original
+
+
+class World:
+    """Steps the powder physics, and queues the frames the virtual scale sends, up to the virtual time."""
+
+    def __init__(self, virtual_scale, motors, frame_rate=10, step=0.01, start=1000.0):
+        """Constructor. motors are the trickler motors feeding the powder model, in order."""
+        self.virtual_scale = virtual_scale
+        self.motors = motors
+        self.time = int(start * 1e9)
+        self.frame_interval = int(1e9 / frame_rate)
+        self.next_frame = self.time + self.frame_interval
+        self._step = int(step * 1e9)
+        # Bytes sent by the scale and not yet read.
+        self.output = bytearray()
+        # Called once when the virtual time passes the deadline, such as to stop a charge which never finishes.
+        self.deadline = None
+        self.on_deadline = None
+
+    def run_until(self, timestamp):
+        """Advance the physics to a monotonic ns timestamp."""
+        while self.time < timestamp:
+            end = min(timestamp, self.next_frame, self.time + self._step)
+            self.virtual_scale.powder.step((end - self.time) / 1e9, [x.speed for x in self.motors])
+            self.time = end
+            if end >= self.next_frame:
+                frame = self.virtual_scale.frame()
+                if frame:
+                    self.output += frame
+                self.next_frame += self.frame_interval
+            if self.deadline is not None and end >= self.deadline:
+                self.deadline = None
+                self.on_deadline()
+
+
+class TwinSerial:
+    """Stands in for serial.Serial, reading the frames of a World. Waiting for a frame moves the virtual clock."""
+
+    def __init__(self, world, clock, timeout=0.1):
+        """Constructor."""
+        self.port = 'twin'
+        self.baudrate = 0
+        self.world = world
+        self.clock = clock
+        self.timeout = timeout
+        self._commands = b''
+
+    def _wait(self, condition):
+        """Move the virtual clock on a frame at a time until condition() is true or the timeout passes."""
+        deadline = self.clock.monotonic_ns() + int((self.timeout or 0) * 1e9)
+        while not condition() and self.clock.monotonic_ns() < deadline:
+            self.clock.advance_to(min(self.world.next_frame, deadline))
+
+    def readline(self):
+        """Returns the next line, or what arrived before the timeout."""
+        output = self.world.output
+        self._wait(lambda: b'\n' in output)
+        end = output.find(b'\n') + 1 or len(output)
+        data = bytes(output[:end])
+        del output[:end]
+        return data
+
+    def read(self, size=1):
+        """Returns up to size bytes, waiting for the first one until the timeout."""
+        output = self.world.output
+        self._wait(lambda: output)
+        data = bytes(output[:size])
+        del output[:size]
+        return data
+
+    @property
+    def in_waiting(self):
+        """Returns the number of bytes which have arrived and not been read."""
+        return len(self.world.output)
+
+    def reset_input_buffer(self):
+        """Throws away the bytes which have arrived."""
+        self.world.output.clear()
+
+    def write(self, data):
+        """Hands complete command lines to the virtual scale."""
+        self._commands += data
+        while b'\n' in self._commands:
+            line, self._commands = self._commands.split(b'\n', 1)
+            self.world.virtual_scale.command(line)
+        return len(data)
+
+    def fileno(self):
+        """The twin has no file descriptor to select on."""
+        raise io.UnsupportedOperation('The digital twin scale has no file descriptor.')
+
+    def close(self):
+        """Nothing to close."""
+
+
+class TwinTricklerMotor:
+    """Stands in for motors.TricklerMotor, with the same clamping of the PWM, feeding the powder model."""
+
+    def __init__(self, motor, config, **kwargs):
+        """Constructor."""
+        self.min_pwm = float(kwargs.get('min_pwm', config['motor' + str(motor)]['trickler_min_pwm']))
+        self.max_pwm = float(kwargs.get('max_pwm', config['motor' + str(motor)]['trickler_max_pwm']))
+        self.speed = 0.0
+
+    def update(self, target_pwm):
+        """Change PWM speed of motor (int), enforcing clamps."""
+        target_pwm = max(min(int(target_pwm), self.max_pwm), self.min_pwm)
+        self.set_speed(target_pwm / 100)
+
+    def set_speed(self, speed):
+        """Sets the PWM speed (float) and circumvents any clamps."""
+        if 0 <= speed <= 1:
+            self.speed = speed
+
+    def off(self):
+        """Turns motor off."""
+        self.set_speed(0)
+
+
+class TwinServoMotor:
+    """Stands in for motors.ServoMotor, dropping dump_mass grams of powder onto the pan when it runs to servo_angle.
+
+    Other angles tip out more or less of the measure's cavity, and a little more dribbles out for every second it's
+    held open.
+    """
+
+    def __init__(self, world, servo_angle=92.0, seed=None, **kwargs):
+        """Constructor."""
+        self.world = world
+        self.servo_angle = servo_angle
+        self.dump_mass = 0.0
+        self.dumps = 0
+        # Angle the measure starts to tip out at, and the most of dump_mass it holds.
+        self.spill_angle = kwargs.get('spill_angle', 30.0)
+        self.max_ratio = kwargs.get('max_ratio', 1.3)
+        # Fraction of the dump which dribbles out per second held open, for up to a second.
+        self.dwell_rate = kwargs.get('dwell_rate', 0.05)
+        # Relative noise on the mass of a dump.
+        self.noise = kwargs.get('noise', 0.01)
+        self._random = random.Random(seed)
+        self._opened = None
+
+    def run_servo(self, angle=None):
+        """Dumps the powder measure."""
+        angle = self.servo_angle if angle is None else angle
+        powder = self.world.virtual_scale.powder
+        ratio = min(max((angle - self.spill_angle) / (self.servo_angle - self.spill_angle), 0.0), self.max_ratio)
+        self._opened = (powder.time, self.dump_mass * ratio)
+        powder.dump(self.dump_mass * ratio * max(0.0, self._random.gauss(1.0, self.noise)))
+        self.dumps += 1
+
+    def set_initial_angle(self):
+        """Returns the measure to filling."""
+        if self._opened is not None:
+            powder = self.world.virtual_scale.powder
+            opened, mass = self._opened
+            powder.dump(mass * self.dwell_rate * min(powder.time - opened, 1.0))
+            self._opened = None
+
+    def off(self):
+        """Turns servo off."""
+
+    def stop(self):
+        """Nothing to release."""
+
+
+class MemoryStore:
+    """In-process stand-in for the memcache client: get, get_multi, set, set_multi."""
+
+    def __init__(self):
+        """Constructor."""
+        self._values = {}
+
+    def get(self, key, default=None):
+        """Returns the value of a key, or default if it was never set."""
+        return self._values.get(key, default)
+
+    def get_multi(self, keys):
+        """Returns a dict of the keys which are set."""
+        return {x: self._values[x] for x in keys if x in self._values}
+
+    def set(self, key, value, *args, **kwargs): # pylint: disable=unused-argument;
+        """Sets the value of a key."""
+        self._values[key] = value
+        return True
+
+    def set_multi(self, values, *args, **kwargs): # pylint: disable=unused-argument;
+        """Sets the values of a dict of keys."""
+        self._values.update(values)
+        return []
+
+
+class Twin: # pylint: disable=too-many-instance-attributes;
+    """A trickler with a simulated scale, motors and powder, whose charges run on a virtual clock."""
+
+    def __init__(self, config, profile=None, seed=None, **kwargs):
+        """Constructor. profile is a dict of simulator.PowderModel arguments."""
+        self.config = config
+        self.constants = enum.Enum('memcache_vars', dict(config['memcache_vars']))
+        self.store = MemoryStore()
+        self.powder = simulator.PowderModel(seed=seed, **(profile or {}))
+        self.virtual_scale = simulator.VirtualScale(kwargs.get('model', config['scale']['model']), self.powder)
+        self.pid = controller.from_config(config)
+        self.cascade = cascade.from_config(config, self.pid, lambda x: TwinTricklerMotor(x, config))
+        # The powder model's flow_rates are those of motor 1, 2 and so on.
+        self.world = World(
+            self.virtual_scale,
+            [self.cascade.motors[x] for x in sorted(self.cascade.motors, key=int)],
+            frame_rate=float(kwargs.get('frame_rate', 10)))
+        self.world.on_deadline = lambda: self.store.set(self.constants.AUTO_MODE.value, False)
+        self.clock = VirtualClock(self.world)
+        self.servo_motor = TwinServoMotor(self.world, float(config['servo']['servo_angle']), seed)
+        with self.clock.installed():
+            self.scale = self.virtual_scale.scale_cls(
+                config,
+                serial_port=TwinSerial(self.world, self.clock, float(config['scale']['timeout'])),
+                reader_thread=False,
+                capture_file='')
+            self.loop_scheduler = scheduler.from_config(config)
+            # The estimator starts from its initial lead without saving it, and settle() waits for the powder to land.
+            self.cutoff = cutoff.from_config(config, profiles_file='', settle_time=0)
+            self.dump_sequence = dump.from_config(config)
+            self.calibration = calibration.from_config(config, samples_file='')
+            self.scale.set_output_mode(self.scale.trickle_output_mode)
+            self.scale.update()
+
+    def settle(self, timeout=10.0):
+        """Reads the scale until the powder has landed and the scale is stable, or the timeout passes."""
+        deadline = self.clock.monotonic() + timeout
+        while self.clock.monotonic() < deadline:
+            self.scale.update()
+            # The flow from the tube dies away exponentially, so only count powder which would show on the scale.
+            if self.scale.is_stable and sum(x[1] for x in self.powder.in_flight) < 1e-6:
+                return True
+        return False
+
+    def run_charge(self, target, dump_fraction=0.9, max_time=120.0):
+        """Dumps and trickles one charge of target (in the scale unit) onto an empty pan. Returns a ChargeResult."""
+        target = decimal.Decimal(str(target))
+        grams = float(target)
+        if self.scale.unit == self.scale.Units.GRAINS:
+            grams /= scales.GRAINS_PER_GRAM
+        with self.clock.installed():
+            # Empty the pan and tare, as the reloader does between charges.
+            self.powder.toggle_pan()
+            self.powder.toggle_pan()
+            self.powder.tare()
+            self.store.set_multi({
+                self.constants.AUTO_MODE.value: True,
+                self.constants.TARGET_WEIGHT.value: target,
+                self.constants.TARGET_UNIT.value: self.scale.unit,
+            })
+            start = self.clock.monotonic()
+            self.settle()
+
+            # The dump of main.control_loop(), with the scale streaming as it does for trickling.
+            self.servo_motor.dump_mass = grams * dump_fraction
+            if self.calibration:
+                command = self.calibration.choose(target, self.scale.weight, self.scale.unit)
+                if command:
+                    self.calibration.learn(
+                        self.dump_sequence.run(self.scale, self.servo_motor, command.angle, command.dwell),
+                        self.scale.unit)
+            else:
+                self.dump_sequence.run(self.scale, self.servo_motor)
+
+            trickle_start = self.clock.monotonic()
+            # A charge which never reaches the target is stopped by turning auto mode off, as the user would.
+            self.world.deadline = self.clock.monotonic_ns() + int(max_time * 1e9)
+            self.pid.SetPoint = 100.0
+            result = main.trickler_loop(
+                self.store, self.constants, self.pid, self.cascade, self.scale, target, self.scale.unit, None,
+                self.loop_scheduler, self.cutoff)
+            self.world.deadline = None
+            trickle_time = self.clock.monotonic() - trickle_start
+            timed_out = result.reason is main.StopReason.AUTO_MODE_OFF
+            self.settle()
+            final = self.scale.weight
+            if self.cutoff:
+                self.cutoff.trickled(result.reason is main.StopReason.COMPLETE)
+                self.cutoff.settled(final, self.scale.is_stable)
+        return ChargeResult(
+            float(target), float(final), float(final - target), trickle_time, self.clock.monotonic() - start,
+            timed_out)
+
+
+def _percentile(values, percent):
+    """Returns the nearest-rank percentile of a list of numbers."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(percent / 100 * len(ordered) + 0.5)) - 1))]
+
+
+def summarize(results):
+    """Returns the benchmark numbers of a list of ChargeResults, as a dict."""
+    overshoots = [x.overshoot for x in results]
+    times = [x.trickle_time for x in results]
+    return {
+        'charges': len(results),
+        'charges_per_hour': 3600 * len(results) / sum(x.cycle_time for x in results),
+        'overshoot_mean': sum(overshoots) / len(overshoots),
+        'overshoot_p99': _percentile(overshoots, 99),
+        'time_to_target_mean': sum(times) / len(times),
+        'time_to_target_p99': _percentile(times, 99),
+        'timeouts': sum(x.timed_out for x in results),
+    }
+
+
+def run_cell(sections, profile_name, profile, target, charges, seed):
+    """Runs charges of one target and powder profile on a new twin. Returns (results, virtual seconds)."""
+    import configparser # pylint: disable=import-outside-toplevel;
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read_dict(sections)
+    twin = Twin(config, profile, seed=f'{seed}:{profile_name}:{target}')
+    start = twin.clock.monotonic()
+    results = [twin.run_charge(target) for _ in range(charges)]
+    return results, twin.clock.monotonic() - start
+
+
+def benchmark(config, targets, profiles, charges=20, seed=0, workers=None):
+    """Runs every combination of target and profile in a pool of worker processes.
+
+    Returns a dict of 'profile target': summary, and the virtual seconds simulated.
+    """
+    import concurrent.futures # pylint: disable=import-outside-toplevel;
+    sections = {x: dict(config[x]) for x in config.sections()}
+    cells = [(name, target) for name in profiles for target in targets]
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        futures = [
+            executor.submit(run_cell, sections, name, profiles[name], target, charges, seed) for name, target in cells]
+        outcomes = [x.result() for x in futures]
+    summaries = {f'{name} {target:g}': summarize(results) for (name, target), (results, _) in zip(cells, outcomes)}
+    return summaries, sum(x[1] for x in outcomes)
+
+
+def compare(baseline, summaries, tolerance=0.05, resolution=0.02):
+    """Returns a description of every way the summaries are worse than the baseline, beyond the tolerance."""
+    regressions = []
+    for cell, summary in summaries.items():
+        base = baseline.get(cell)
+        if base is None:
+            continue
+        if summary['charges_per_hour'] < base['charges_per_hour'] * (1 - tolerance):
+            regressions.append(f'{cell}: charges/hour {base["charges_per_hour"]:.1f} -> {summary["charges_per_hour"]:.1f}')
+        for key in ('overshoot_mean', 'overshoot_p99'):
+            if summary[key] - base[key] > max(abs(base[key]) * tolerance, resolution):
+                regressions.append(f'{cell}: {key} {base[key]:.3f} -> {summary[key]:.3f}')
+        for key in ('time_to_target_mean', 'time_to_target_p99'):
+            if summary[key] > base[key] * (1 + tolerance):
+                regressions.append(f'{cell}: {key} {base[key]:.2f}s -> {summary[key]:.2f}s')
+        if summary['timeouts'] > base['timeouts']:
+            regressions.append(f'{cell}: timeouts {base["timeouts"]} -> {summary["timeouts"]}')
+    return regressions
+
+
+if __name__ == '__main__':
+    import argparse
+    import configparser
+    import json
+    import sys
+
+    import helpers
+
+    parser = argparse.ArgumentParser(description='Benchmark the trickler control loop on a digital twin.')
+    parser.add_argument('config_file')
+    parser.add_argument('--targets', default='10,24.5,42,75', help='Comma separated target weights, in grains.')
+    parser.add_argument('--profiles', default=','.join(list(PROFILES) + ['simulator']),
+        help='Comma separated powder profiles: ' + ', '.join(PROFILES) + ', or simulator for the [simulator] model.')
+    parser.add_argument('--charges', type=int, default=20, help='Charges for each target and profile.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--save', help='Write the results to this JSON file, to compare against later.')
+    parser.add_argument('--compare', help='Fail if the results are worse than those saved in this JSON file.')
+    parser.add_argument('--tolerance', type=float, default=0.05, help='Relative change allowed by --compare.')
+    parser.add_argument('--cutoff', action='store_true', help='Stop the trickle early with the [cutoff] estimator.')
+    parser.add_argument('--calibration', action='store_true', help='Choose each dump with the [calibration] model.')
+    args = parser.parse_args()
+
+    helpers.setup_logging(logging.WARNING)
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read(args.config_file)
+    if args.cutoff:
+        if not config.has_section('cutoff'):
+            config.add_section('cutoff')
+        config['cutoff']['enabled'] = 'True'
+    if args.calibration:
+        if not config.has_section('calibration'):
+            config.add_section('calibration')
+        config['calibration']['enabled'] = 'True'
+
+    sim_config = config['simulator'] if config.has_section('simulator') else {}
+    profiles = dict(PROFILES)
+    profiles['simulator'] = dict(
+        flow_rates=[float(x) for x in sim_config.get('flow_rates', '0.02, 0.06').split(',')],
+        stall_pwm=float(sim_config.get('stall_pwm', 0.25)),
+        fall_time=float(sim_config.get('fall_time', 0.35)),
+        scale_lag=float(sim_config.get('scale_lag', 0.25)))
+    profiles = {x: profiles[x] for x in args.profiles.split(',')}
+    targets = [float(x) for x in args.targets.split(',')]
+
+    started = time.monotonic()
+    summaries, simulated = benchmark(config, targets, profiles, args.charges, args.seed, args.workers)
+    elapsed = time.monotonic() - started
+
+    print(f'{"profile target":<18} {"charges/h":>9} {"over mean":>9} {"over p99":>9} {"time mean":>9} '
+        f'{"time p99":>9} {"timeouts":>8}')
+    for cell, summary in summaries.items():
+        print(
+            f'{cell:<18} {summary["charges_per_hour"]:9.1f} {summary["overshoot_mean"]:9.3f} '
+            f'{summary["overshoot_p99"]:9.3f} {summary["time_to_target_mean"]:9.2f} '
+            f'{summary["time_to_target_p99"]:9.2f} {summary["timeouts"]:8d}')
+    print(f'Simulated {simulated / 3600:.1f} hours in {elapsed:.1f}s, {simulated / elapsed:.0f}x real time.')
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as results_file:
+            json.dump(summaries, results_file, indent=2)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as baseline_file:
+            regressions = compare(json.load(baseline_file), summaries, args.tolerance)
+        for regression in regressions:
+            print('Regression:', regression)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) codebydch and contributors. All rights reserved.
+Released under the MIT license. See LICENSE file in the project root for details.
+
+Benchmarks the scale frame parsers, comparing the original str/decimal.Decimal parsing against the bytes-level
+parsers in scales.py. Prints frames/second for each of the scale protocols.
+
+Usage: python3 utilities/parser_benchmark.py [--frames 200000]
+"""
+import argparse
+import decimal
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'trickler'))
+
+import scales # pylint: disable=import-error,wrong-import-position;
+
+
+# Sample frames for each protocol, cycled through during the benchmark.
+FRAMES = {
+    'and': [b'ST,+00012.34 GN\r\n', b'US,+00012.36 GN\r\n', b'ST,+000.8012  g\r\n', b'US,-00000.02 GN\r\n'],
+    'creedmoor': [b'+0012.34 GN\r\n', b'+0012.35 GN\r\n', b'+00.8012 g\r\n', b'-0000.01 GN\r\n'],
+    'ussolid': [b'+  12.345gn\r\n', b'+  12.346gn\r\n', b'+   0.801 g\r\n', b'-   0.001gn\r\n'],
+}
+
+
+def legacy_and(cls, raw):
+    """The original A&D parse path: strip, decode, slice, Decimal and rebuilt maps on every frame."""
+    line = raw.strip().decode('utf-8')
+    if line[0:2] in ('ST', 'US'):
+        weight = decimal.Decimal(line[3:12].strip())
+        unit = cls.unit_map[line[12:15].strip()]
+        resolution = cls.resolution_map[unit]
+        return weight, unit, resolution
+    return None
+
+
+def legacy_creedmoor(cls, raw):
+    """The original Creedmoor parse path."""
+    line = raw.rstrip(b'\r\n').decode('utf-8')
+    if line[0:1] in ('+', '-'):
+        weight = decimal.Decimal(line[0:8])
+        unit = cls.unit_map[line[9:11]]
+        resolution = cls.resolution_map[unit]
+        return weight, unit, resolution
+    return None
+
+
+def legacy_ussolid(cls, raw):
+    """The original U.S. Solid parse path."""
+    line = raw.rstrip(b'\r\n').decode('utf-8')
+    if line[0:1] in ('+', '-'):
+        weight = decimal.Decimal(line[0:9].replace(' ', ''))
+        unit = cls.unit_map[line[9:11].strip()]
+        resolution = cls.resolution_map[unit]
+        return weight, unit, resolution
+    return None
+
+
+LEGACY = {
+    'and': legacy_and,
+    'creedmoor': legacy_creedmoor,
+    'ussolid': legacy_ussolid,
+}
+
+
+def frames_per_second(fn, frames, count):
+    """Runs fn over count frames and returns the rate in frames/second."""
+    samples = (frames * (count // len(frames) + 1))[:count]
+
+    def run():
+        for raw in samples:
+            fn(raw)
+
+    elapsed = min(timeit.repeat(run, number=1, repeat=3))
+    return count / elapsed
+
+
+def main(args):
+    """Run the benchmark for every protocol and print a table."""
+    print(f'{"protocol":<10} {"before":>12} {"after":>12} {"after+Decimal":>14} {"speedup":>8}')
+    for name, frames in FRAMES.items():
+        cls = scales.SCALES[name]
+        legacy = LEGACY[name]
+        # Warm up the lookup tables so their one-time cost isn't measured.
+        cls._parse_frame(frames[0]) # pylint: disable=protected-access;
+        before = frames_per_second(lambda raw, cls=cls, legacy=legacy: legacy(cls, raw), frames, args.frames)
+        after = frames_per_second(cls._parse_frame, frames, args.frames) # pylint: disable=protected-access;
+        after_decimal = frames_per_second(
+            lambda raw, cls=cls: cls._parse_frame(raw).weight, # pylint: disable=protected-access;
+            frames,
+            args.frames)
+        print(f'{name:<10} {before:>12,.0f} {after:>12,.0f} {after_decimal:>14,.0f} {after / before:>7.1f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark scale frame parsers (frames/second).')
+    parser.add_argument('--frames', type=int, default=200000)
+    main(parser.parse_args())